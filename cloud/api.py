@@ -1,39 +1,105 @@
+import asyncio
+import itertools
 import json
 import os
 import logging
 import pathlib
 
+from contextlib import asynccontextmanager
 from datetime import datetime
 from io import BytesIO
 from json import JSONDecodeError
+from typing import AsyncIterator
 
 import multibase
 import qrcode
 from Crypto.PublicKey import ECC
 from functools import lru_cache
-from fastapi import FastAPI, Depends, Path, Body
+from fastapi import FastAPI, Depends, Header, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.params import Query
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import StreamingResponse
 from pydantic import ValidationError, HttpUrl
 from qrcode.image.styledpil import StyledPilImage
 from qrcode.image.styles.colormasks import SolidFillColorMask
 from qrcode.image.styles.moduledrawers import RoundedModuleDrawer
-from tinydb import TinyDB, where
 
-from crypto.crypto import initialize, load_private_key, generate_keys, encrypt_hpke, determine_role, \
-    decrypt_hpke, verify_vp
+from crypto.blockchain import blockchain, BlockchainUnavailable
+from crypto.crypto import initialize, load_private_key, encrypt_document, determine_role, \
+    verify_vp, did_cache, data_key_cache, parse_signed_request, SignedRequest, DID_REGEX, read_grants
+from crypto.executor import crypto_executor, ExecutorSaturated
 from dotenv import load_dotenv
-from util.models import EncryptedPayload, SuccessfulResponse, DID, \
-    BadRequestResponse, ForbiddenResponse, NotFoundResponse, VerifiablePresentation
-from util.middleware import verify_request, retrieve_data
+from util.cache import projection_cache
+from util.compression import compression
+from util.locks import StripedLock
+from util.projection import attribute_plans, parse_fields
+from util.models import EncryptedPayload, SuccessfulResponse, DID, DIDPage, bms_example, \
+    BadRequestResponse, ForbiddenResponse, NotFoundResponse, VerifiablePresentation, ConflictResponse, \
+    PreconditionFailedResponse, BatchResponse, RequestTooLargeResponse
+from util.middleware import verify_request, retrieve_data, update_data, prepare_battery_pass
 from util.validators import validate_battery_pass_payload
+from util.serialization import FastJSONResponse, dumps, loads, ndjson_lines
+from util.storage import BatteryPassStore, VersionConflict, open_store
+from util.timeseries import TimeSeriesStore, open_timeseries, telemetry_points
+from util.events import EventStore, open_events, telemetry_events
+from util.analytics import FleetAnalytics, open_analytics, parse_query, COLUMN_PATHS
+from util.anomaly import AnomalyDetector, open_anomaly_detector
+
+
+def log_task_failure(task: asyncio.Task) -> None:
+    """Log the exception of a background task as soon as it fails, nothing else awaits it."""
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Background task {task.get_name()} failed", exc_info=task.exception())
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Open the stores before serving, so a worker that can't open them, e.g. a second worker on the
+    # single-process log backend, fails at startup instead of on its first request
+    get_db()
+    get_timeseries()
+    get_events()
+    get_analytics()
+    get_anomaly_detector()
+    await blockchain.start()
+    crypto_executor.start()
+    background = [
+        asyncio.create_task(prewarm_projections(int(os.getenv("PROJECTION_CACHE_PREWARM", "0"))),
+                            name="prewarm-projections"),
+        asyncio.create_task(reconcile_analytics(), name="reconcile-analytics"),
+    ]
+    for task in background:
+        task.add_done_callback(log_task_failure)
+    yield
+    for task in background:
+        task.cancel()
+    # Let the tasks stop before the stores they use are closed, their failures have been logged already
+    await asyncio.gather(*background, return_exceptions=True)
+    crypto_executor.shutdown()
+    await blockchain.aclose()
+    get_db().close()
+    get_db.cache_clear()
+    get_timeseries().close()
+    get_timeseries.cache_clear()
+    get_events().close()
+    get_events.cache_clear()
+    get_analytics().close()
+    get_analytics.cache_clear()
+    get_anomaly_detector().close()
+    get_anomaly_detector.cache_clear()
+
 
 app = FastAPI(
     title="Battery Pass API",
     description="A detailed API description can be found "
                 "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data/tree/main/cloud/docs/api.md)**.",
     redoc_url=None,
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
+# Compress larger responses, e.g. full battery passes, for clients sending Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", "1024")))
 
 load_dotenv()
 
@@ -47,7 +113,7 @@ with open(pathlib.Path(__file__).parent / "docs" / "example" / "batterypass.json
 
 
 def error_response(status_code: int, message: str):
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=status_code,
         content={
             "status": status_code,
@@ -57,12 +123,57 @@ def error_response(status_code: int, message: str):
     )
 
 
-def get_db():
-    db = TinyDB("data/db.json")
-    try:
-        yield db
-    finally:
-        db.close()
+did_locks = StripedLock()
+
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(64 << 20)))
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+@app.exception_handler(BlockchainUnavailable)
+async def blockchain_unavailable_handler(_, e: BlockchainUnavailable):
+    logging.error(f"Blockchain unavailable: {e}")
+    return error_response(503, "Blockchain is unavailable.")
+
+
+@app.exception_handler(ExecutorSaturated)
+async def executor_saturated_handler(_, e: ExecutorSaturated):
+    logging.warning(f"Crypto executor saturated: {e}")
+    response = error_response(503, "Server is busy, try again later.")
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.exception_handler(RequestTooLarge)
+async def request_too_large_handler(_, e: RequestTooLarge):
+    return error_response(413, str(e))
+
+
+@lru_cache()
+def get_db() -> BatteryPassStore:
+    return open_store()
+
+
+@lru_cache()
+def get_timeseries() -> TimeSeriesStore:
+    return open_timeseries()
+
+
+@lru_cache()
+def get_events() -> EventStore:
+    return open_events()
+
+
+@lru_cache()
+def get_analytics() -> FleetAnalytics:
+    return open_analytics()
+
+
+@lru_cache()
+def get_anomaly_detector() -> AnomalyDetector:
+    return open_anomaly_detector()
 
 
 @lru_cache()
@@ -73,20 +184,206 @@ def get_private_key():
 pub_key_multibase = multibase.encode("base58btc", get_private_key().public_key().export_key(format="DER"))
 
 
-def set_nested_value(doc, path_keys, new_value):
-    current_level = doc
-    for key in path_keys[:-1]:
-        current_level = current_level.setdefault(key, {})
-    if isinstance(current_level[path_keys[-1]], list):
-        current_level[path_keys[-1]].append(new_value)
-    else:
-        current_level[path_keys[-1]] = new_value
+def to_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def parse_if_match(if_match: str | None) -> int | None:
+    """Parse an If-Match header holding the record version as returned in the ETag header."""
+    if if_match is None:
+        return None
+    value = if_match.strip().removeprefix("W/").strip('"')
+    if not value.isdigit():
+        raise ValueError("Invalid If-Match header, expected a record version.")
+    return int(value)
+
+
+if_match_header = Header(
+    default=None,
+    description="Only apply the change if the entry still has this version (as returned in the ETag header)."
+)
+
+
+def to_signed_request(body: bytes) -> SignedRequest:
+    try:
+        return parse_signed_request(body)
+    except ValueError as e:
+        field, _, message = str(e).partition(": ")
+        loc = ("body",) if field == "body" else ("body", field)
+        raise RequestValidationError([{"type": "value_error", "loc": loc, "msg": message}])
+
+
+async def read_signed_request(request: Request) -> SignedRequest | None:
+    """
+    Parse the body of a request as an encrypted payload straight from the raw bytes,
+    returns None if the body is empty.
+    """
+    body = await request.body()
+    if not body:
+        return None
+    return to_signed_request(body)
+
+
+async def require_signed_request(payload: SignedRequest | None = Depends(read_signed_request)) -> SignedRequest:
+    if payload is None:
+        raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required"}])
+    return payload
+
+
+async def read_batch_body(request: Request) -> bytearray:
+    """
+    Read the body of a batch request chunk by chunk into a single buffer, so a batch larger
+    than ``BATCH_MAX_BYTES`` is rejected as soon as that is known instead of after receiving it.
+    """
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > BATCH_MAX_BYTES:
+        raise RequestTooLarge(f"Batch exceeds {BATCH_MAX_BYTES} bytes.")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > BATCH_MAX_BYTES:
+            raise RequestTooLarge(f"Batch exceeds {BATCH_MAX_BYTES} bytes.")
+    if not body:
+        raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required"}])
+    return body
+
+
+async def read_signed_batch(body: bytearray = Depends(read_batch_body)) -> SignedRequest:
+    return to_signed_request(body)
+
+
+def signed_request_body(required: bool = True, media_type: str = "application/json") -> dict:
+    """Document the encrypted payload in the OpenAPI spec, as the body isn't parsed by FastAPI."""
+    return {"requestBody": {
+        "required": required,
+        "content": {media_type: {"schema": EncryptedPayload.model_json_schema()}},
+    }}
+
+
+def record_tag(document: dict) -> tuple:
+    """
+    Identify the state of a record for the projection cache. The encapsulated key tells a record
+    apart from an earlier record of the same DID that has been deleted in the meantime.
+    """
+    enc = document["encrypted_data"]["enc"]
+    return document["version"], enc if isinstance(enc, str) else bytes(enc)
+
+
+async def render_projection(scope: str, did: str, document: dict, private_key: ECC.EccKey,
+                            fields: tuple[tuple[str, ...], ...] = ()) -> bytes:
+    """
+    Return the JSON body of the projection of a record for a scope, rendering it only if it isn't
+    cached yet for this state of the record and of ``attributes.jsonc``. Projections restricted
+    to fields are cached separately from the full projection.
+    """
+    # The body is cached under the generation of the very plan it's rendered with
+    generation, plan = attribute_plans.get(scope, fields)
+    tag = record_tag(document), generation
+    key = scope if not fields else f"{scope}?fields={','.join('.'.join(path) for path in fields)}"
+    body = projection_cache.get(did, key, tag)
+    if body is None:
+        body = await crypto_executor.run("retrieve", retrieve_data, scope, did, document, private_key, fields,
+                                         plan)
+        projection_cache.put(did, key, tag, body)
+    return body
+
+
+async def read_projection(scope: str, did: str, document: dict, private_key: ECC.EccKey,
+                          fields: tuple[tuple[str, ...], ...] = ()) -> Response:
+    body = await render_projection(scope, did, document, private_key, fields)
+    return Response(body, media_type="application/json", headers={"ETag": to_etag(document["version"])})
+
+
+async def prewarm_projections(count: int) -> None:
+    """Render the public projections of the first ``count`` battery passes in the background."""
+    db, private_key = get_db(), get_private_key()
+    for did in itertools.islice(db.dids(), count):
+        document = db.get(did)
+        if document is not None:
+            await read_projection("public", did, document, private_key)
+    if count:
+        logging.info(f"Projection cache prewarmed: {projection_cache.stats()}")
+
+
+async def read_analytics(did: str, document: dict) -> None:
+    """Set the row of a battery pass in the fleet analytics, decrypting only the submodels holding its columns."""
+    columns = await crypto_executor.run("retrieve", retrieve_data, "bms", did, document, get_private_key(),
+                                        COLUMN_PATHS)
+    get_analytics().put(did, record_tag(document), loads(columns))
+
+
+async def reconcile_analytics() -> None:
+    """
+    Bring the fleet analytics in line with the database in the background, i.e. read the columns
+    of battery passes without a row or with an outdated one and drop the rows of deleted ones.
+    """
+    db, analytics = get_db(), get_analytics()
+    dids = set()
+    read = 0
+    for did in db.dids():
+        dids.add(did)
+        async with did_locks(did):
+            document = db.get(did)
+            if document is None or analytics.is_current(did, record_tag(document)):
+                continue
+            try:
+                await read_analytics(did, document)
+            except Exception:
+                # A battery pass that can't be read mustn't leave the analytics of the rest empty
+                logging.exception(f"Could not read the fleet analytics of {did}")
+                continue
+            read += 1
+    for did in set(analytics.dids()) - dids:
+        if did not in db:
+            analytics.remove(did)
+    logging.info(f"Fleet analytics reconciled, read {read} battery passes: {analytics.stats()}")
+
+
+def batch_result(did: str | None, status: int, message: str) -> dict:
+    return {"did": did, "status": status, "message": message}
+
+
+def batch_response(results: list[dict]) -> dict:
+    succeeded = sum(1 for result in results if result["status"] == 200)
+    return {"succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
+
+async def read_batch_lines(dids: list, grants: set[str], db: BatteryPassStore, private_key: ECC.EccKey,
+                           fields: tuple[tuple[str, ...], ...] = ()) -> AsyncIterator[bytes]:
+    """
+    Read the legitimate interest projections of several DIDs concurrently and yield one NDJSON
+    line per DID as soon as it is ready.
+    """
+    slots = asyncio.Semaphore(2 * crypto_executor.workers)
+
+    async def read_one(did) -> bytes:
+        if not isinstance(did, str) or not DID_REGEX.match(did):
+            return dumps(batch_result(did if isinstance(did, str) else None, 400, "Invalid DID.")) + b"\n"
+        if did not in grants:
+            return dumps(batch_result(did, 403, "Access denied.")) + b"\n"
+        document = db.get(did)
+        if document is None:
+            return dumps(batch_result(did, 404, "Entry doesn't exist.")) + b"\n"
+        try:
+            async with slots:
+                body = await render_projection("legitimate_interest", did, document, private_key, fields)
+        except ExecutorSaturated:
+            return dumps(batch_result(did, 503, "Server is busy, try again later.")) + b"\n"
+        return b'{"did":%s,"status":200,"version":%d,"data":%s}\n' % (dumps(did), document["version"], body)
+
+    tasks = [asyncio.create_task(read_one(did)) for did in dids]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 def is_vp(b: bytes) -> VerifiablePresentation | None:
     try:
-        model = json.loads(b)
-    except (json.JSONDecodeError, UnicodeDecodeError):
+        model = loads(b)
+    except (JSONDecodeError, UnicodeDecodeError):
         return None
     try:
         return VerifiablePresentation.model_validate(model)
@@ -130,15 +427,76 @@ def read_root():
     return {"ok": "API is running.", "publicKeyMultibase": pub_key_multibase}
 
 
+def parse_prefix(prefix: str | None) -> str | None:
+    return prefix.removesuffix("*") if prefix else None
+
+
+fields_query = Query(
+    default=None,
+    description="Only return these attributes, as comma separated dotted paths like "
+                "`performance.batteryCondition.remainingCapacity`."
+)
+prefix_query = Query(
+    default=None,
+    description="Only list DIDs starting with this prefix, e.g. `did:batterypass:bms.sn-AB*`."
+)
+
+
+@app.get("/stats",
+         summary="Cache and performance statistics",
+         tags=["General"])
+async def read_stats():
+    """
+    Provides hit/miss counts and latencies of the DID document, data key and projection caches,
+    the queue depth and per-stage latencies of the crypto executor, the compression ratio,
+    the size of the time-series and event stores and of the fleet analytics and the number of anomaly alerts.
+    """
+    return {
+        "did_cache": did_cache.stats(),
+        "data_key_cache": data_key_cache.stats(),
+        "projection_cache": projection_cache.stats(),
+        "compression": compression.stats(),
+        "crypto_executor": crypto_executor.stats(),
+        "timeseries": get_timeseries().stats(),
+        "events": get_events().stats(),
+        "analytics": get_analytics().stats(),
+        "anomalies": get_anomaly_detector().stats(),
+    }
+
+
 @app.get("/batterypass/",
-         summary="List all stored DIDs",
+         summary="List the stored DIDs page by page",
+         tags=["Battery Pass"],
+         responses={
+             200: {"model": DIDPage}
+         })
+async def list_dids(
+        limit: int = Query(default=100, ge=1, le=1000, description="The maximum number of DIDs per page."),
+        cursor: str | None = Query(default=None, description="The `next_cursor` of the previous page."),
+        prefix: str | None = prefix_query,
+        db: BatteryPassStore = Depends(get_db),
+):
+    """
+    List the stored DIDs in lexicographic order. Follow `next_cursor` to fetch the next page.
+    """
+    dids = db.list_dids(limit + 1, after=cursor, prefix=parse_prefix(prefix))
+    return {"dids": dids[:limit], "next_cursor": dids[limit - 1] if len(dids) > limit else None}
+
+
+@app.get("/batterypass/stream",
+         summary="Stream all stored DIDs as NDJSON",
          tags=["Battery Pass"],
          responses={
-             200: {"model": list[DID]}
+             200: {"content": {"application/x-ndjson": {"example": f"\"{bms_example}\"\n"}}}
          })
-async def list_dids(db: TinyDB = Depends(get_db)):
-    entries = db.all()
-    return [entry["did"] for entry in entries if "did" in entry]
+def stream_dids(prefix: str | None = prefix_query, db: BatteryPassStore = Depends(get_db)):
+    """
+    Stream the stored DIDs in lexicographic order as newline-delimited JSON strings.
+    """
+    return StreamingResponse(
+        (dumps(did) + b"\n" for did in db.dids(prefix=parse_prefix(prefix))),
+        media_type="application/x-ndjson"
+    )
 
 
 @app.post("/batterypass/read/{did}",
@@ -152,39 +510,206 @@ async def list_dids(db: TinyDB = Depends(get_db)):
           description="A detailed description can be found "
                       "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
                       "/blob/main/cloud/docs/api.md#get-batterypassreaddid)**. "
-                      "If body is omitted, read public data."
+                      "If body is omitted, read public data.",
+          openapi_extra=signed_request_body(required=False),
           )
 async def read_item(
         did: DID,
-        payload: EncryptedPayload = None,
-        db: TinyDB = Depends(get_db),
+        response: Response,
+        payload: SignedRequest | None = Depends(read_signed_request),
+        fields: str | None = fields_query,
+        db: BatteryPassStore = Depends(get_db),
         private_key: ECC.EccKey = Depends(get_private_key),
 ):
     """
     Retrieve a battery pass entry by a specified Decentralized Identifier (DID).
-    This endpoint fetches information from the TinyDB database corresponding
+    This endpoint fetches information from the battery pass store corresponding
     to the given DID. The DID must be formatted correctly for the query to
-    execute successfully.
+    execute successfully. With `fields`, only the requested attributes readable
+    by the caller are returned.
     """
-    document = db.search(where("did") == did)
-    if not document:
+    try:
+        selected_fields = parse_fields(fields) if fields else ()
+    except ValueError as e:
+        return error_response(400, str(e))
+    document = db.get(did)
+    if document is None:
         return error_response(404, "Entry doesn't exist.")
+    response.headers["ETag"] = to_etag(document["version"])
     if not payload:
-        return retrieve_data(scope="public", did=did, doc=document[0], private_key=private_key)
+        return await read_projection("public", did, document, private_key, selected_fields)
     try:
-        decrypted_payload = verify_request(payload, private_key)
+        decrypted_payload = await verify_request(payload, private_key)
         vp: VerifiablePresentation = is_vp(decrypted_payload)
         if not vp and len(decrypted_payload) != 128:
             raise ValueError("Invalid length for random value.")
     except ValueError as e:
         return error_response(400, str(e))
-    if determine_role(document[0], payload.did) == "bms":
-        return retrieve_data(scope="bms", did=did, doc=document[0], private_key=private_key)
-    if vp and verify_vp(json.loads(decrypted_payload)) == "read":
-        return retrieve_data(scope="legitimate_interest", did=did, doc=document[0], private_key=private_key)
+    if await determine_role(document, payload.did) == "bms":
+        return Response(
+            await crypto_executor.run("retrieve", retrieve_data, "bms", did, document, private_key, selected_fields),
+            media_type="application/json", headers={"ETag": to_etag(document["version"])}
+        )
+    if vp and await verify_vp(loads(decrypted_payload)) == "read":
+        return await read_projection("legitimate_interest", did, document, private_key, selected_fields)
     return error_response(400, "Invalid request.")
 
 
+@app.post("/batterypass/batch/read",
+          summary="Read the battery pass entries of many DIDs with one Verifiable Presentation",
+          tags=["Battery Pass"],
+          responses={
+              200: {"content": {"application/x-ndjson": {"example": (
+                  f'{{"did": "{bms_example}", "status": 200, "version": 1, "data": {{}}}}\n'
+                  f'{{"did": "{bms_example}0", "status": 403, "message": "Access denied."}}\n'
+              )}}},
+              400: {"model": BadRequestResponse},
+              403: {"model": ForbiddenResponse},
+              413: {"model": RequestTooLargeResponse},
+          },
+          description="A detailed description can be found "
+                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                      "/blob/main/cloud/docs/api.md#post-batterypassbatchread)**.",
+          openapi_extra=signed_request_body())
+async def read_batch(
+        payload: SignedRequest = Depends(read_signed_batch),
+        fields: str | None = fields_query,
+        db: BatteryPassStore = Depends(get_db),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Read the legitimate interest data of many battery passes with a single Verifiable Presentation.
+
+    The presentation is verified once. Every DID is then checked against the credentials of the
+    presentation and read concurrently, the results are streamed back as one NDJSON line per DID
+    in the order they complete.
+    """
+    try:
+        selected_fields = parse_fields(fields) if fields else ()
+        request = loads(await verify_request(payload, private_key))
+        if not isinstance(request, dict) or not isinstance(request.get("dids"), list):
+            raise ValueError("Expected a presentation and a list of DIDs.")
+        VerifiablePresentation.model_validate(request.get("presentation"))
+    except JSONDecodeError:
+        return error_response(400, "Error occurred while decoding JSON.")
+    except ValidationError:
+        return error_response(400, "Invalid Verifiable Presentation.")
+    except ValueError as e:
+        return error_response(400, str(e))
+    if await verify_vp(request["presentation"]) != "read":
+        return error_response(403, "Access denied.")
+    dids = list(dict.fromkeys(did if isinstance(did, str) else None for did in request["dids"]))
+    return StreamingResponse(
+        read_batch_lines(dids, read_grants(request["presentation"]), db, private_key, selected_fields),
+        media_type="application/x-ndjson"
+    )
+
+
+@app.post("/batterypass/telemetry/{did}",
+          summary="Get the telemetry history of a battery pass entry by DID",
+          tags=["Battery Pass"],
+          responses={
+              200: {"content": {"application/json": {"example": {"did": bms_example, "metrics": {
+                  "stateOfCharge.stateOfChargeValue": {
+                      "raw": {"time": [1738328789.437], "value": [87.5]},
+                      "1h": {"time": [1738324800.0], "min": [86.0], "max": [91.0], "mean": [88.5], "count": [4]},
+                  }
+              }}}}},
+              400: {"model": BadRequestResponse},
+              403: {"model": ForbiddenResponse},
+              404: {"model": NotFoundResponse},
+          },
+          description="A detailed description can be found "
+                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                      "/blob/main/cloud/docs/api.md#post-batterypasstelemetrydid)**.",
+          openapi_extra=signed_request_body())
+async def read_telemetry(
+        did: DID,
+        payload: SignedRequest = Depends(require_signed_request),
+        metric: str | None = Query(
+            default=None,
+            description="Only return this metric and the metrics below it, e.g. `stateOfCharge`."
+        ),
+        since: datetime | None = Query(default=None, description="Only return points from this time on."),
+        until: datetime | None = Query(default=None, description="Only return points up to this time."),
+        db: BatteryPassStore = Depends(get_db),
+        timeseries: TimeSeriesStore = Depends(get_timeseries),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Retrieve the history of the numeric telemetry below `performance.batteryCondition` of a battery pass,
+    as recorded by its updates. Recent points are returned as reported, older ones downsampled into
+    buckets with their minimum, maximum, mean and count. Times are Unix timestamps in seconds.
+    """
+    try:
+        decrypted_payload = await verify_request(payload, private_key)
+        vp: VerifiablePresentation = is_vp(decrypted_payload)
+        if not vp and len(decrypted_payload) != 128:
+            raise ValueError("Invalid length for random value.")
+    except ValueError as e:
+        return error_response(400, str(e))
+    document = db.get(did)
+    if document is None:
+        return error_response(404, "Entry doesn't exist.")
+    if await determine_role(document, payload.did) != "bms" and not (
+            vp and await verify_vp(loads(decrypted_payload)) == "read"):
+        return error_response(403, "Access denied.")
+    return {"did": did, "metrics": timeseries.query(
+        did, metric, since.timestamp() if since else None, until.timestamp() if until else None
+    )}
+
+
+@app.post("/batterypass/events/{did}",
+          summary="Get the event history of a battery pass entry by DID",
+          tags=["Battery Pass"],
+          responses={
+              200: {"content": {"application/json": {"example": {"did": bms_example, "events": [
+                  {"list": "negativeEvents", "time": 1738328789.437,
+                   "entry": {"negativeEvent": "Deep discharge", "lastUpdate": "2025-01-31T14:06:29.437+01:00"}},
+              ]}}}},
+              400: {"model": BadRequestResponse},
+              403: {"model": ForbiddenResponse},
+              404: {"model": NotFoundResponse},
+          },
+          description="A detailed description can be found "
+                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                      "/blob/main/cloud/docs/api.md#post-batterypasseventsdid)**.",
+          openapi_extra=signed_request_body())
+async def read_events(
+        did: DID,
+        payload: SignedRequest = Depends(require_signed_request),
+        event_list: str | None = Query(
+            default=None, alias="list", description="Only return the events of this list, e.g. `negativeEvents`."
+        ),
+        since: datetime | None = Query(default=None, description="Only return events from this time on."),
+        until: datetime | None = Query(default=None, description="Only return events up to this time."),
+        db: BatteryPassStore = Depends(get_db),
+        events: EventStore = Depends(get_events),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Retrieve the history of the event lists below `performance.batteryCondition` of a battery pass, e.g.
+    `negativeEvents`, as recorded by its updates. The entry itself only keeps the latest event of each list.
+    Times are Unix timestamps in seconds.
+    """
+    try:
+        decrypted_payload = await verify_request(payload, private_key)
+        vp: VerifiablePresentation = is_vp(decrypted_payload)
+        if not vp and len(decrypted_payload) != 128:
+            raise ValueError("Invalid length for random value.")
+    except ValueError as e:
+        return error_response(400, str(e))
+    document = db.get(did)
+    if document is None:
+        return error_response(404, "Entry doesn't exist.")
+    if await determine_role(document, payload.did) != "bms" and not (
+            vp and await verify_vp(loads(decrypted_payload)) == "read"):
+        return error_response(403, "Access denied.")
+    return {"did": did, "events": events.query(
+        did, event_list, since.timestamp() if since else None, until.timestamp() if until else None
+    )}
+
+
 @app.put("/batterypass/create/{did}",
          summary="Create a new battery pass entry for a DID",
          tags=["Battery Pass"],
@@ -200,11 +725,14 @@ async def read_item(
          },
          description="A detailed description can be found "
                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
-                     "/blob/main/cloud/docs/api.md#put-batterypasscreatedid)**.")
+                     "/blob/main/cloud/docs/api.md#put-batterypasscreatedid)**.",
+         openapi_extra=signed_request_body())
 async def create_item(
-        payload: EncryptedPayload,
         did: DID,
-        db: TinyDB = Depends(get_db),
+        response: Response,
+        payload: SignedRequest = Depends(require_signed_request),
+        db: BatteryPassStore = Depends(get_db),
+        analytics: FleetAnalytics = Depends(get_analytics),
         private_key: ECC.EccKey = Depends(get_private_key),
 ):
     """
@@ -216,24 +744,122 @@ async def create_item(
     database, an HTTPException with status code 400 is raised.
     """
     try:
-        decrypted_payload = verify_request(payload, private_key)
+        decrypted_payload = await verify_request(payload, private_key)
     except ValueError as e:
         return error_response(400, str(e))
-    if db.search(where("did") == did):
+    if did in db:
         logging.warning(f"DID {did} already exists in DB")
         return error_response(400, "Entry already exists.")
-    if not determine_role(None, payload.did) == "oem":
+    if not await determine_role(None, payload.did) == "oem":
         return error_response(403, "Access denied.")
-    results = validate_battery_pass_payload(json.loads(decrypted_payload))
+    battery_pass = loads(decrypted_payload)
+    results = validate_battery_pass_payload(battery_pass)
     if not all(value == "Valid" for value in results.values()):
         return error_response(400, f"Invalid payload: {json.dumps(results)}")
-    db.insert({
-        "did": did,
-        "encrypted_data": encrypt_hpke(private_key, decrypted_payload)
-    })
+    encrypted_data = await crypto_executor.run("encrypt", encrypt_document, private_key, did, battery_pass)
+    try:
+        db.insert(did, encrypted_data)
+    except KeyError:
+        return error_response(400, "Entry already exists.")
+    analytics.put(did, record_tag({"version": 1, "encrypted_data": encrypted_data}), battery_pass)
+    response.headers["ETag"] = to_etag(1)
     return {"ok": f"Entry for {did} added successfully."}
 
 
+@app.put("/batterypass/batch/create",
+         summary="Create battery pass entries for many DIDs at once",
+         tags=["Battery Pass"],
+         responses={
+             200: {"model": BatchResponse},
+             400: {"model": BadRequestResponse},
+             403: {"model": ForbiddenResponse},
+             413: {"model": RequestTooLargeResponse},
+         },
+         description="A detailed description can be found "
+                     "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                     "/blob/main/cloud/docs/api.md#put-batterypassbatchcreate)**.",
+         openapi_extra=signed_request_body())
+async def create_batch(
+        payload: SignedRequest = Depends(read_signed_batch),
+        db: BatteryPassStore = Depends(get_db),
+        analytics: FleetAnalytics = Depends(get_analytics),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Create battery pass entries for many DIDs with a single signed request of an OEM.
+
+    The decrypted payload holds one `{"did": ..., "payload": {...}}` entry per line. The OEM role
+    is checked once for the whole batch, the entries are validated and encrypted in parallel and
+    all valid entries are stored in a single transaction. Invalid entries are reported in the
+    per-entry results and don't keep the others from being created.
+    """
+    try:
+        decrypted_payload = await verify_request(payload, private_key)
+    except ValueError as e:
+        return error_response(400, str(e))
+    if await determine_role(None, payload.did) != "oem":
+        return error_response(403, "Access denied.")
+
+    results: list[dict | None] = []
+    records: dict[int, tuple[str, dict]] = {}
+    battery_passes: dict[int, dict] = {}
+    seen = set()
+    # Entries are only parsed as fast as workers become available to validate them
+    slots = asyncio.Semaphore(2 * crypto_executor.workers)
+
+    async def prepare(index: int, did: str, battery_pass: dict) -> None:
+        try:
+            records[index] = did, await crypto_executor.run(
+                "encrypt", prepare_battery_pass, did, battery_pass, private_key
+            )
+            battery_passes[index] = battery_pass
+        except ValueError as e:
+            results[index] = batch_result(did, 400, str(e))
+        finally:
+            slots.release()
+
+    tasks = []
+    for index, line in enumerate(ndjson_lines(decrypted_payload)):
+        results.append(None)
+        try:
+            entry = loads(line)
+        except (JSONDecodeError, UnicodeDecodeError):
+            results[index] = batch_result(None, 400, "Error occurred while decoding JSON.")
+            continue
+        did = entry.get("did") if isinstance(entry, dict) else None
+        if not isinstance(did, str) or not DID_REGEX.match(did):
+            results[index] = batch_result(did if isinstance(did, str) else None, 400, "Invalid DID.")
+        elif not isinstance(entry.get("payload"), dict):
+            results[index] = batch_result(did, 400, "Invalid payload.")
+        elif did in seen:
+            results[index] = batch_result(did, 400, "Duplicate DID in batch.")
+        elif did in db:
+            results[index] = batch_result(did, 400, "Entry already exists.")
+        else:
+            seen.add(did)
+            await slots.acquire()
+            tasks.append(asyncio.create_task(prepare(index, did, entry["payload"])))
+    if not results:
+        return error_response(400, "Empty batch.")
+    await asyncio.gather(*tasks)
+
+    entries = [records[index] for index in sorted(records)]
+    existing = set()
+    try:
+        db.insert_many(entries)
+    except KeyError:
+        # Some of the DIDs have been created concurrently since they were checked
+        existing = {did for did, _ in entries if did in db}
+        db.insert_many([(did, data) for did, data in entries if did not in existing])
+    for index, (did, encrypted_data) in records.items():
+        if did in existing:
+            results[index] = batch_result(did, 400, "Entry already exists.")
+        else:
+            analytics.put(did, record_tag({"version": 1, "encrypted_data": encrypted_data}), battery_passes[index])
+            results[index] = batch_result(did, 200, f"Entry for {did} added successfully.")
+    return batch_response(results)
+
+
 @app.post("/batterypass/update/{did}",
           summary="Update a battery pass entry by DID",
           tags=["Battery Pass"],
@@ -247,14 +873,23 @@ async def create_item(
               400: {"model": BadRequestResponse},
               403: {"model": ForbiddenResponse},
               404: {"model": NotFoundResponse},
+              409: {"model": ConflictResponse},
+              412: {"model": PreconditionFailedResponse},
           },
           description="A detailed description can be found "
                       "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
-                      "/blob/main/cloud/docs/api.md#post-batterypassupdatedid)**.")
+                      "/blob/main/cloud/docs/api.md#post-batterypassupdatedid)**.",
+          openapi_extra=signed_request_body())
 async def update_item(
-        payload: EncryptedPayload,
         did: DID,
-        db: TinyDB = Depends(get_db),
+        response: Response,
+        payload: SignedRequest = Depends(require_signed_request),
+        if_match: str | None = if_match_header,
+        db: BatteryPassStore = Depends(get_db),
+        timeseries: TimeSeriesStore = Depends(get_timeseries),
+        events: EventStore = Depends(get_events),
+        analytics: FleetAnalytics = Depends(get_analytics),
+        anomalies: AnomalyDetector = Depends(get_anomaly_detector),
         private_key: ECC.EccKey = Depends(get_private_key),
 ):
     """
@@ -264,32 +899,158 @@ async def update_item(
     Decodes the encrypted data provided in the request payload using the specified private key. Fetches the document
     associated with the given DID from the database, decrypts it, and applies the updates from the payload. The updated
     data is re-encrypted and stored back in the database.
+
+    An update of a DID fails with 409 while another one is in progress. If an If-Match header is given,
+    the update is only applied if the entry still has that version. Numeric telemetry below `performance.batteryCondition`
+    is recorded in the time-series store and checked for anomalies, events like `negativeEvents` are
+    recorded in the event store. The lists of the telemetry only keep their latest entry.
     """
     try:
-        decrypted_payload = json.loads(verify_request(payload, private_key))
+        expected_version = parse_if_match(if_match)
+        decrypted_payload = loads(await verify_request(payload, private_key))
     except JSONDecodeError:
         return error_response(400, "Error occurred while decoding JSON.")
     except ValueError as e:
         return error_response(400, str(e))
 
-    document = db.search(where("did") == did)
-    if not document:
+    # Authorize before taking the lock, so a DID resolution doesn't hold up other requests for the DID
+    document = db.get(did)
+    if document is None:
         return error_response(404, "Entry doesn't exist.")
-    if determine_role(document[0], payload.did) != "bms":
+    if await determine_role(document, payload.did) != "bms":
         return error_response(403, "Access denied.")
-    decrypted_document = json.loads(decrypt_hpke(private_key, document[0]["encrypted_data"]))
-    for element in decrypted_payload:  # Iterate over the list of JSON items
-        if not isinstance(element, dict) or len(element) != 1:
-            return error_response(400, "Invalid update format.")
-        key, value = next(iter(element.items()))
-        set_nested_value(decrypted_document, key.split("."), value)
-    encrypted_data = encrypt_hpke(
-        private_key.public_key(), json.dumps(decrypted_document).encode()
-    )
-    db.update({"encrypted_data": encrypted_data}, where("did") == did)
+
+    async with did_locks.hold(did) as acquired:
+        if not acquired:
+            return error_response(409, "Entry is being modified by another request.")
+        document = db.get(did)
+        if document is None:
+            return error_response(404, "Entry doesn't exist.")
+        if expected_version is not None and document["version"] != expected_version:
+            return error_response(412, f"Entry has version {document['version']}, expected {expected_version}.")
+        try:
+            encrypted_data = await crypto_executor.run(
+                "update", update_data, document, decrypted_payload, private_key
+            )
+        except ValueError as e:
+            return error_response(400, str(e))
+        try:
+            version = db.update(did, encrypted_data, expected_version=document["version"])
+        except KeyError:
+            return error_response(404, "Entry doesn't exist.")
+        except VersionConflict:
+            return error_response(409, "Entry has been modified concurrently.")
+        projection_cache.invalidate(did)
+        points = telemetry_points(decrypted_payload)
+        timeseries.record(did, points)
+        events.record(did, telemetry_events(decrypted_payload))
+        anomalies.observe(did, points)
+        updated = {"version": version, "encrypted_data": encrypted_data}
+        if not analytics.update(did, record_tag(document), record_tag(updated), decrypted_payload):
+            await read_analytics(did, updated)
+    response.headers["ETag"] = to_etag(version)
     return {"ok": f"Entry for {did} updated successfully."}
 
 
+@app.post("/batterypass/batch/update",
+          summary="Update the battery pass entries of many DIDs at once",
+          tags=["Battery Pass"],
+          responses={
+              200: {"model": BatchResponse},
+              400: {"model": BadRequestResponse},
+              413: {"model": RequestTooLargeResponse},
+          },
+          description="A detailed description can be found "
+                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                      "/blob/main/cloud/docs/api.md#post-batterypassbatchupdate)**.",
+          openapi_extra=signed_request_body(media_type="application/x-ndjson"))
+async def update_batch(
+        body: bytearray = Depends(read_batch_body),
+        db: BatteryPassStore = Depends(get_db),
+        timeseries: TimeSeriesStore = Depends(get_timeseries),
+        events: EventStore = Depends(get_events),
+        analytics: FleetAnalytics = Depends(get_analytics),
+        anomalies: AnomalyDetector = Depends(get_anomaly_detector),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Update the battery pass entries of many DIDs with a single request, e.g. from a gateway in
+    front of many BMS.
+
+    The body holds one encrypted payload per line, each signed by the BMS whose entry it updates.
+    The payloads are verified, decrypted and applied in parallel, the updated entries are stored
+    as one group. An update of an entry modified in the meantime fails with status 409.
+    """
+    results: list[dict | None] = []
+    updates: dict[int, tuple[str, dict, int]] = {}
+    points: dict[int, list] = {}
+    changes: dict[int, list] = {}
+    tags: dict[int, tuple] = {}
+    seen = set()
+    slots = asyncio.Semaphore(2 * crypto_executor.workers)
+
+    async def prepare(index: int, payload: SignedRequest) -> None:
+        did = payload.did
+        try:
+            decrypted_payload = loads(await verify_request(payload, private_key))
+            document = db.get(did)
+            if document is None:
+                results[index] = batch_result(did, 404, "Entry doesn't exist.")
+            elif await determine_role(document, did) != "bms":
+                results[index] = batch_result(did, 403, "Access denied.")
+            else:
+                updates[index] = did, await crypto_executor.run(
+                    "update", update_data, document, decrypted_payload, private_key
+                ), document["version"]
+                points[index] = telemetry_points(decrypted_payload)
+                changes[index] = decrypted_payload
+                tags[index] = record_tag(document)
+        except JSONDecodeError:
+            results[index] = batch_result(did, 400, "Error occurred while decoding JSON.")
+        except ValueError as e:
+            results[index] = batch_result(did, 400, str(e))
+        finally:
+            slots.release()
+
+    tasks = []
+    for index, line in enumerate(ndjson_lines(body)):
+        results.append(None)
+        try:
+            payload = parse_signed_request(bytes(line))
+        except ValueError as e:
+            results[index] = batch_result(None, 400, str(e))
+            continue
+        if payload.did in seen:
+            results[index] = batch_result(payload.did, 400, "Duplicate DID in batch.")
+            continue
+        seen.add(payload.did)
+        await slots.acquire()
+        tasks.append(asyncio.create_task(prepare(index, payload)))
+    if not results:
+        return error_response(400, "Empty batch.")
+    await asyncio.gather(*tasks)
+
+    indices = sorted(updates)
+    stale = []
+    for index, version in zip(indices, db.update_many([updates[index] for index in indices])):
+        did = updates[index][0]
+        if isinstance(version, KeyError):
+            results[index] = batch_result(did, 404, "Entry doesn't exist.")
+        elif isinstance(version, VersionConflict):
+            results[index] = batch_result(did, 409, "Entry has been modified concurrently.")
+        else:
+            projection_cache.invalidate(did)
+            timeseries.record(did, points[index])
+            events.record(did, telemetry_events(changes[index]))
+            anomalies.observe(did, points[index])
+            updated = {"version": version, "encrypted_data": updates[index][1]}
+            if not analytics.update(did, tags[index], record_tag(updated), changes[index]):
+                stale.append((did, updated))
+            results[index] = batch_result(did, 200, f"Entry for {did} updated successfully.")
+    await asyncio.gather(*(read_analytics(*entry) for entry in stale))
+    return batch_response(results)
+
+
 @app.post("/batterypass/delete/{did}",
           summary="Delete a battery pass entry by DID",
           tags=["Battery Pass"],
@@ -303,36 +1064,67 @@ async def update_item(
               400: {"model": BadRequestResponse},
               403: {"model": ForbiddenResponse},
               404: {"model": NotFoundResponse},
+              409: {"model": ConflictResponse},
+              412: {"model": PreconditionFailedResponse},
           },
           description="A detailed description can be found "
                       "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
-                      "/blob/main/cloud/docs/api.md#delete-batterypassdeletedid)**.")
+                      "/blob/main/cloud/docs/api.md#delete-batterypassdeletedid)**.",
+          openapi_extra=signed_request_body())
 async def delete_item(
         did: DID,
-        payload: EncryptedPayload,
-        db: TinyDB = Depends(get_db),
+        payload: SignedRequest = Depends(require_signed_request),
+        if_match: str | None = if_match_header,
+        db: BatteryPassStore = Depends(get_db),
+        timeseries: TimeSeriesStore = Depends(get_timeseries),
+        events: EventStore = Depends(get_events),
+        analytics: FleetAnalytics = Depends(get_analytics),
+        anomalies: AnomalyDetector = Depends(get_anomaly_detector),
         private_key: ECC.EccKey = Depends(get_private_key),
 ):
     """
-    For a given DID, delete the entry from the database.
+    For a given DID, delete the entry, its telemetry and event history and anomaly baselines from the database.
+    If an If-Match header is given, the entry is only deleted if it still has that version.
     """
     try:
-        verify_request(payload, private_key)
+        expected_version = parse_if_match(if_match)
+        await verify_request(payload, private_key)
     except ValueError as e:
         return error_response(400, str(e))
 
     # Search for database entry with the given DID
-    document = db.search(where("did") == did)
+    document = db.get(did)
 
     # If no entry is found, raise an HTTP exception
-    if not document:
+    if document is None:
         return error_response(404, "Entry doesn't exist.")
 
-    if determine_role(document[0], payload.did) != "bms":
+    # Authorize before taking the lock, so a DID resolution doesn't hold up other requests for the DID
+    if await determine_role(document, payload.did) != "bms":
         return error_response(403, "Access denied.")
 
-    # Delete the entry from the database
-    db.remove(where("did") == did)
+    async with did_locks.hold(did) as acquired:
+        if not acquired:
+            return error_response(409, "Entry is being modified by another request.")
+        document = db.get(did)
+        if document is None:
+            return error_response(404, "Entry doesn't exist.")
+
+        if expected_version is not None and document["version"] != expected_version:
+            return error_response(412, f"Entry has version {document['version']}, expected {expected_version}.")
+
+        # Delete the entry from the database
+        try:
+            db.remove(did, expected_version=document["version"])
+        except KeyError:
+            return error_response(404, "Entry doesn't exist.")
+        except VersionConflict:
+            return error_response(409, "Entry has been modified concurrently.")
+        projection_cache.invalidate(did)
+        timeseries.remove(did)
+        events.remove(did)
+        analytics.remove(did)
+        anomalies.remove(did)
 
     # Return a success message indicating the deletion was successful
     return {"ok": f"Entry for {did} deleted successfully."}
@@ -351,3 +1143,87 @@ def read_qr(did: DID, url: HttpUrl = Query(description="The URL for the battery
     except ValueError as e:
         return error_response(400, str(e))
     return StreamingResponse(qr_code, media_type="image/png")
+
+
+@app.post("/analytics/query",
+          summary="Get statistics of a metric over all battery passes",
+          tags=["Analytics"],
+          responses={
+              200: {"content": {"application/json": {"example": {
+                  "metric": "stateOfCertifiedEnergy",
+                  "group_by": "batteryCategory",
+                  "suppressed_groups": 1,
+                  "bin_edges": [0.0, 50.0, 100.0],
+                  "groups": [{"key": "ev", "count": 1250, "mean": 91.2, "min": 48.5, "max": 100.0,
+                              "percentiles": {"5": 78.1, "50": 92.4, "95": 99.3}, "histogram": [3, 1247]}],
+              }}}},
+              400: {"model": BadRequestResponse},
+              403: {"model": ForbiddenResponse},
+          },
+          description="A detailed description can be found "
+                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                      "/blob/main/cloud/docs/api.md#post-analyticsquery)**.",
+          openapi_extra=signed_request_body())
+async def query_analytics(
+        payload: SignedRequest = Depends(require_signed_request),
+        analytics: FleetAnalytics = Depends(get_analytics),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Compute statistics of a numeric attribute over all battery passes, optionally per value of a text attribute,
+    from the columnar fleet analytics instead of decrypting the battery passes. Only available to OEMs,
+    i.e. DIDs controlled by `did:batterypass:eu`.
+
+    The decrypted payload is a query like `{"metric": "stateOfCertifiedEnergy", "group_by": "batteryCategory",
+    "percentiles": [5, 50, 95], "bins": 10, "range": [0, 100]}`, of which only `metric` is required.
+    Groups of fewer than `ANALYTICS_MIN_GROUP_SIZE` battery passes are left out and only counted.
+    """
+    try:
+        query = parse_query(loads(await verify_request(payload, private_key)))
+    except JSONDecodeError:
+        return error_response(400, "Error occurred while decoding JSON.")
+    except ValueError as e:
+        return error_response(400, str(e))
+    if await determine_role(None, payload.did) != "oem":
+        return error_response(403, "Access denied.")
+    try:
+        # Sorting the columns takes a while for large fleets, so it doesn't run on the event loop
+        return await asyncio.to_thread(analytics.query, **query)
+    except ValueError as e:
+        return error_response(400, str(e))
+
+
+@app.post("/analytics/alerts",
+          summary="Get the latest anomaly alerts of the telemetry",
+          tags=["Analytics"],
+          responses={
+              200: {"content": {"application/json": {"example": {"alerts": [{
+                  "did": bms_example, "metric": "remainingCapacity.remainingCapacityValue", "time": 1738328789.437,
+                  "value": 61.5, "rule": "zscore", "score": 6.2, "expected": 80.1,
+              }]}}}},
+              400: {"model": BadRequestResponse},
+              403: {"model": ForbiddenResponse},
+          },
+          description="A detailed description can be found "
+                      "**[here](https://github.com/THI-CSI/decentralized_iam_battery_data"
+                      "/blob/main/cloud/docs/api.md#post-analyticsalerts)**.",
+          openapi_extra=signed_request_body())
+async def read_alerts(
+        payload: SignedRequest = Depends(require_signed_request),
+        did: DID | None = Query(default=None, description="Only return the alerts of this DID."),
+        since: datetime | None = Query(default=None, description="Only return alerts of points from this time on."),
+        anomalies: AnomalyDetector = Depends(get_anomaly_detector),
+        private_key: ECC.EccKey = Depends(get_private_key),
+):
+    """
+    Retrieve the latest alerts raised by the anomaly rules in `util/anomaly.jsonc` when updates reported
+    telemetry, oldest first. Only available to OEMs, i.e. DIDs controlled by `did:batterypass:eu`.
+    """
+    try:
+        if len(await verify_request(payload, private_key)) != 128:
+            raise ValueError("Invalid length for random value.")
+    except ValueError as e:
+        return error_response(400, str(e))
+    if await determine_role(None, payload.did) != "oem":
+        return error_response(403, "Access denied.")
+    return {"alerts": anomalies.alerts(did, since.timestamp() if since else None)}
@@ -0,0 +1,57 @@
+import os
+
+import httpx
+
+
+class BlockchainUnavailable(Exception):
+    """Raised when the blockchain can't be reached or doesn't answer in time."""
+
+
+class BlockchainClient:
+    """
+    Asynchronous client for the blockchain API.
+
+    A single instance is shared for the lifespan of the app, so requests reuse a pool of
+    keep-alive connections instead of opening a new connection per call. Every call is
+    bounded by ``BLOCKCHAIN_TIMEOUT`` seconds.
+    """
+
+    def __init__(self):
+        self._client: httpx.AsyncClient | None = None
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=os.getenv("BLOCKCHAIN_URL", "http://localhost:8443"),
+                timeout=float(os.getenv("BLOCKCHAIN_TIMEOUT", "5")),
+                limits=httpx.Limits(
+                    max_connections=int(os.getenv("BLOCKCHAIN_MAX_CONNECTIONS", "100")),
+                    max_keepalive_connections=int(os.getenv("BLOCKCHAIN_MAX_KEEPALIVE", "20")),
+                ),
+            )
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self._client is None:
+            await self.start()
+        try:
+            return await self._client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            raise BlockchainUnavailable(f"{method} {url} failed: {e!r}") from e
+
+    async def get_did(self, did: str) -> dict | None:
+        """Fetch a DID document, returns None if the DID is unknown."""
+        response = await self._request("GET", f"/api/v1/dids/{did}")
+        return response.json() if response.is_success else None
+
+    async def verify_service_vp(self, vp: dict) -> bool:
+        """Let the blockchain verify a service access Verifiable Presentation."""
+        response = await self._request("POST", "/api/v1/vps/verify/service", json=vp)
+        return response.is_success
+
+
+blockchain = BlockchainClient()
@@ -1,13 +1,26 @@
+import asyncio
 import functools
+import threading
 import pathlib
 import logging
+import re
 import base64
 import json
+import time
+from typing import Iterable, NamedTuple
+
+from cachetools import LRUCache, TTLCache
 from jwcrypto import jws, jwk
 import os
 import requests
 #from test.cloudutil import ecc_public_key_to_multibase, build_did_document, sign_did, register_key_with_blockchain, export_pem
 import cloudutil.cloudutil as cloudutil
+from crypto.blockchain import blockchain
+from crypto.executor import crypto_executor
+from util.compression import compression
+from util.lazyjson import compact, dump_object
+from util.models import DID_PATTERN
+from util.serialization import dumps
 
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
@@ -16,51 +29,124 @@ from Crypto.Protocol.DH import key_agreement
 from Crypto.Protocol.KDF import HKDF
 from Crypto.Signature import DSS
 from Crypto.PublicKey import ECC
+from Crypto.Random import get_random_bytes
 from multiformats import multibase
-from tinydb.table import Document
 
+DID_REGEX = re.compile(DID_PATTERN)
 
-def decrypt_and_verify(receiver_key: ECC.EccKey, message_bytes: bytes) -> bytes:
-    message = json.loads(message_bytes)
-    fields_to_decode = ["ciphertext", "aad", "salt", "signature", "eph_pub"]
-    decoded_message = {key: base64.b64decode(value) for key, value in message.items() if key in fields_to_decode}
-    eph_pub_der = decoded_message["eph_pub"]
-    eph_pub = ECC.import_key(eph_pub_der)
-    nonce = decoded_message["aad"]
-    ciphertext = decoded_message["ciphertext"]
-    salt = decoded_message["salt"]
-    signature = decoded_message["signature"]
-    ciphertext_data = ciphertext[:-16]
-    tag = ciphertext[-16:]
-    context = eph_pub_der + receiver_key.public_key().export_key(format="DER")
-    did = message["did"]
-
-    # Verify signature
-    sender_key = retrieve_public_key(did)
-    verifier = DSS.new(sender_key, mode="fips-186-3", encoding="binary")
-    message_to_verify = json.dumps(
-        {key: value for key, value in message.items() if key != "signature"}, separators=(",", ":")
-    ).encode()
+
+def verify_ecdsa(public_key: ECC.EccKey, message: bytes, signature: bytes) -> bool:
+    verifier = DSS.new(public_key, mode="fips-186-3", encoding="binary")
     try:
-        verifier.verify(SHA256.new(message_to_verify), signature)
+        verifier.verify(SHA256.new(message), signature)
+        return True
     except ValueError:
-        raise ValueError("Failed decryption due to invalid signature.")
+        return False
 
-    # Decrypt message
+
+async def verify_signature(did: str, message: bytes, signature: bytes) -> None:
+    """
+    Verify an ECDSA signature of a DID. If it doesn't match, the key is fetched again in case the
+    cached one is outdated, but at most once per DID and TTL of the DID cache, so that invalid
+    signatures can't force a blockchain lookup on every request.
+    """
+    public_key = await retrieve_public_key(did)
+    if await crypto_executor.run("verify", verify_ecdsa, public_key, message, signature):
+        return
+    if did_cache.refresh(did):
+        public_key = await retrieve_public_key(did)
+        if await crypto_executor.run("verify", verify_ecdsa, public_key, message, signature):
+            return
+    raise ValueError("Failed decryption due to invalid signature.")
+
+
+def open_envelope(receiver_key: ECC.EccKey, eph_pub_der: bytes, nonce: bytes, salt: bytes,
+                  ciphertext: bytes) -> bytes:
+    """Derive the AES key of a request from the ephemeral public key of the sender and decrypt it."""
+    eph_pub = ECC.import_key(eph_pub_der)
+    context = eph_pub_der + receiver_key.public_key().export_key(format="DER")
     hkdf = functools.partial(HKDF, key_len=32, hashmod=SHA256, salt=salt, context=context)
     aes_key = key_agreement(eph_pub=eph_pub, static_priv=receiver_key, kdf=hkdf)
     cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
     cipher.update(nonce)
     try:
-        plaintext = cipher.decrypt_and_verify(ciphertext_data, tag)
-        return plaintext
+        return cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:])
     except ValueError:
         raise ValueError("Failed decryption due to invalid MAC tag.")
 
 
+class SignedRequest(NamedTuple):
+    """The decoded fields of an encrypted request together with the bytes covered by its signature."""
+    did: str
+    ciphertext: bytes
+    aad: bytes
+    salt: bytes
+    eph_pub: bytes
+    signature: bytes
+    signed: bytes
+
+
+# Base64 fields of a request and the exact length of their encoding, if fixed
+SIGNED_REQUEST_FIELDS = {"ciphertext": None, "aad": 16, "salt": 44, "eph_pub": 124, "signature": None}
+
+
+def parse_signed_request(body: bytes) -> SignedRequest:
+    """
+    Parse and validate an encrypted request in a single pass over the raw body.
+
+    The signed bytes are the compact JSON object of ciphertext, aad, salt, eph_pub and did in this
+    order. Since all of them are validated to be base64 or a DID, i.e. need no escaping, they are
+    formatted directly instead of being serialized as JSON again.
+    Raises a ValueError naming the offending field.
+    """
+    try:
+        message = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError("body: Invalid JSON.")
+    if not isinstance(message, dict):
+        raise ValueError("body: Expected a JSON object.")
+    did = message.get("did")
+    if not isinstance(did, str) or not DID_REGEX.match(did):
+        raise ValueError("did: Invalid DID.")
+    decoded = {}
+    for field, length in SIGNED_REQUEST_FIELDS.items():
+        value = message.get(field)
+        if not isinstance(value, str) or (length is not None and len(value) != length):
+            raise ValueError(f"{field}: Invalid base64 string.")
+        try:
+            decoded[field] = base64.b64decode(value, validate=True)
+        except ValueError:
+            raise ValueError(f"{field}: Invalid base64 string.")
+    signed = '{"ciphertext":"%s","aad":"%s","salt":"%s","eph_pub":"%s","did":"%s"}' % (
+        message["ciphertext"], message["aad"], message["salt"], message["eph_pub"], did
+    )
+    return SignedRequest(did=did, signed=signed.encode(), **decoded)
+
+
+async def decrypt_and_verify_request(receiver_key: ECC.EccKey, request: SignedRequest) -> bytes:
+    """
+    Verify the signature of a parsed request and decrypt it. The sender's key is resolved on the
+    event loop, signature verification and decryption run on the crypto executor.
+    """
+    await verify_signature(request.did, request.signed, request.signature)
+    return await crypto_executor.run(
+        "decrypt", open_envelope, receiver_key, request.eph_pub, request.aad, request.salt, request.ciphertext
+    )
+
+
+async def decrypt_and_verify(receiver_key: ECC.EccKey, message_bytes: bytes) -> bytes:
+    return await decrypt_and_verify_request(receiver_key, parse_signed_request(message_bytes))
+
+
+def _to_bytes(value: str | bytes | memoryview) -> bytes:
+    # Stores either hold base64 strings or raw (memory-mapped) bytes
+    return base64.b64decode(value) if isinstance(value, str) else bytes(value)
+
+
 def decrypt_hpke(private_key: ECC.EccKey, bundle: dict) -> bytes:
-    enc = base64.b64decode(bundle["enc"])
-    ciphertext = base64.b64decode(bundle["ciphertext"])
+    enc = _to_bytes(bundle["enc"])
+    ciphertext = base64.b64decode(bundle["ciphertext"]) if isinstance(bundle["ciphertext"], str) \
+        else bundle["ciphertext"]
     decapsulator = HPKE.new(enc=enc, aead_id=HPKE.AEAD.AES256_GCM, receiver_key=private_key)
     return decapsulator.unseal(ciphertext)
 
@@ -75,19 +161,198 @@ def encrypt_hpke(private_key: ECC.EccKey, message: bytes) -> dict:
     }
 
 
+class DataKeyCache:
+    """
+    Bounded LRU cache of unwrapped record data keys, keyed by the wrapped key.
+
+    A hit lets a record be decrypted and re-encrypted with AES-GCM only, without the HPKE
+    decapsulation of the data key. The cache is used from the crypto executor threads and
+    therefore locked. With a process executor every worker keeps its own cache.
+    """
+
+    def __init__(self, maxsize: int):
+        self._cache: LRUCache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def unwrap(self, private_key: ECC.EccKey, bundle: dict) -> bytes:
+        wrapped_key = _to_bytes(bundle["wrapped_key"])
+        with self._lock:
+            data_key = self._cache.get(wrapped_key)
+            if data_key is not None:
+                self.hits += 1
+                return data_key
+        decapsulator = HPKE.new(enc=_to_bytes(bundle["enc"]), aead_id=HPKE.AEAD.AES256_GCM, receiver_key=private_key)
+        data_key = decapsulator.unseal(wrapped_key)
+        with self._lock:
+            self._cache[wrapped_key] = data_key
+            self.misses += 1
+        return data_key
+
+    def put(self, wrapped_key: bytes, data_key: bytes) -> None:
+        with self._lock:
+            self._cache[wrapped_key] = data_key
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "maxsize": self._cache.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+data_key_cache = DataKeyCache(maxsize=int(os.getenv("DATA_KEY_CACHE_SIZE", "10000")))
+
+
+def is_envelope(bundle: dict) -> bool:
+    return "wrapped_key" in bundle
+
+
+def is_chunked(bundle: dict) -> bool:
+    return "chunks" in bundle
+
+
+def _to_base64(value: str | bytes | memoryview) -> str:
+    return value if isinstance(value, str) else base64.b64encode(value).decode()
+
+
+def _record_key(private_key: ECC.EccKey, bundle: dict | None) -> tuple[bytes, str | bytes, str | bytes]:
+    """
+    Return the data key of a record together with its HPKE encapsulation and wrapped form.
+    If ``bundle`` is the record's current envelope its data key is reused, otherwise a new data
+    key is generated and wrapped with HPKE for the cloud key.
+    """
+    if bundle is not None and is_envelope(bundle):
+        return data_key_cache.unwrap(private_key, bundle), bundle["enc"], bundle["wrapped_key"]
+    data_key = get_random_bytes(32)
+    encapsulator = HPKE.new(receiver_key=private_key.public_key(), aead_id=HPKE.AEAD.AES256_GCM)
+    wrapped_key = encapsulator.seal(data_key)
+    data_key_cache.put(wrapped_key, data_key)
+    return data_key, encapsulator.enc, wrapped_key
+
+
+def encrypt_record(private_key: ECC.EccKey, did: str, message: bytes, bundle: dict | None = None) -> dict:
+    """
+    Compress a record and encrypt it with its AES-256-GCM data key, bound to the DID as associated data.
+
+    If ``bundle`` is the record's current envelope its data key is reused, otherwise a new data
+    key is generated and wrapped with HPKE for the cloud key.
+    """
+    data_key, enc, wrapped_key = _record_key(private_key, bundle)
+    compressed = compression.compress(message)
+    if compressed is not None:
+        message, dict_id = compressed
+    nonce = get_random_bytes(12)
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(did.encode())
+    ciphertext, tag = cipher.encrypt_and_digest(message)
+    bundle = {
+        "enc": _to_base64(enc),
+        "wrapped_key": _to_base64(wrapped_key),
+        "nonce": base64.b64encode(nonce).decode(),
+        "ciphertext": base64.b64encode(ciphertext + tag).decode(),
+    }
+    if compressed is not None:
+        bundle.update(compression="zstd", dict_id=dict_id)
+    return bundle
+
+
+def compression_matches(bundle: dict) -> bool:
+    """Whether new chunks of a record would be compressed like its existing ones."""
+    if compression.enabled:
+        return bundle.get("compression") == "zstd" and bundle.get("dict_id") == compression.dict_id
+    return "compression" not in bundle
+
+
+def encrypt_chunks(private_key: ECC.EccKey, did: str, chunks: dict[str, bytes], bundle: dict | None = None) -> dict:
+    """
+    Compress the submodels of a record and encrypt each of them as an independent chunk with the
+    record's AES-256-GCM data key, bound to the DID and the submodel name as associated data.
+
+    If ``bundle`` is the record's current envelope its data key is reused. The chunks of a chunked
+    ``bundle`` that aren't passed are kept as they are, which requires ``compression_matches(bundle)``.
+    """
+    data_key, enc, wrapped_key = _record_key(private_key, bundle)
+    encrypted = dict(bundle["chunks"]) if bundle is not None and is_chunked(bundle) else {}
+    for name, message in chunks.items():
+        compressed = compression.compress(message)
+        if compressed is not None:
+            message, _ = compressed
+        nonce = get_random_bytes(12)
+        cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(f"{did}#{name}".encode())
+        ciphertext, tag = cipher.encrypt_and_digest(message)
+        encrypted[name] = {
+            "nonce": base64.b64encode(nonce).decode(),
+            "ciphertext": base64.b64encode(ciphertext + tag).decode(),
+        }
+    bundle = {"enc": _to_base64(enc), "wrapped_key": _to_base64(wrapped_key), "chunks": encrypted}
+    if compression.enabled:
+        bundle.update(compression="zstd", dict_id=compression.dict_id)
+    return bundle
+
+
+def encrypt_document(private_key: ECC.EccKey, did: str, document: dict, bundle: dict | None = None) -> dict:
+    """Encrypt a battery pass with one chunk per submodel, see ``encrypt_chunks``."""
+    return encrypt_chunks(private_key, did, {name: dump_object(submodel) for name, submodel in document.items()}, bundle)
+
+
+def decrypt_chunks(private_key: ECC.EccKey, did: str, bundle: dict,
+                   names: Iterable[str] | None = None) -> dict[str, bytes]:
+    """Decrypt the chunks of a chunked record, only those of the submodels in ``names`` if given."""
+    data_key = data_key_cache.unwrap(private_key, bundle)
+    names = None if names is None else set(names)
+    plaintexts = {}
+    for name, chunk in bundle["chunks"].items():
+        if names is not None and name not in names:
+            continue
+        ciphertext = chunk["ciphertext"]
+        ciphertext = base64.b64decode(ciphertext) if isinstance(ciphertext, str) else ciphertext
+        cipher = AES.new(data_key, AES.MODE_GCM, nonce=_to_bytes(chunk["nonce"]))
+        cipher.update(f"{did}#{name}".encode())
+        plaintext = cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:])
+        if bundle.get("compression") == "zstd":
+            plaintext = compression.decompress(plaintext, bundle["dict_id"])
+        plaintexts[name] = plaintext
+    return plaintexts
+
+
+def decrypt_record(private_key: ECC.EccKey, did: str, bundle: dict) -> bytes:
+    """
+    Decrypt a stored record, either an envelope with a wrapped data key or a plain HPKE bundle.
+    The submodels of a chunked record are joined into the JSON document without parsing them.
+    """
+    if not is_envelope(bundle):
+        return decrypt_hpke(private_key, bundle)
+    if is_chunked(bundle):
+        chunks = decrypt_chunks(private_key, did, bundle)
+        return b"{" + b",".join(dumps(name) + b":" + compact(chunk) for name, chunk in chunks.items()) + b"}"
+    ciphertext = bundle["ciphertext"]
+    ciphertext = base64.b64decode(ciphertext) if isinstance(ciphertext, str) else ciphertext
+    cipher = AES.new(data_key_cache.unwrap(private_key, bundle), AES.MODE_GCM, nonce=_to_bytes(bundle["nonce"]))
+    cipher.update(did.encode())
+    plaintext = cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:])
+    if bundle.get("compression") == "zstd":
+        return compression.decompress(plaintext, bundle["dict_id"])
+    return plaintext
+
+
 def verify_credentials(did, info) -> ECC.EccKey:
     # TODO: Verify the credentials by checking against the DID document
     pass
 
 
-def determine_role(doc: Document | None, sender_did: str) -> str | None:
+async def determine_role(doc: dict | None, sender_did: str) -> str | None:
     if doc and doc["did"] == sender_did:
         return "bms"
-    did_response = requests.get(f"{os.getenv("BLOCKCHAIN_URL", "http://localhost:8443")}/api/v1/dids/{sender_did}")
-    if not did_response.ok:
+    resolved = await did_cache.get(sender_did)
+    if resolved is None:
         return None
-    controller = did_response.json()["verificationMethod"]["controller"]
-    return "oem" if controller == "did:batterypass:eu" else None
+    return "oem" if resolved.controller == "did:batterypass:eu" else None
 
 
 def initialize():
@@ -155,23 +420,142 @@ def register_key(public_key: ECC.EccKey):
     return response.status_code == 200
 
 
-def retrieve_public_key(did: str) -> ECC.EccKey:
-    response = requests.get(f"{os.getenv("BLOCKCHAIN_URL", "http://localhost:8443")}/api/v1/dids/{did}")
-    raw = multibase.decode(response.json()["verificationMethod"]["publicKeyMultibase"])
+class ResolvedDid(NamedTuple):
+    document: dict
+    public_key: ECC.EccKey
+    controller: str
+    revoked: bool
+
+
+def parse_public_key(public_key_multibase: str) -> ECC.EccKey:
+    raw = multibase.decode(public_key_multibase)
     if len(raw) == 67:
         raw = raw[len(b"\x12\x00"):]
         return ECC.EccKey(curve="P-256",
                           point=ECC.EccPoint(
                               int.from_bytes(raw[1:33], "big"), int.from_bytes(raw[33:65], "big"))
                           )
-    if response.json()["revoked"]:
+    return ECC.import_key(raw)
+
+
+async def resolve_did(did: str) -> ResolvedDid | None:
+    """Fetch a DID document from the blockchain, returns None if the DID is unknown."""
+    document = await blockchain.get_did(did)
+    if document is None:
+        return None
+    return ResolvedDid(
+        document=document,
+        public_key=parse_public_key(document["verificationMethod"]["publicKeyMultibase"]),
+        controller=document["verificationMethod"]["controller"],
+        revoked=document.get("revoked", False),
+    )
+
+
+class DidCache:
+    """
+    Bounded cache of resolved DID documents with a time to live.
+
+    Entries hold the DID document together with the parsed public key and the controller,
+    so a hit needs neither a blockchain round trip nor key decoding. Concurrent misses for
+    the same DID share a single lookup. Unknown DIDs aren't cached. Changes on the blockchain,
+    e.g. a revocation, become visible after at most ``ttl`` seconds or when the DID is
+    invalidated explicitly. ``refresh`` invalidates a DID at most once per ``ttl``.
+
+    The cache is only used from the event loop and therefore needs no locking.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._pending: dict[str, asyncio.Future] = {}
+        # DIDs refreshed within the last ttl seconds
+        self._refreshed: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    async def get(self, did: str) -> ResolvedDid | None:
+        start = time.perf_counter()
+        resolved = self._cache.get(did)
+        if resolved is not None:
+            self.hits += 1
+            self.hit_seconds += time.perf_counter() - start
+            return resolved
+        pending = self._pending.get(did)
+        if pending is None:
+            pending = self._pending[did] = asyncio.ensure_future(resolve_did(did))
+            pending.add_done_callback(lambda _: self._pending.pop(did, None))
+        resolved = await asyncio.shield(pending)
+        if resolved is not None:
+            self._cache[did] = resolved
+        self.misses += 1
+        self.miss_seconds += time.perf_counter() - start
+        return resolved
+
+    def invalidate(self, did: str | None = None) -> None:
+        """Drop a single DID or, if no DID is given, the whole cache."""
+        if did is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(did, None)
+
+    def refresh(self, did: str) -> bool:
+        """
+        Invalidate a DID whose cached document seems outdated, e.g. after its key failed to verify
+        a signature, unless it was already refreshed within the TTL. Returns whether it was.
+        """
+        if did in self._refreshed:
+            return False
+        self._refreshed[did] = True
+        self.invalidate(did)
+        self.refreshes += 1
+        return True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "maxsize": self._cache.maxsize,
+            "ttl": self._cache.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "avg_hit_ms": 1000 * self.hit_seconds / self.hits if self.hits else None,
+            "avg_miss_ms": 1000 * self.miss_seconds / self.misses if self.misses else None,
+        }
+
+
+did_cache = DidCache(
+    maxsize=int(os.getenv("DID_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("DID_CACHE_TTL", "60")),
+)
+
+
+async def retrieve_public_key(did: str) -> ECC.EccKey:
+    resolved = await did_cache.get(did)
+    if resolved is None:
+        raise ValueError("Unknown DID.")
+    if resolved.revoked:
         raise ValueError("Public key revoked.")
-    return ECC.import_key(multibase.decode(response.json()["verificationMethod"]["publicKeyMultibase"]))
+    return resolved.public_key
+
+
+def verify_jws(token: str, public_key: ECC.EccKey) -> bool:
+    validator = jws.JWS()
+    validator.deserialize(token)
+    try:
+        validator.verify(jwk.JWK.from_pem(public_key.export_key(format="PEM").encode()))
+        return True
+    except jws.InvalidJWSSignature:
+        return False
 
 
-def verify_vp(vp_json_object) -> str | None:
+async def verify_vp(vp_json_object) -> str | None:
     """
     This function takes a Verifiable Presentation dictionary and sends it to the Blockchain for verification.
+    The signer's key is retrieved while the Blockchain verifies the presentation.
     """
     validator = jws.JWS()
     try:
@@ -181,19 +565,17 @@ def verify_vp(vp_json_object) -> str | None:
         did = vp_json_object["proof"]["verificationMethod"].split("#")[0]
     except KeyError:
         return None
-    key = jwk.JWK.from_pem(retrieve_public_key(did).export_key(format="PEM").encode())
-    try:
-        validator.verify(key)
-    except jws.InvalidJWSSignature:
-        return None
-
-    # Then we send the Data to the Blockchain.
-    response = requests.post(
-        f"{os.getenv("BLOCKCHAIN_URL", "http://localhost:8443")}/api/v1/vps/verify/service",
-        # json=vp_json_object.model_dump(mode='json', by_alias=True)
-        json = vp_json_object
+    public_key, verified_by_blockchain = await asyncio.gather(
+        retrieve_public_key(did),
+        blockchain.verify_service_vp(vp_json_object),
+        return_exceptions=True,
     )
-    if not response.ok:
+    for result in (public_key, verified_by_blockchain):
+        if isinstance(result, BaseException) and not isinstance(result, ValueError):
+            raise result
+    if isinstance(public_key, ValueError) or verified_by_blockchain is not True:
+        return None
+    if not await crypto_executor.run("verify_vp", verify_jws, vp_json_object["proof"]["jws"], public_key):
         return None
 
     try:
@@ -202,3 +584,13 @@ def verify_vp(vp_json_object) -> str | None:
         return None
     except (KeyError, StopIteration):
         return None
+
+
+def read_grants(vp_json_object) -> set[str]:
+    """Return the BMS DIDs the credentials of a verified presentation grant read access to."""
+    return {
+        credential["credentialSubject"]["bmsDid"]
+        for credential in vp_json_object.get("verifiableCredential", [])
+        if "read" in credential.get("credentialSubject", {}).get("accessLevel", [])
+        and "bmsDid" in credential["credentialSubject"]
+    }
@@ -0,0 +1,107 @@
+import asyncio
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing.reduction import ForkingPickler
+from typing import Any, Callable
+
+from Crypto.PublicKey import ECC
+
+
+class ExecutorSaturated(Exception):
+    """Raised when too many crypto jobs are already waiting for a worker."""
+
+
+@lru_cache(maxsize=256)
+def _import_key(der: bytes) -> ECC.EccKey:
+    return ECC.import_key(der)
+
+
+def _reduce_key(key: ECC.EccKey):
+    return _import_key, (key.export_key(format="DER"),)
+
+
+def _reduce_view(view: memoryview):
+    return bytes, (view.tobytes(),)
+
+
+# Keys and memory-mapped record views can't be pickled as is, send them to worker processes as bytes
+ForkingPickler.register(ECC.EccKey, _reduce_key)
+ForkingPickler.register(memoryview, _reduce_view)
+
+
+class CryptoExecutor:
+    """
+    Pool that runs the CPU-bound crypto stages off the event loop.
+
+    ``CRYPTO_EXECUTOR`` selects a "thread" or "process" pool with ``CRYPTO_WORKERS`` workers.
+    At most ``CRYPTO_MAX_QUEUE`` jobs may be running or waiting at once, further jobs are
+    rejected with an ExecutorSaturated instead of queueing up without bound. The latency of
+    every stage is recorded including the time spent waiting for a worker.
+
+    The executor is only used from the event loop and therefore needs no locking.
+    """
+
+    def __init__(self, kind: str, workers: int, max_queue: int):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown crypto executor '{kind}'.")
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool: Executor | None = None
+        self._pending = 0
+        self.rejected = 0
+        self._stages: dict[str, list] = {}
+
+    def start(self) -> None:
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="crypto")
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    async def run(self, stage: str, fn: Callable[..., Any], *args) -> Any:
+        """Run ``fn(*args)`` on the pool and record its latency under ``stage``."""
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise ExecutorSaturated(f"{self._pending} crypto jobs pending, rejecting '{stage}'.")
+        self.start()
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self._pending -= 1
+            stats = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            elapsed = time.perf_counter() - start
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self._pending,
+            "rejected": self.rejected,
+            "stages": {
+                stage: {"count": count, "avg_ms": 1000 * total / count, "max_ms": 1000 * maximum}
+                for stage, (count, total, maximum) in self._stages.items()
+            },
+        }
+
+
+crypto_executor = CryptoExecutor(
+    kind=os.getenv("CRYPTO_EXECUTOR", "thread"),
+    workers=int(os.getenv("CRYPTO_WORKERS", str(os.cpu_count() or 1))),
+    max_queue=int(os.getenv("CRYPTO_MAX_QUEUE", "1024")),
+)
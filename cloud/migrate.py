@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Maintenance commands for the battery pass store.
+
+Usage:
+    python migrate.py import-json data/db.json [--backend sqlite]
+    python migrate.py wrap-keys [--backend sqlite]
+    python migrate.py train-dict [--backend sqlite] [--samples docs/example/batterypass.json ...]
+    python migrate.py recompress [--backend sqlite]
+    python migrate.py split-submodels [--backend sqlite]
+    python migrate.py pack-records [--backend sqlite]
+    python migrate.py trim-telemetry [--backend sqlite]
+"""
+
+import argparse
+import itertools
+import logging
+import os
+
+from pathlib import Path
+
+from crypto.crypto import decrypt_record, encrypt_document, is_chunked, is_envelope, load_private_key
+from util.compression import compression, zstandard
+from util.lazyjson import dump_object
+from util.serialization import dumps, loads
+from util.storage import JsonStore, VersionConflict, open_store
+from util.events import open_events, telemetry_events
+from util.timeseries import TELEMETRY_PATH, latest_entries, open_timeseries, telemetry_points
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def import_json(args: argparse.Namespace) -> None:
+    """Import every record of a TinyDB ``db.json`` file into the configured store in one transaction."""
+    source = JsonStore(args.source)
+    target = open_store(args.backend)
+    records = [(did, source.get(did)["encrypted_data"]) for did in source.dids()]
+    skipped = {did for did, _ in records if did in target}
+    records = [(did, data) for did, data in records if did not in skipped]
+    for did in sorted(skipped):
+        logging.warning(f"DID {did} already exists in target store, skipping")
+    target.insert_many(records)
+    source.close()
+    target.close()
+    logging.info(f"Imported {len(records)} of {len(records) + len(skipped)} records from {args.source}")
+
+
+def reencrypt(backend: str | None, needs_reencryption, description: str) -> None:
+    """Decrypt every record for which ``needs_reencryption(encrypted_data)`` holds and encrypt it again."""
+    private_key = load_private_key(os.getenv("PASSPHRASE", "secret"))
+    store = open_store(backend)
+    migrated = 0
+    for did in store.dids():
+        record = store.get(did)
+        if record is None or not needs_reencryption(record["encrypted_data"]):
+            continue
+        plaintext = decrypt_record(private_key, did, record["encrypted_data"])
+        try:
+            store.update(did, encrypt_document(private_key, did, loads(plaintext)), expected_version=record["version"])
+            migrated += 1
+        except (KeyError, VersionConflict):
+            logging.warning(f"DID {did} changed during the migration, skipping")
+    store.close()
+    logging.info(f"{description} {migrated} records")
+
+
+def wrap_keys(args: argparse.Namespace) -> None:
+    """Re-encrypt records that are still plain HPKE bundles with a wrapped per-record data key."""
+    reencrypt(args.backend, lambda encrypted_data: not is_envelope(encrypted_data),
+              "Migrated to envelope encryption:")
+
+
+def split_submodels(args: argparse.Namespace) -> None:
+    """Re-encrypt records stored as a whole with one chunk per submodel."""
+    reencrypt(args.backend, lambda encrypted_data: not is_chunked(encrypted_data),
+              "Split into submodels:")
+
+
+def recompress(args: argparse.Namespace) -> None:
+    """Re-encrypt records that aren't compressed with the newest zstd dictionary."""
+    if not compression.enabled:
+        raise SystemExit("Compression is disabled or zstandard isn't installed.")
+    reencrypt(args.backend, lambda encrypted_data: encrypted_data.get("dict_id") != compression.dict_id,
+              f"Compressed with dictionary {compression.dict_id}:")
+
+
+def pack_records(args: argparse.Namespace) -> None:
+    """Convert records stored as base64 encoded JSON into the binary record layout."""
+    store = open_store(args.backend)
+    packed = store.pack_records()
+    store.close()
+    logging.info(f"Converted {packed} records to binary records")
+
+
+def trim_telemetry(args: argparse.Namespace) -> None:
+    """
+    Move the history kept in the telemetry lists of the battery passes into the time-series and
+    event stores. The lists only keep their latest entry, of ``internalResistanceIncrease`` one
+    per component.
+    """
+    private_key = load_private_key(os.getenv("PASSPHRASE", "secret"))
+    store = open_store(args.backend)
+    timeseries = open_timeseries()
+    events = open_events()
+    trimmed = 0
+    for did in store.dids():
+        record = store.get(did)
+        if record is None:
+            continue
+        document = loads(decrypt_record(private_key, did, record["encrypted_data"]))
+        telemetry = document
+        for key in TELEMETRY_PATH:
+            telemetry = telemetry.get(key) if isinstance(telemetry, dict) else None
+        if not isinstance(telemetry, dict):
+            continue
+        history = {
+            key: value for key, value in telemetry.items()
+            if isinstance(value, list) and len(latest_entries(value)) < len(value)
+        }
+        if not history:
+            continue
+        for key, value in history.items():
+            telemetry[key] = latest_entries(value)
+        try:
+            store.update(did, encrypt_document(private_key, did, document), expected_version=record["version"])
+        except (KeyError, VersionConflict):
+            logging.warning(f"DID {did} changed during the migration, skipping")
+            continue
+        updates = [{".".join(TELEMETRY_PATH): history}]
+        timeseries.record(did, telemetry_points(updates))
+        events.record(did, telemetry_events(updates))
+        trimmed += 1
+    events.close()
+    timeseries.close()
+    store.close()
+    logging.info(f"Moved the telemetry history of {trimmed} records into {timeseries.path} and {events.path}")
+
+
+def document_samples(document: bytes) -> list[bytes]:
+    """A battery pass and each of its submodels, which are compressed one by one when it is stored."""
+    parsed = loads(document)
+    if not isinstance(parsed, dict):
+        return [document]
+    return [dumps(parsed)] + [dump_object(submodel) for submodel in parsed.values()]
+
+
+def train_dict(args: argparse.Namespace) -> None:
+    """Train a zstd dictionary on stored battery passes and sample files and report the compression ratio."""
+    if zstandard is None:
+        raise SystemExit("zstandard isn't installed.")
+    samples = []
+    for path in args.samples:
+        samples.extend(document_samples(Path(path).read_bytes()))
+    if args.max_records:
+        private_key = load_private_key(os.getenv("PASSPHRASE", "secret"))
+        store = open_store(args.backend)
+        for did in itertools.islice(store.dids(), args.max_records):
+            samples.extend(document_samples(decrypt_record(private_key, did, store.get(did)["encrypted_data"])))
+        store.close()
+    if not samples:
+        raise SystemExit("No samples to train on.")
+    try:
+        dictionary = zstandard.train_dictionary(args.size, samples)
+    except zstandard.ZstdError as e:
+        raise SystemExit(f"Training failed, try more samples or a smaller --size: {e}")
+
+    size = sum(len(sample) for sample in samples)
+    plain = zstandard.ZstdCompressor(level=compression.level)
+    trained = zstandard.ZstdCompressor(level=compression.level, dict_data=dictionary)
+    plain_size = sum(len(plain.compress(sample)) for sample in samples)
+    trained_size = sum(len(trained.compress(sample)) for sample in samples)
+    logging.info(f"{len(samples)} samples, {size} bytes: "
+                 f"ratio {size / plain_size:.2f} without and {size / trained_size:.2f} with the dictionary")
+
+    compression.dict_dir.mkdir(parents=True, exist_ok=True)
+    path = compression.dict_dir / f"{dictionary.dict_id()}.dict"
+    path.write_bytes(dictionary.as_bytes())
+    logging.info(f"Wrote dictionary {dictionary.dict_id()} to {path}, restart the API to compress with it")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Battery pass store maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import-json", help="Import an existing TinyDB db.json file")
+    import_parser.add_argument("source", help="Path to the db.json file")
+    import_parser.add_argument("--backend", default="sqlite", help="Target storage backend (default: sqlite)")
+    import_parser.set_defaults(func=import_json)
+
+    wrap_parser = subparsers.add_parser("wrap-keys", help="Migrate HPKE records to envelope encryption")
+    wrap_parser.add_argument("--backend", default=None, help="Storage backend (default: STORAGE_BACKEND)")
+    wrap_parser.set_defaults(func=wrap_keys)
+
+    train_parser = subparsers.add_parser("train-dict", help="Train a zstd dictionary on battery passes")
+    train_parser.add_argument("--backend", default=None, help="Storage backend (default: STORAGE_BACKEND)")
+    train_parser.add_argument("--samples", nargs="*", default=[], help="Battery pass JSON files to train on")
+    train_parser.add_argument("--max-records", type=int, default=1000,
+                              help="Maximum number of stored battery passes to train on (default: 1000)")
+    train_parser.add_argument("--size", type=int, default=16384, help="Dictionary size in bytes (default: 16384)")
+    train_parser.set_defaults(func=train_dict)
+
+    recompress_parser = subparsers.add_parser("recompress", help="Compress records with the newest dictionary")
+    recompress_parser.add_argument("--backend", default=None, help="Storage backend (default: STORAGE_BACKEND)")
+    recompress_parser.set_defaults(func=recompress)
+
+    split_parser = subparsers.add_parser("split-submodels", help="Encrypt records with one chunk per submodel")
+    split_parser.add_argument("--backend", default=None, help="Storage backend (default: STORAGE_BACKEND)")
+    split_parser.set_defaults(func=split_submodels)
+
+    pack_parser = subparsers.add_parser("pack-records", help="Convert records to the binary record layout")
+    pack_parser.add_argument("--backend", default=None, help="Storage backend (default: STORAGE_BACKEND)")
+    pack_parser.set_defaults(func=pack_records)
+
+    trim_parser = subparsers.add_parser("trim-telemetry", help="Move telemetry lists into the time-series and event stores")
+    trim_parser.add_argument("--backend", default=None, help="Storage backend (default: STORAGE_BACKEND)")
+    trim_parser.set_defaults(func=trim_telemetry)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
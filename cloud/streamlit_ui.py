@@ -76,19 +76,25 @@ def render_top_level(data):
             render_item(value)
 
 
-# Function to fetch all DIDs
+# Function to fetch all DIDs page by page
 def list_all_dids():
     url = f"{API_BASE_URL}/batterypass/"
+    dids = []
+    params = {"limit": 1000}
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"Error: {response.status_code}, {response.text}")
-            return []
+        while True:
+            response = requests.get(url, params=params)
+            if response.status_code != 200:
+                st.error(f"Error: {response.status_code}, {response.text}")
+                return dids
+            page = response.json()
+            dids.extend(page["dids"])
+            if not page["next_cursor"]:
+                return dids
+            params["cursor"] = page["next_cursor"]
     except Exception as e:
         st.error(f"Could not connect to the API: {e}")
-        return []
+        return dids
 
 
 # Function to fetch data for a specific DID
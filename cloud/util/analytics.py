@@ -0,0 +1,426 @@
+import base64
+import hashlib
+import logging
+import os
+import threading
+
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from util.locks import lock_exclusively
+
+# Numeric attributes kept as columns, by the name they are queried with
+METRICS: dict[str, tuple[str, ...]] = {
+    "stateOfCertifiedEnergy": ("performance", "batteryCondition", "stateOfCertifiedEnergy",
+                               "stateOfCertifiedEnergyValue"),
+    "remainingCapacity": ("performance", "batteryCondition", "remainingCapacity", "remainingCapacityValue"),
+    "capacityFade": ("performance", "batteryCondition", "capacityFade", "capacityFadeValue"),
+    "numberOfFullCycles": ("performance", "batteryCondition", "numberOfFullCycles", "numberOfFullCyclesValue"),
+    "ratedCapacity": ("performance", "batteryTechicalProperties", "ratedCapacity"),
+    "expectedNumberOfCycles": ("performance", "batteryTechicalProperties", "expectedNumberOfCycles"),
+    "batteryMass": ("generalProductInformation", "batteryMass"),
+    "batteryCarbonFootprint": ("carbonFootprint", "batteryCarbonFootprint"),
+    "absoluteCarbonFootprint": ("carbonFootprint", "absoluteCarbonFootprint"),
+}
+# Text attributes the metrics can be grouped by
+DIMENSIONS: dict[str, tuple[str, ...]] = {
+    "batteryCategory": ("generalProductInformation", "batteryCategory"),
+    "batteryStatus": ("generalProductInformation", "batteryStatus"),
+    "manufacturer": ("generalProductInformation", "manufacturerInformation", "identifier"),
+    "manufacturingCountry": ("generalProductInformation", "manufacturingPlace", "addressCountry"),
+}
+COLUMN_PATHS = tuple(METRICS.values()) + tuple(DIMENSIONS.values())
+
+_METRIC_INDEX = {name: index for index, name in enumerate(METRICS)}
+_DIMENSION_INDEX = {name: index for index, name in enumerate(DIMENSIONS)}
+
+
+def _lookup(document: Any, path: tuple[str, ...]) -> Any:
+    for key in path:
+        if not isinstance(document, dict) or key not in document:
+            return None
+        document = document[key]
+    return document
+
+
+def _as_number(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return np.nan
+    return float(value)
+
+
+def _enc_digest(enc: str | bytes) -> int:
+    """A 64-bit digest of the encapsulated key of a record, base64 encoded or raw like the stores hold it."""
+    raw = base64.b64decode(enc) if isinstance(enc, str) else bytes(enc)
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "big", signed=True)
+
+
+def _updated_value(updates: list, path: tuple[str, ...]) -> tuple[bool, Any]:
+    """Whether a list of ``{"path.to.key": value}`` updates sets the attribute at a path, and its new value."""
+    found, result = False, None
+    for element in updates:
+        for key, value in element.items():
+            keys = tuple(key.split("."))
+            if path[:len(keys)] == keys:
+                found, result = True, _lookup(value, path[len(keys):])
+    return found, result
+
+
+class FleetAnalytics:
+    """
+    Columnar cache of selected attributes of all battery passes for fleet-wide statistics.
+
+    Every battery pass is a row, its ``METRICS`` are stored in one float64 array per metric
+    (NaN if missing) and its ``DIMENSIONS`` as integer codes into one list of distinct values per
+    dimension (-1 if missing). Creates and updates change single rows, so queries never decrypt
+    battery passes. A query groups a metric by a dimension with one sort and computes counts,
+    means, extremes, percentiles and histograms of all groups with vectorized numpy operations.
+
+    Each row remembers the tag of the record it was read from, i.e. its version and a digest of
+    its encapsulated key like ``api.record_tag``, so a record that has been deleted and created
+    again is told apart from the old one. The cache is saved to ``path`` every
+    ``snapshot_interval`` seconds if it has changed and on close. Rows whose record has changed
+    since, e.g. after a crash, are read again by ``api.reconcile_analytics`` on startup. Only one
+    process can open the cache, it holds an exclusive lock on ``<path>.lock`` while it's open.
+    """
+
+    def __init__(self, path: str | os.PathLike, min_group_size: int = 5, snapshot_interval: float = 300.0):
+        self.path = Path(path)
+        self._process_lock = lock_exclusively(self.path.with_suffix(self.path.suffix + ".lock"))
+        self.min_group_size = min_group_size
+        self._lock = threading.Lock()
+        self._rows: dict[str, int] = {}
+        self._free: list[int] = []
+        self._size = 0
+        self._dirty = False
+        self._allocate(1024)
+        self._load()
+        self._closed = threading.Event()
+        self._snapshotter = threading.Thread(
+            target=self._snapshot_loop, args=(snapshot_interval,), name="analytics-snapshots", daemon=True
+        )
+        self._snapshotter.start()
+
+    def _allocate(self, capacity: int) -> None:
+        self._dids = np.full(capacity, "", dtype=object)
+        self._versions = np.zeros(capacity, dtype=np.int64)
+        self._encs = np.zeros(capacity, dtype=np.int64)
+        self._live = np.zeros(capacity, dtype=bool)
+        self._metrics = np.full((len(METRICS), capacity), np.nan)
+        self._codes = np.full((len(DIMENSIONS), capacity), -1, dtype=np.int32)
+        self._categories: list[list[str]] = [[] for _ in DIMENSIONS]
+        self._category_codes: list[dict[str, int]] = [{} for _ in DIMENSIONS]
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self._live)
+        self._dids = np.concatenate([self._dids, np.full(capacity - len(self._dids), "", dtype=object)])
+        self._versions = np.concatenate([self._versions, np.zeros(capacity - len(self._versions), dtype=np.int64)])
+        self._encs = np.concatenate([self._encs, np.zeros(capacity - len(self._encs), dtype=np.int64)])
+        self._live = np.concatenate([self._live, np.zeros(capacity - len(self._live), dtype=bool)])
+        self._metrics = np.concatenate([self._metrics, np.full_like(self._metrics, np.nan)], axis=1)
+        self._codes = np.concatenate([self._codes, np.full_like(self._codes, -1)], axis=1)
+
+    def _load(self) -> None:
+        if not self.path.is_file():
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as snapshot:
+                if (list(snapshot["metric_names"]) != list(METRICS)
+                        or list(snapshot["dimension_names"]) != list(DIMENSIONS)):
+                    logging.info(f"Columns of {self.path} have changed, rebuilding the fleet analytics")
+                    return
+                dids = snapshot["dids"].tolist()
+                size = len(dids)
+                while len(self._live) < size:
+                    self._grow()
+                self._dids[:size] = dids
+                self._versions[:size] = snapshot["versions"]
+                self._encs[:size] = snapshot["encs"]
+                self._live[:size] = True
+                self._metrics[:, :size] = snapshot["metrics"]
+                self._codes[:, :size] = snapshot["codes"]
+                for dimension in range(len(DIMENSIONS)):
+                    self._categories[dimension] = snapshot[f"categories_{dimension}"].tolist()
+                    self._category_codes[dimension] = {
+                        value: code for code, value in enumerate(self._categories[dimension])
+                    }
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Can't load the fleet analytics from {self.path}, rebuilding them: {e}")
+            self._allocate(1024)
+            return
+        self._rows = {did: row for row, did in enumerate(dids)}
+        self._size = size
+
+    def save(self) -> None:
+        """Write the live rows to ``path``."""
+        with self._lock:
+            live = np.flatnonzero(self._live[:self._size])
+            columns = {
+                "metric_names": np.array(list(METRICS)),
+                "dimension_names": np.array(list(DIMENSIONS)),
+                "dids": np.array(self._dids[live].tolist(), dtype=str),
+                "versions": self._versions[live],
+                "encs": self._encs[live],
+                "metrics": self._metrics[:, live],
+                "codes": self._codes[:, live],
+            }
+            for dimension, categories in enumerate(self._categories):
+                columns[f"categories_{dimension}"] = np.array(categories, dtype=str)
+            self._dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp.npz")
+        np.savez(tmp_path, **columns)
+        os.replace(tmp_path, self.path)
+
+    def _snapshot_loop(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    logging.error(f"Failed to save the fleet analytics: {e}")
+
+    def _code(self, dimension: int, value: Any) -> int:
+        if not isinstance(value, str):
+            return -1
+        code = self._category_codes[dimension].get(value)
+        if code is None:
+            code = self._category_codes[dimension][value] = len(self._categories[dimension])
+            self._categories[dimension].append(value)
+        return code
+
+    def _row(self, did: str) -> int:
+        """The row of a DID, allocating one if it has none. Must be called with the lock held."""
+        row = self._rows.get(did)
+        if row is not None:
+            return row
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self._size == len(self._live):
+                self._grow()
+            row = self._size
+            self._size += 1
+        self._rows[did] = row
+        self._dids[row] = did
+        self._live[row] = True
+        self._metrics[:, row] = np.nan
+        self._codes[:, row] = -1
+        return row
+
+    def put(self, did: str, tag: tuple[int, str | bytes], document: dict) -> None:
+        """Set the row of a battery pass from its parsed document and the ``(version, enc)`` tag of its record."""
+        with self._lock:
+            row = self._row(did)
+            self._versions[row] = tag[0]
+            self._encs[row] = _enc_digest(tag[1])
+            self._dirty = True
+            for index, path in enumerate(METRICS.values()):
+                self._metrics[index, row] = _as_number(_lookup(document, path))
+            for index, path in enumerate(DIMENSIONS.values()):
+                self._codes[index, row] = self._code(index, _lookup(document, path))
+
+    def update(self, did: str, previous_tag: tuple[int, str | bytes], tag: tuple[int, str | bytes],
+               updates: list) -> bool:
+        """
+        Apply a list of ``{"path.to.key": value}`` updates to the row of a battery pass, if the row
+        was read from the record tagged ``previous_tag``. Returns False if it wasn't, the row then
+        has to be set with ``put``.
+        """
+        with self._lock:
+            row = self._rows.get(did)
+            if row is None or not self._is_current(row, previous_tag):
+                return False
+            self._versions[row] = tag[0]
+            self._encs[row] = _enc_digest(tag[1])
+            self._dirty = True
+            for index, path in enumerate(METRICS.values()):
+                found, value = _updated_value(updates, path)
+                if found:
+                    self._metrics[index, row] = _as_number(value)
+            for index, path in enumerate(DIMENSIONS.values()):
+                found, value = _updated_value(updates, path)
+                if found:
+                    self._codes[index, row] = self._code(index, value)
+            return True
+
+    def remove(self, did: str) -> None:
+        with self._lock:
+            row = self._rows.pop(did, None)
+            if row is None:
+                return
+            self._live[row] = False
+            self._dids[row] = ""
+            self._free.append(row)
+            self._dirty = True
+
+    def _is_current(self, row: int, tag: tuple[int, str | bytes]) -> bool:
+        return self._versions[row] == tag[0] and self._encs[row] == _enc_digest(tag[1])
+
+    def is_current(self, did: str, tag: tuple[int, str | bytes]) -> bool:
+        """Whether the row of a battery pass has been read from the record tagged ``tag``."""
+        with self._lock:
+            row = self._rows.get(did)
+            return row is not None and self._is_current(row, tag)
+
+    def dids(self) -> list[str]:
+        with self._lock:
+            return list(self._rows)
+
+    def query(self, metric: str, group_by: str | None = None, percentiles: list[float] = (),
+              bins: int | None = None, value_range: tuple[float, float] | None = None) -> dict:
+        """
+        Statistics of a metric over all battery passes having it, per value of the dimension
+        ``group_by`` if given. Groups of fewer than ``min_group_size`` battery passes are left out,
+        so that no statistic reveals the data of single battery passes. Raises a ValueError for an
+        unknown metric or dimension and invalid percentiles or histogram bins.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {', '.join(METRICS)}.")
+        if group_by is not None and group_by not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension '{group_by}', expected one of {', '.join(DIMENSIONS)}.")
+        quantiles = np.asarray(percentiles, dtype=float) / 100
+        if np.any((quantiles < 0) | (quantiles > 1)):
+            raise ValueError("Percentiles must be between 0 and 100.")
+        if bins is not None and not 1 <= bins <= 1000:
+            raise ValueError("The number of histogram bins must be between 1 and 1000.")
+
+        with self._lock:
+            size = self._size
+            values = self._metrics[_METRIC_INDEX[metric], :size]
+            if group_by is None:
+                codes = np.zeros(size, dtype=np.int32)
+                names = None
+            else:
+                codes = self._codes[_DIMENSION_INDEX[group_by], :size]
+                names = list(self._categories[_DIMENSION_INDEX[group_by]])
+            # Boolean indexing copies, so the computation below doesn't need the lock
+            selected = self._live[:size] & ~np.isnan(values) & (codes >= 0)
+            values = values[selected]
+            codes = codes[selected]
+
+        # Sort by group, then by value, so each group is a contiguous sorted run
+        order = np.lexsort((values, codes))
+        values = values[order]
+        codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(values) else np.zeros(0, dtype=np.intp)
+        counts = np.diff(np.r_[starts, len(values)])
+        kept = counts >= self.min_group_size
+        # Placeholder values of the schema like 1.8e308 overflow the sums, their means are then infinite
+        with np.errstate(over="ignore"):
+            sums = np.add.reduceat(values, starts)[kept] if len(values) else np.zeros(0)
+        starts, counts = starts[kept], counts[kept]
+        ends = starts + counts - 1
+
+        # Interpolated percentiles of all groups at once, one column per percentile
+        positions = starts[:, None] + quantiles[None, :] * (counts - 1)[:, None]
+        lower = np.floor(positions).astype(np.intp)
+        upper = np.ceil(positions).astype(np.intp)
+        percentile_values = values[lower] + (values[upper] - values[lower]) * (positions - lower)
+
+        result = {
+            "metric": metric,
+            "group_by": group_by,
+            "suppressed_groups": int(np.count_nonzero(~kept)),
+        }
+        histograms = None
+        if bins is not None:
+            members = np.repeat(starts, counts) + _ranks(counts)
+            member_values = values[members]
+            if value_range is None:
+                low, high = (float(member_values.min()), float(member_values.max())) if len(members) else (0.0, 1.0)
+                if low == high:
+                    low, high = low - 0.5, high + 0.5
+            else:
+                low, high = (float(bound) for bound in value_range)
+                if not (np.isfinite(low) and np.isfinite(high) and low < high):
+                    raise ValueError("The histogram range must be two finite numbers in ascending order.")
+            group_index = np.repeat(np.arange(len(counts)), counts)
+            inside = (member_values >= low) & (member_values <= high)
+            bin_index = np.minimum(((member_values[inside] - low) / (high - low) * bins).astype(np.intp), bins - 1)
+            histograms = np.bincount(group_index[inside] * bins + bin_index,
+                                     minlength=len(counts) * bins).reshape(len(counts), bins)
+            result["bin_edges"] = np.linspace(low, high, bins + 1).tolist()
+
+        groups = []
+        for index in range(len(counts)):
+            group = {
+                "key": names[codes[starts[index]]] if names is not None else None,
+                "count": int(counts[index]),
+                "mean": float(sums[index] / counts[index]),
+                "min": float(values[starts[index]]),
+                "max": float(values[ends[index]]),
+            }
+            if len(quantiles):
+                group["percentiles"] = {
+                    f"{percentile:g}": float(value)
+                    for percentile, value in zip(percentiles, percentile_values[index])
+                }
+            if histograms is not None:
+                group["histogram"] = histograms[index].tolist()
+            groups.append(group)
+        result["groups"] = groups
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "battery_passes": len(self._rows),
+                "rows": self._size,
+                "bytes": int(self._metrics[:, :self._size].nbytes + self._codes[:, :self._size].nbytes),
+            }
+
+    def close(self) -> None:
+        self._closed.set()
+        self._snapshotter.join()
+        self.save()
+        self._process_lock.close()
+
+
+def _ranks(counts: np.ndarray) -> np.ndarray:
+    """The position of each member within its group, for groups of the given sizes laid out one after another."""
+    if not len(counts):
+        return np.zeros(0, dtype=np.intp)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(int(counts.sum())) - offsets
+
+
+def parse_query(query: Any) -> dict:
+    """
+    Check a JSON query like ``{"metric": ..., "group_by": ..., "percentiles": [...], "bins": ..., "range": [...]}``
+    and return the keyword arguments of ``FleetAnalytics.query``, raises a ValueError if it's malformed.
+    """
+    if not isinstance(query, dict) or not isinstance(query.get("metric"), str):
+        raise ValueError("The query must be an object with a metric.")
+    unknown = query.keys() - {"metric", "group_by", "percentiles", "bins", "range"}
+    if unknown:
+        raise ValueError(f"Unknown query parameters: {', '.join(sorted(unknown))}.")
+
+    def is_number(value: Any) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    group_by = query.get("group_by")
+    percentiles = query.get("percentiles", [])
+    bins = query.get("bins")
+    value_range = query.get("range")
+    if group_by is not None and not isinstance(group_by, str):
+        raise ValueError("group_by must be the name of a dimension.")
+    if not isinstance(percentiles, list) or len(percentiles) > 100 or not all(map(is_number, percentiles)):
+        raise ValueError("percentiles must be a list of at most 100 numbers.")
+    if bins is not None and (not isinstance(bins, int) or isinstance(bins, bool)):
+        raise ValueError("bins must be an integer.")
+    if value_range is not None and (bins is None or not isinstance(value_range, list) or len(value_range) != 2
+                                    or not all(map(is_number, value_range))):
+        raise ValueError("range must be a list of two numbers and requires bins.")
+    return {"metric": query["metric"], "group_by": group_by, "percentiles": percentiles, "bins": bins,
+            "value_range": tuple(value_range) if value_range is not None else None}
+
+
+def open_analytics() -> FleetAnalytics:
+    return FleetAnalytics(
+        os.getenv("ANALYTICS_PATH", "data/analytics.npz"),
+        min_group_size=int(os.getenv("ANALYTICS_MIN_GROUP_SIZE", "5")),
+        snapshot_interval=float(os.getenv("ANALYTICS_SNAPSHOT_INTERVAL", "300")),
+    )
@@ -0,0 +1,299 @@
+import logging
+import math
+import os
+import threading
+import time
+
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import NamedTuple
+
+import json5
+import numpy as np
+
+from util.locks import lock_exclusively
+from util.timeseries import Point
+
+RULES_PATH = Path(__file__).parent / "anomaly.jsonc"
+
+_RULE_OPTIONS = {"alpha", "min_samples", "zscore", "ewma_zscore", "max_jump", "min", "max"}
+# Number of metrics whose resolved rule is cached
+_MAX_RESOLVED = 1024
+
+
+class Rule(NamedTuple):
+    alpha: float = 0.1
+    min_samples: int = 10
+    zscore: float | None = None
+    ewma_zscore: float | None = None
+    max_jump: float | None = None
+    min: float | None = None
+    max: float | None = None
+
+
+def parse_rules(config: dict) -> dict[str, Rule]:
+    """Compile the rules of an ``anomaly.jsonc``, raises a ValueError if they are malformed."""
+    defaults = config.get("defaults", {})
+    rules = {}
+    for metric, options in config.get("rules", {}).items():
+        options = {**defaults, **options}
+        unknown = options.keys() - _RULE_OPTIONS
+        if unknown:
+            raise ValueError(f"Unknown options of the rule '{metric}': {', '.join(sorted(unknown))}.")
+        rules[metric] = Rule(**options)
+        if not 0 < rules[metric].alpha <= 1:
+            raise ValueError(f"The alpha of the rule '{metric}' must be in (0, 1].")
+    return rules
+
+
+class MetricState:
+    """Running statistics of a metric of a DID, a fixed number of floats no matter how many values it has seen."""
+    __slots__ = ("count", "mean", "m2", "ewma", "ewvar", "last", "last_time")
+
+    FIELDS = __slots__
+
+    def __init__(self, count=0.0, mean=0.0, m2=0.0, ewma=0.0, ewvar=0.0, last=0.0, last_time=-math.inf):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.ewma = ewma
+        self.ewvar = ewvar
+        self.last = last
+        self.last_time = last_time
+
+    def add(self, value: float, alpha: float) -> None:
+        self.count += 1
+        if self.count == 1:
+            self.mean = self.ewma = value
+        else:
+            # Welford's update of the mean and the sum of squared deviations
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+            # Exponentially weighted mean and variance
+            delta = value - self.ewma
+            increment = alpha * delta
+            self.ewma += increment
+            self.ewvar = (1 - alpha) * (self.ewvar + delta * increment)
+        self.last = value
+
+
+class AnomalyDetector:
+    """
+    Online anomaly detection of the telemetry of battery passes.
+
+    Every metric of a DID that has a rule in ``anomaly.jsonc`` keeps a ``MetricState``: its
+    count, mean and variance over all values (Welford) and its exponentially weighted mean and
+    variance. Each new value is checked against the statistics before it and then added to them,
+    so an update costs a few float operations per value. Alerts are logged and the latest
+    ``max_alerts`` are kept for ``alerts``.
+
+    The rules file is checked for changes at most every ``check_interval`` seconds, like
+    ``attributes.jsonc``. The statistics are saved to ``path`` every ``snapshot_interval`` seconds
+    if they have changed and on close, and are loaded on startup, so the baselines survive restarts.
+    Only one process can open the detector, it holds an exclusive lock on ``<path>.lock`` while it's open.
+    """
+
+    def __init__(
+            self,
+            path: str | os.PathLike,
+            rules_path: str | os.PathLike = RULES_PATH,
+            max_alerts: int = 1000,
+            snapshot_interval: float = 300.0,
+            check_interval: float = 1.0,
+    ):
+        self.path = Path(path)
+        self._process_lock = lock_exclusively(self.path.with_suffix(self.path.suffix + ".lock"))
+        self.rules_path = Path(rules_path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # Statistics per DID and metric
+        self._states: dict[str, dict[str, MetricState]] = {}
+        self._alerts: deque[dict] = deque(maxlen=max_alerts)
+        self._raised = 0
+        self._dirty = False
+        # Modification time of the rules file, its rules and the rule the latest metrics resolved to
+        self._rules: tuple[int, dict[str, Rule]] = (0, {})
+        self._resolved: OrderedDict[str, Rule] = OrderedDict()
+        self._next_check = 0.0
+        self._load_rules()
+        self._load()
+        self._closed = threading.Event()
+        self._snapshotter = threading.Thread(
+            target=self._snapshot_loop, args=(snapshot_interval,), name="anomaly-snapshots", daemon=True
+        )
+        self._snapshotter.start()
+
+    def _load_rules(self) -> None:
+        """
+        Reload the rules if the file has changed, keeping the previous ones if it can't be parsed.
+        Must be called with the lock held.
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        mtime = self._rules[0]
+        try:
+            mtime = self.rules_path.stat().st_mtime_ns
+            if mtime != self._rules[0]:
+                with open(self.rules_path) as f:
+                    self._rules = mtime, parse_rules(json5.load(f))
+                self._resolved.clear()
+                logging.info(f"Loaded anomaly rules from {self.rules_path}")
+        except (OSError, ValueError, TypeError) as e:
+            logging.error(f"Failed to load {self.rules_path}, keeping the previous anomaly rules: {e}")
+            # Don't retry until the file changes again
+            self._rules = mtime, self._rules[1]
+
+    def _rule(self, metric: str) -> Rule | None:
+        """
+        The rule of the metric or of the closest metric above it. Only metrics that have a rule
+        are cached, at most ``_MAX_RESOLVED`` of them, dropping the least recently used.
+        """
+        rule = self._resolved.get(metric)
+        if rule is not None:
+            self._resolved.move_to_end(metric)
+            return rule
+        rules = self._rules[1]
+        rule = rules.get(metric)
+        prefix = metric
+        while rule is None and "." in prefix:
+            prefix = prefix.rsplit(".", 1)[0]
+            rule = rules.get(prefix)
+        if rule is not None:
+            self._resolved[metric] = rule
+            if len(self._resolved) > _MAX_RESOLVED:
+                self._resolved.popitem(last=False)
+        return rule
+
+    def _load(self) -> None:
+        if not self.path.is_file():
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as snapshot:
+                if list(snapshot["fields"]) != list(MetricState.FIELDS):
+                    logging.info(f"Fields of {self.path} have changed, resetting the anomaly baselines")
+                    return
+                for did, metric, values in zip(snapshot["dids"].tolist(), snapshot["metrics"].tolist(),
+                                               snapshot["values"].tolist()):
+                    self._states.setdefault(did, {})[metric] = MetricState(*values)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Can't load the anomaly baselines from {self.path}, resetting them: {e}")
+
+    def save(self) -> None:
+        """Write the statistics of all metrics to ``path``."""
+        with self._lock:
+            keys = [(did, metric) for did, metrics in self._states.items() for metric in metrics]
+            values = [[getattr(self._states[did][metric], field) for field in MetricState.FIELDS] for did, metric in keys]
+            self._dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            fields=np.array(MetricState.FIELDS),
+            dids=np.array([did for did, _ in keys], dtype=str),
+            metrics=np.array([metric for _, metric in keys], dtype=str),
+            values=np.array(values, dtype=float).reshape(len(values), len(MetricState.FIELDS)),
+        )
+        os.replace(tmp_path, self.path)
+
+    def _snapshot_loop(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    logging.error(f"Failed to save the anomaly baselines: {e}")
+
+    def observe(self, did: str, points: list[Point]) -> list[dict]:
+        """Check new telemetry points of a DID against its statistics, add them and return the alerts raised."""
+        alerts = []
+        with self._lock:
+            self._load_rules()
+            metrics = None
+            for metric, timestamp, value in points:
+                rule = self._rule(metric)
+                if rule is None:
+                    continue
+                if metrics is None:
+                    metrics = self._states.setdefault(did, {})
+                state = metrics.get(metric)
+                if state is None:
+                    state = metrics[metric] = MetricState()
+                elif timestamp < state.last_time:
+                    # Points older than the latest one, e.g. a retransmission, don't count again
+                    continue
+                alerts += self._check(did, metric, timestamp, value, rule, state)
+                state.add(value, rule.alpha)
+                state.last_time = timestamp
+                self._dirty = True
+            self._alerts.extend(alerts)
+            self._raised += len(alerts)
+        for alert in alerts:
+            logging.warning(f"Anomaly of {alert['metric']} of {did}: {alert['rule']} {alert['score']:.3g}, "
+                            f"value {alert['value']:.6g}, expected {alert['expected']:.6g}")
+        return alerts
+
+    @staticmethod
+    def _check(did: str, metric: str, timestamp: float, value: float, rule: Rule, state: MetricState) -> list[dict]:
+        triggered = []
+        if rule.min is not None and value < rule.min:
+            triggered.append(("min", rule.min - value, rule.min))
+        if rule.max is not None and value > rule.max:
+            triggered.append(("max", value - rule.max, rule.max))
+        if state.count and rule.max_jump is not None and abs(value - state.last) > rule.max_jump:
+            triggered.append(("max_jump", abs(value - state.last), state.last))
+        if state.count >= max(rule.min_samples, 2):
+            # Without any variance so far a deviation can't be scored
+            if rule.zscore is not None and state.m2 > 0:
+                score = abs(value - state.mean) / math.sqrt(state.m2 / (state.count - 1))
+                if score > rule.zscore:
+                    triggered.append(("zscore", score, state.mean))
+            if rule.ewma_zscore is not None and state.ewvar > 0:
+                score = abs(value - state.ewma) / math.sqrt(state.ewvar)
+                if score > rule.ewma_zscore:
+                    triggered.append(("ewma_zscore", score, state.ewma))
+        return [
+            {"did": did, "metric": metric, "time": timestamp, "value": value, "rule": name, "score": score,
+             "expected": expected}
+            for name, score, expected in triggered
+        ]
+
+    def alerts(self, did: str | None = None, since: float | None = None) -> list[dict]:
+        """The latest alerts, of a single DID and from a time on if given, oldest first."""
+        with self._lock:
+            return [
+                alert for alert in self._alerts
+                if (did is None or alert["did"] == did) and (since is None or alert["time"] >= since)
+            ]
+
+    def remove(self, did: str) -> None:
+        with self._lock:
+            if self._states.pop(did, None) is not None:
+                self._dirty = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "dids": len(self._states),
+                "series": sum(len(metrics) for metrics in self._states.values()),
+                "rules": len(self._rules[1]),
+                "alerts": self._raised,
+            }
+
+    def close(self) -> None:
+        self._closed.set()
+        self._snapshotter.join()
+        self.save()
+        self._process_lock.close()
+
+
+def open_anomaly_detector() -> AnomalyDetector:
+    """Open the anomaly detector configured by the ``ANOMALY_*`` environment variables."""
+    return AnomalyDetector(
+        os.getenv("ANOMALY_STATE_PATH", "data/anomaly.npz"),
+        os.getenv("ANOMALY_RULES_PATH", RULES_PATH),
+        max_alerts=int(os.getenv("ANOMALY_MAX_ALERTS", "1000")),
+        snapshot_interval=float(os.getenv("ANOMALY_SNAPSHOT_INTERVAL", "300")),
+    )
@@ -0,0 +1,87 @@
+import os
+
+from collections import OrderedDict
+from typing import Hashable
+
+
+class ProjectionCache:
+    """
+    LRU cache of rendered battery pass projections, e.g. the public view of a battery pass.
+
+    Entries are keyed by DID and scope and hold the JSON body together with a tag of the record
+    it was rendered from, e.g. its version, so a lookup for any other tag misses. The cache is
+    bounded by the total size of the bodies and holds at most ``max_scopes_per_did`` scopes of a
+    DID, e.g. projections restricted to different fields, dropping the least recently used of them.
+    It is only used from the event loop and therefore needs no locking.
+    """
+
+    def __init__(self, max_bytes: int, max_scopes_per_did: int = 8):
+        self.max_bytes = max_bytes
+        self.max_scopes_per_did = max_scopes_per_did
+        self._entries: OrderedDict[tuple[str, str], tuple[Hashable, bytes]] = OrderedDict()
+        # The cached scopes of each DID, least recently used first
+        self._scopes: dict[str, OrderedDict[str, None]] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, did: str, scope: str, tag: Hashable) -> bytes | None:
+        entry = self._entries.get((did, scope))
+        if entry is None or entry[0] != tag:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((did, scope))
+        self._scopes[did].move_to_end(scope)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, did: str, scope: str, tag: Hashable, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        self._discard((did, scope))
+        scopes = self._scopes.setdefault(did, OrderedDict())
+        while len(scopes) >= self.max_scopes_per_did:
+            self._discard((did, next(iter(scopes))))
+        self._entries[(did, scope)] = (tag, body)
+        scopes[scope] = None
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry[1])
+        did, scope = key
+        scopes = self._scopes[did]
+        del scopes[scope]
+        if not scopes:
+            del self._scopes[did]
+
+    def invalidate(self, did: str) -> None:
+        """Drop all projections of a DID, called whenever the record is changed or deleted."""
+        for scope in list(self._scopes.get(did, ())):
+            self._discard((did, scope))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._scopes.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+projection_cache = ProjectionCache(
+    max_bytes=int(os.getenv("PROJECTION_CACHE_BYTES", str(64 << 20))),
+    max_scopes_per_did=int(os.getenv("PROJECTION_CACHE_SCOPES_PER_DID", "8")),
+)
@@ -0,0 +1,90 @@
+import os
+import threading
+
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Compression:
+    """
+    zstd compression of battery pass plaintext before it's encrypted.
+
+    Battery passes share most of their keys and a lot of their values, so they compress far better
+    with a dictionary trained on battery passes (see ``migrate.py train-dict``). Dictionaries are
+    read from ``dict_dir`` on startup, the newest one is used for compressing while all of them are
+    kept for decompressing records compressed with older ones. Records are compressed without a
+    dictionary (id 0) if there is none.
+
+    zstd contexts aren't thread-safe, so every thread gets its own.
+    """
+
+    def __init__(self, dict_dir: str | os.PathLike, level: int = 3, enabled: bool = True):
+        self.dict_dir = Path(dict_dir)
+        self.level = level
+        self.enabled = enabled and zstandard is not None
+        self._dictionaries: dict[int, "zstandard.ZstdCompressionDict"] = {}
+        self.dict_id = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if zstandard is not None:
+            self._load_dictionaries()
+
+    def _load_dictionaries(self) -> None:
+        if not self.dict_dir.is_dir():
+            return
+        for path in sorted(self.dict_dir.glob("*.dict"), key=lambda path: path.stat().st_mtime):
+            dictionary = zstandard.ZstdCompressionDict(path.read_bytes())
+            self._dictionaries[dictionary.dict_id()] = dictionary
+            self.dict_id = dictionary.dict_id()
+
+    def _context(self, kind: str, dict_id: int):
+        contexts = self._local.__dict__.setdefault(kind, {})
+        context = contexts.get(dict_id)
+        if context is None:
+            dictionary = self._dictionaries.get(dict_id) if dict_id else None
+            if dict_id and dictionary is None:
+                raise ValueError(f"Unknown zstd dictionary {dict_id}.")
+            if kind == "compressor":
+                context = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            else:
+                context = zstandard.ZstdDecompressor(dict_data=dictionary)
+            contexts[dict_id] = context
+        return context
+
+    def compress(self, data: bytes) -> tuple[bytes, int] | None:
+        """Compress with the current dictionary, returns the data and the dictionary id or None if disabled."""
+        if not self.enabled:
+            return None
+        compressed = self._context("compressor", self.dict_id).compress(data)
+        with self._lock:
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+        return compressed, self.dict_id
+
+    def decompress(self, data: bytes, dict_id: int) -> bytes:
+        if zstandard is None:
+            raise ValueError("Record is zstd compressed, but zstandard isn't installed.")
+        return self._context("decompressor", dict_id).decompress(data)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "dict_id": self.dict_id,
+            "dictionaries": len(self._dictionaries),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": self.bytes_in / self.bytes_out if self.bytes_out else None,
+        }
+
+
+compression = Compression(
+    dict_dir=os.getenv("ZSTD_DICT_DIR", "data/zstd"),
+    level=int(os.getenv("ZSTD_LEVEL", "3")),
+    enabled=os.getenv("COMPRESSION", "zstd") == "zstd",
+)
@@ -1,11 +1,189 @@
-from sqlalchemy import create_engine
+import os
+
+from pathlib import Path
+
+from sqlalchemy import create_engine, event, inspect, make_url, select, delete, update, text, Column, Integer, String, \
+    JSON, LargeBinary
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-DATABASE_URL = "sqlite:///./test.db"
+from util.records import can_pack, pack, unpack
+from util.serialization import dumps, loads
+from util.storage import BatteryPassStore, VersionConflict, to_json_safe
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/batterypass.db")
+# FULL syncs the WAL on every commit before acknowledging it, NORMAL only on
+# checkpoints, which is faster but can lose the last commits if the machine loses power
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "FULL").upper()
+if SQLITE_SYNCHRONOUS not in ("FULL", "NORMAL"):
+    raise ValueError(f"SQLITE_SYNCHRONOUS must be FULL or NORMAL, not '{SQLITE_SYNCHRONOUS}'.")
 
 engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+    DATABASE_URL,
+    connect_args={"check_same_thread": False} if make_url(DATABASE_URL).get_backend_name() == "sqlite" else {},
+    json_serializer=lambda obj: dumps(obj).decode(), json_deserializer=loads,
 )
 
+
+def set_sqlite_pragmas(dbapi_connection, _):
+    """Enable WAL so readers don't block on a writer and a commit only appends to the log."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    # DIDs are case-sensitive, this also lets prefix queries use the primary key index
+    cursor.execute("PRAGMA case_sensitive_like=ON")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", set_sqlite_pragmas)
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+
+
+class BatteryPassRecord(Base):
+    __tablename__ = "battery_passes"
+
+    did = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=1, server_default="0")
+    # Encrypted data with a binary layout is stored in ``record`` (see util.records), anything else as JSON
+    encrypted_data = Column(JSON, nullable=True)
+    record = Column(LargeBinary, nullable=True)
+
+
+def record_columns(encrypted_data: dict) -> dict:
+    """Column values storing the encrypted data, as a binary record if it has a binary layout."""
+    if can_pack(encrypted_data):
+        return {"encrypted_data": None, "record": pack(encrypted_data)}
+    return {"encrypted_data": to_json_safe(encrypted_data), "record": None}
+
+
+class SqlStore(BatteryPassStore):
+    """
+    Battery pass store backed by the SQLAlchemy engine of this module.
+
+    Every record is a row keyed by its DID, so a write only touches the affected
+    row instead of rewriting the whole store. The encrypted data is stored as a
+    binary record instead of base64 encoded JSON wherever possible.
+    """
+
+    def __init__(self, session_factory: sessionmaker = SessionLocal):
+        self._session_factory = session_factory
+        bind = session_factory.kw["bind"]
+        if bind.url.get_backend_name() == "sqlite" and bind.url.database not in (None, "", ":memory:"):
+            Path(bind.url.database).parent.mkdir(parents=True, exist_ok=True)
+        Base.metadata.create_all(bind)
+        # Tables created before records were versioned or stored as binary records lack these columns
+        columns = {column["name"] for column in inspect(bind).get_columns(BatteryPassRecord.__tablename__)}
+        missing = {"version": "INTEGER NOT NULL DEFAULT 0", "record": "BLOB"}
+        with bind.begin() as connection:
+            for name, definition in missing.items():
+                if name not in columns:
+                    connection.execute(text(
+                        f"ALTER TABLE {BatteryPassRecord.__tablename__} ADD COLUMN {name} {definition}"
+                    ))
+
+    def get(self, did: str) -> dict | None:
+        with self._session_factory() as session:
+            record = session.get(BatteryPassRecord, did)
+            if record is None:
+                return None
+            encrypted_data = record.encrypted_data if record.record is None else unpack(record.record)
+            return {"did": record.did, "version": record.version, "encrypted_data": encrypted_data}
+
+    def __contains__(self, did: str) -> bool:
+        with self._session_factory() as session:
+            return session.scalar(select(BatteryPassRecord.did).where(BatteryPassRecord.did == did)) is not None
+
+    def insert(self, did: str, encrypted_data: dict) -> None:
+        self.insert_many([(did, encrypted_data)])
+
+    def insert_many(self, records: list[tuple[str, dict]]) -> None:
+        """Insert several records in a single transaction. Raises a KeyError if any DID already exists."""
+        with self._session_factory() as session:
+            session.add_all(BatteryPassRecord(did=did, **record_columns(data)) for did, data in records)
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                raise KeyError(", ".join(did for did, _ in records))
+
+    def _raise_missing_or_conflict(self, session, did: str, expected_version: int | None) -> None:
+        session.rollback()
+        version = session.scalar(select(BatteryPassRecord.version).where(BatteryPassRecord.did == did))
+        if version is None:
+            raise KeyError(did)
+        raise VersionConflict(did, expected_version, version)
+
+    @staticmethod
+    def _update_statement(did: str, encrypted_data: dict, expected_version: int | None):
+        condition = BatteryPassRecord.did == did
+        if expected_version is not None:
+            condition &= BatteryPassRecord.version == expected_version
+        return (
+            update(BatteryPassRecord)
+            .where(condition)
+            .values(**record_columns(encrypted_data), version=BatteryPassRecord.version + 1)
+            .returning(BatteryPassRecord.version)
+        )
+
+    def update(self, did: str, encrypted_data: dict, expected_version: int | None = None) -> int:
+        with self._session_factory() as session:
+            version = session.scalar(self._update_statement(did, encrypted_data, expected_version))
+            if version is None:
+                self._raise_missing_or_conflict(session, did, expected_version)
+            session.commit()
+            return version
+
+    def update_many(self, updates: list[tuple[str, dict, int | None]]) -> list[int | Exception]:
+        """Apply all updates in a single transaction."""
+        results = []
+        with self._session_factory() as session:
+            for did, encrypted_data, expected_version in updates:
+                version = session.scalar(self._update_statement(did, encrypted_data, expected_version))
+                if version is None:
+                    version = session.scalar(select(BatteryPassRecord.version).where(BatteryPassRecord.did == did))
+                    results.append(KeyError(did) if version is None
+                                   else VersionConflict(did, expected_version, version))
+                else:
+                    results.append(version)
+            session.commit()
+        return results
+
+    def remove(self, did: str, expected_version: int | None = None) -> None:
+        condition = BatteryPassRecord.did == did
+        if expected_version is not None:
+            condition &= BatteryPassRecord.version == expected_version
+        with self._session_factory() as session:
+            result = session.execute(delete(BatteryPassRecord).where(condition))
+            if result.rowcount == 0:
+                self._raise_missing_or_conflict(session, did, expected_version)
+            session.commit()
+
+    def list_dids(self, limit: int, after: str | None = None, prefix: str | None = None) -> list[str]:
+        query = select(BatteryPassRecord.did).order_by(BatteryPassRecord.did).limit(limit)
+        if after is not None:
+            query = query.where(BatteryPassRecord.did > after)
+        if prefix:
+            query = query.where(BatteryPassRecord.did.startswith(prefix, autoescape=True))
+        with self._session_factory() as session:
+            return list(session.scalars(query))
+
+    def pack_records(self) -> int:
+        """Convert rows holding base64 encoded JSON into binary records, keeping their versions."""
+        packed = 0
+        with self._session_factory() as session:
+            for record in session.scalars(select(BatteryPassRecord).where(BatteryPassRecord.record.is_(None))):
+                if record.encrypted_data is not None and can_pack(record.encrypted_data):
+                    record.record = pack(record.encrypted_data)
+                    record.encrypted_data = None
+                    packed += 1
+            session.commit()
+        return packed
+
+    def __len__(self) -> int:
+        with self._session_factory() as session:
+            return session.query(BatteryPassRecord).count()
@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+from pathlib import Path
+
+from util.locks import lock_exclusively
+from util.serialization import dumps, loads
+from util.timeseries import TELEMETRY_PATH, parse_timestamp
+
+# Lists below TELEMETRY_PATH whose entries are events, the battery pass only keeps the latest one
+EVENT_LISTS = frozenset(["negativeEvents"])
+
+Event = tuple[str, float, dict]
+
+
+def telemetry_events(updates: list, now: float | None = None) -> list[Event]:
+    """
+    The entries of ``EVENT_LISTS`` in a list of ``{"path.to.key": value}`` updates as
+    ``(list, timestamp, entry)`` events, their timestamp is their ``lastUpdate`` or ``now``.
+    """
+    now = time.time() if now is None else now
+    events = []
+    for element in updates:
+        for key, value in element.items():
+            path = tuple(key.split("."))
+            if path[:len(TELEMETRY_PATH)] == TELEMETRY_PATH and len(path) == len(TELEMETRY_PATH) + 1:
+                lists = {path[-1]: value} if path[-1] in EVENT_LISTS else {}
+            elif path == TELEMETRY_PATH[:len(path)]:
+                # An update of e.g. the whole performance submodel contains the lists further down
+                for parent in TELEMETRY_PATH[len(path):]:
+                    value = value.get(parent) if isinstance(value, dict) else None
+                lists = {name: value[name] for name in EVENT_LISTS if isinstance(value, dict) and name in value}
+            else:
+                continue
+            for name, entries in lists.items():
+                for entry in entries if isinstance(entries, list) else [entries]:
+                    if isinstance(entry, dict):
+                        events.append((name, parse_timestamp(entry.get("lastUpdate"), now), entry))
+    return events
+
+
+class EventStore:
+    """
+    Bounded store for the history of the event lists of battery passes, e.g. ``negativeEvents``.
+
+    The latest ``max_events`` events of each DID are kept in memory in the order they were
+    recorded. Events are appended to a log of JSON lines, which is replayed on startup and
+    rewritten with the live events once it holds more than ``compaction_ratio`` times as many
+    lines. Like the time-series store, the log is flushed on every write but only fsynced on
+    compaction and close, and only one process can open the store at a time.
+    """
+
+    def __init__(
+            self,
+            path: str | os.PathLike,
+            max_events: int = 1000,
+            compaction_ratio: float = 2.0,
+            compaction_min_bytes: int = 1 << 20,
+    ):
+        self.path = Path(path)
+        self.max_events = max_events
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_bytes = compaction_min_bytes
+        self._events: dict[str, deque[Event]] = {}
+        # Number of live events and of lines in the log
+        self._live = 0
+        self._log_lines = 0
+        self._log_bytes = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._process_lock = lock_exclusively(self.path.with_suffix(self.path.suffix + ".lock"))
+        self._tmp_path.unlink(missing_ok=True)
+        self.path.touch()
+        self._replay()
+        self._file = open(self.path, "ab")
+
+    @property
+    def _tmp_path(self) -> Path:
+        return self.path.with_suffix(self.path.suffix + ".compact")
+
+    def _replay(self) -> None:
+        """Rebuild the events from the log and cut off a torn last line."""
+        data = self.path.read_bytes()
+        offset = 0
+        while offset < len(data):
+            end = data.find(b"\n", offset)
+            if end == -1:
+                break
+            try:
+                line = loads(data[offset:end])
+                self._apply(line["did"], line.get("list"), line.get("time"), line.get("entry"))
+            except (ValueError, KeyError, TypeError):
+                break
+            self._log_lines += 1
+            offset = end + 1
+        if offset != len(data):
+            logging.warning(f"Discarding incomplete event entry at offset {offset} in {self.path}")
+            os.truncate(self.path, offset)
+        self._log_bytes = offset
+
+    def _apply(self, did: str, name: str | None, timestamp: float | None, entry: dict | None) -> None:
+        """Apply a line of the log, one without a list drops the events of the DID. Must be called with the lock held."""
+        if name is None:
+            self._live -= len(self._events.pop(did, ()))
+            return
+        events = self._events.get(did)
+        if events is None:
+            events = self._events[did] = deque(maxlen=self.max_events)
+        # A full deque drops its oldest event
+        self._live += len(events) < self.max_events
+        events.append((name, float(timestamp), entry))
+
+    def _write(self, lines: list[bytes]) -> None:
+        """Append lines to the log. Must be called with the lock held."""
+        data = b"".join(lines)
+        self._file.write(data)
+        self._file.flush()
+        self._log_lines += len(lines)
+        self._log_bytes += len(data)
+
+    def record(self, did: str, events: list[Event]) -> int:
+        """Append ``(list, timestamp, entry)`` events of a DID and return their number."""
+        if not events:
+            return 0
+        lines = [dumps({"did": did, "list": name, "time": timestamp, "entry": entry}) + b"\n"
+                 for name, timestamp, entry in events]
+        with self._lock:
+            self._write(lines)
+            for name, timestamp, entry in events:
+                self._apply(did, name, timestamp, entry)
+            if self.needs_compaction():
+                self._compact()
+        return len(events)
+
+    def remove(self, did: str) -> None:
+        """Drop all events of a DID, e.g. when its battery pass is deleted."""
+        with self._lock:
+            if did in self._events:
+                self._write([dumps({"did": did}) + b"\n"])
+                self._apply(did, None, None, None)
+
+    def query(self, did: str, name: str | None = None, since: float | None = None,
+              until: float | None = None) -> list[dict]:
+        """The events of a DID in the list ``name`` if given, between ``since`` and ``until`` as Unix timestamps."""
+        with self._lock:
+            return [
+                {"list": event_list, "time": timestamp, "entry": entry}
+                for event_list, timestamp, entry in self._events.get(did, ())
+                if (name is None or event_list == name) and (since is None or timestamp >= since)
+                and (until is None or timestamp <= until)
+            ]
+
+    def __contains__(self, did: str) -> bool:
+        return did in self._events
+
+    def needs_compaction(self) -> bool:
+        return self._log_bytes >= self.compaction_min_bytes and self._log_lines > self.compaction_ratio * self._live
+
+    def _compact(self) -> None:
+        """Write the live events into a new log and replace the current one with it. Must be called with the lock held."""
+        lines = [
+            dumps({"did": did, "list": name, "time": timestamp, "entry": entry}) + b"\n"
+            for did, events in self._events.items() for name, timestamp, entry in events
+        ]
+        with open(self._tmp_path, "wb") as segment:
+            segment.write(b"".join(lines))
+            segment.flush()
+            os.fsync(segment.fileno())
+            size = segment.tell()
+        os.replace(self._tmp_path, self.path)
+        self._file.close()
+        self._file = open(self.path, "ab")
+        logging.info(f"Compacted {self.path} from {self._log_bytes} to {size} bytes")
+        self._log_lines = len(lines)
+        self._log_bytes = size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "dids": len(self._events),
+                "events": self._live,
+                "log_bytes": self._log_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._process_lock.close()
+
+
+def open_events() -> EventStore:
+    """Open the event store configured by the ``EVENTS_*`` environment variables."""
+    return EventStore(
+        os.getenv("EVENTS_PATH", "data/events.log"),
+        max_events=int(os.getenv("EVENTS_MAX_PER_DID", "1000")),
+    )
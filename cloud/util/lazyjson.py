@@ -0,0 +1,168 @@
+import os
+import re
+
+from collections.abc import Mapping
+from typing import Any, Iterator
+
+from util.serialization import RawJSON, dumps, loads
+
+# Objects down to this depth, i.e. the submodels of a battery pass and their members, are written
+# with one member per line, indented with one tab per level
+LAYOUT_DEPTH = 2
+# Smaller objects are parsed as a whole, which is faster than locating their members one by one
+LAZY_MIN_BYTES = int(os.getenv("LAZY_JSON_MIN_BYTES", "16384"))
+
+_INDENTS = [b"\t" * depth for depth in range(LAYOUT_DEPTH + 1)]
+# The rest of a member's key after its opening quote
+_KEY_TAIL = re.compile(rb'(?:[^"\\]|\\.)*"')
+
+
+def dump_object(value: Any, depth: int = 1) -> bytes:
+    """
+    Serialize a value like ``dumps``, but write objects down to ``LAYOUT_DEPTH`` with one member per line.
+    The result is still compact JSON apart from the line breaks, compact JSON never contains a raw
+    line break, so the members of such an object can be located without parsing it.
+    """
+    if isinstance(value, LazyObject):
+        return value.dumps()
+    if not isinstance(value, dict) or not value or depth > LAYOUT_DEPTH:
+        return dumps(value)
+    indent = _INDENTS[depth]
+    members = (b",\n" + indent).join(dumps(key) + b":" + dump_object(item, depth + 1) for key, item in value.items())
+    return b"{\n" + indent + members + b"\n" + _INDENTS[depth - 1] + b"}"
+
+
+def compact(data: bytes) -> bytes:
+    """Remove the line breaks and indentation of ``dump_object``, JSON strings never contain them unescaped."""
+    return data.replace(b"\n", b"").replace(b"\t", b"")
+
+
+def view(data: bytes, depth: int = 1) -> Any:
+    """
+    A ``LazyObject`` over an object written by ``dump_object`` at ``depth`` of at least ``LAZY_MIN_BYTES``,
+    any other JSON is parsed.
+    """
+    if depth <= LAYOUT_DEPTH and len(data) >= LAZY_MIN_BYTES and data.startswith(b"{\n" + _INDENTS[depth] + b'"'):
+        return LazyObject(data, depth)
+    return loads(data)
+
+
+class LazyObject(Mapping):
+    """
+    View of a JSON object written by ``dump_object`` that only parses the members which are accessed.
+
+    The members are located by the line breaks between them, so neither the other members nor the
+    object as a whole are parsed. Members that are objects within ``LAYOUT_DEPTH`` are views
+    themselves. Members can be set, ``dumps`` then splices the accessed and set members into the
+    original bytes and leaves all others as they were, so the cost of reading and updating a
+    document depends on the members used instead of on its size.
+    """
+    __slots__ = ("_data", "_depth", "_values", "_spans")
+
+    def __init__(self, data: bytes, depth: int = 1):
+        self._data = bytes(data)
+        self._depth = depth
+        # Members that have been accessed or set, they are serialized again by dumps
+        self._values: dict[str, Any] = {}
+        self._spans: dict[str, tuple[int, int]] | None = None
+
+    def _index(self) -> dict[str, tuple[int, int]]:
+        """
+        The position of each member's value in the data. Members are separated by a line break
+        followed by the indentation of the object, so they are found without looking at their values.
+        """
+        if self._spans is not None:
+            return self._spans
+        data = self._data
+        indent = _INDENTS[self._depth]
+        separator = b",\n" + indent + b'"'
+        # The last member is followed by the line with the closing brace
+        closing = len(data) - self._depth - 1
+        spans = {}
+        # After the opening quote of the first member
+        start = 2 + len(indent) + 1
+        while True:
+            key_end = data.find(b'"', start)
+            key = data[start:key_end]
+            if b"\\" in key:
+                key_end = _KEY_TAIL.match(data, start).end() - 1
+                key = loads(data[start - 1:key_end + 1])
+            else:
+                key = key.decode()
+            end = data.find(separator, key_end + 2)
+            if end == -1:
+                spans[key] = key_end + 2, closing
+                break
+            spans[key] = key_end + 2, end
+            start = end + len(separator)
+        self._spans = spans
+        return spans
+
+    def _span(self, key: str) -> tuple[int, int] | None:
+        """The position of a member's value in the data, or None if there is no such member."""
+        return self._index().get(key)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
+        span = self._span(key)
+        if span is None:
+            raise KeyError(key)
+        value = self._values[key] = view(self._data[span[0]:span[1]], self._depth + 1)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._values[key] = value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._values or isinstance(key, str) and self._span(key) is not None
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self._values[key] = default
+        return self[key]
+
+    def raw(self, key: str) -> RawJSON:
+        """The compact JSON of a member, which ``dumps`` embeds as it is."""
+        if key in self._values:
+            return RawJSON(compact(dump_object(self._values[key], self._depth + 1)))
+        span = self._span(key)
+        if span is None:
+            raise KeyError(key)
+        return RawJSON(compact(self._data[span[0]:span[1]]))
+
+    def __iter__(self) -> Iterator[str]:
+        index = self._index()
+        yield from index
+        # Members that have been added
+        yield from (key for key in self._values if key not in index)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def dumps(self) -> bytes:
+        """Serialize the object, only the members that have been accessed or set are serialized again."""
+        if not self._values:
+            return self._data
+        indent = _INDENTS[self._depth]
+        replaced = []
+        added = []
+        for key, value in self._values.items():
+            span = self._span(key)
+            serialized = dump_object(value, self._depth + 1)
+            if span is None:
+                added.append(b",\n" + indent + dumps(key) + b":" + serialized)
+            else:
+                replaced.append((span, serialized))
+        replaced.sort()
+        parts = []
+        position = 0
+        for (start, end), serialized in replaced:
+            parts += [self._data[position:start], serialized]
+            position = end
+        closing = len(self._data) - self._depth - 1
+        parts += [self._data[position:closing], *added, self._data[closing:]]
+        return b"".join(parts)
+
+    def raw_json(self) -> bytes:
+        return compact(self.dumps())
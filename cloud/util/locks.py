@@ -0,0 +1,68 @@
+import asyncio
+import os
+import zlib
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class StripedLock:
+    """
+    A fixed pool of asyncio locks shared by all DIDs.
+
+    A DID always maps to the same stripe, so requests for the same DID are serialized
+    while requests for other DIDs only contend if they happen to share a stripe.
+    """
+
+    def __init__(self, stripes: int = 1024):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        # The key each stripe is held for by ``hold``
+        self._holders: list[str | None] = [None] * stripes
+
+    def _stripe(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % len(self._locks)
+
+    def __call__(self, key: str) -> asyncio.Lock:
+        return self._locks[self._stripe(key)]
+
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[bool]:
+        """
+        Hold the stripe of a key and yield True, or yield False at once if it's already held for
+        the same key, so that requests for the same DID fail fast instead of queueing up. Another
+        key that shares the stripe is waited for.
+        """
+        stripe = self._stripe(key)
+        if self._holders[stripe] == key:
+            yield False
+            return
+        async with self._locks[stripe]:
+            self._holders[stripe] = key
+            try:
+                yield True
+            finally:
+                self._holders[stripe] = None
+
+
+def lock_exclusively(path: str | os.PathLike) -> BinaryIO:
+    """
+    Take an exclusive lock on a lock file for as long as the returned file is open, so that only one
+    process at a time uses a store kept in memory. Raises a RuntimeError if another process holds it.
+    Without ``fcntl``, i.e. on Windows, the file is opened without a lock.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file = open(path, "ab")
+    if fcntl is not None:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            raise RuntimeError(f"{path} is locked by another process, the store can only be opened by one process.")
+    return file
@@ -0,0 +1,428 @@
+import base64
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from pathlib import Path
+from typing import NamedTuple
+
+from util.locks import lock_exclusively
+from util.records import can_pack, pack, unpack
+from util.serialization import dumps, loads
+from util.storage import BatteryPassStore, SortedKeys, VersionConflict
+
+OP_PUT = 1
+OP_DEL = 2
+FLAG_ENC = 0x01
+FLAG_CIPHERTEXT = 0x02
+# The ciphertext section holds the whole encrypted data as a binary record, see util.records
+FLAG_RECORD = 0x04
+
+# magic, op, flags, did length, enc length, ciphertext length, extra length, version, crc32
+FRAME_HEADER = struct.Struct("<4sBBHIIIQI")
+FRAME_MAGIC = b"BPLG"
+
+
+class _Entry(NamedTuple):
+    segment: "_Segment"
+    offset: int
+    size: int
+    did_len: int
+    enc_len: int
+    ciphertext_len: int
+    extra_len: int
+    flags: int
+    version: int
+
+
+class _Segment:
+    """Read-only memory map over a log segment that is remapped when the file has grown."""
+
+    def __init__(self, path: Path):
+        self._file = open(path, "rb")
+        self._map: mmap.mmap | None = None
+        self._lock = threading.Lock()
+
+    def view(self, offset: int, length: int) -> memoryview:
+        m = self._map
+        if m is None or offset + length > len(m):
+            with self._lock:
+                m = self._map
+                if m is None or offset + length > len(m):
+                    # The previous map is released once the last view into it is gone
+                    m = self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(m)[offset:offset + length]
+
+    def close(self) -> None:
+        """Map the whole segment before closing the file, so that views into it stay valid."""
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self.view(0, size)
+        self._file.close()
+
+
+def _as_bytes(value) -> bytes | memoryview:
+    return base64.b64decode(value) if isinstance(value, str) else value
+
+
+def encode_frame(op: int, did: str, encrypted_data: dict | None = None, version: int = 0) -> bytes:
+    """
+    Serialize one log entry. Encrypted data with a binary layout is stored as a binary record.
+    Otherwise the ``enc`` and ``ciphertext`` fields are stored as raw bytes, all other fields
+    as a JSON object.
+    """
+    encrypted_data = dict(encrypted_data or {})
+    flags = 0
+    enc = ciphertext = b""
+    if encrypted_data and can_pack(encrypted_data):
+        flags |= FLAG_RECORD
+        ciphertext = pack(encrypted_data)
+        encrypted_data = {}
+    if "enc" in encrypted_data:
+        flags |= FLAG_ENC
+        enc = _as_bytes(encrypted_data.pop("enc"))
+    if "ciphertext" in encrypted_data:
+        flags |= FLAG_CIPHERTEXT
+        ciphertext = _as_bytes(encrypted_data.pop("ciphertext"))
+    extra = dumps(encrypted_data) if encrypted_data else b""
+    did_bytes = did.encode()
+    body = b"".join((did_bytes, enc, ciphertext, extra))
+    header = FRAME_HEADER.pack(
+        FRAME_MAGIC, op, flags, len(did_bytes), len(enc), len(ciphertext), len(extra), version, zlib.crc32(body)
+    )
+    return header + body
+
+
+class LogStore(BatteryPassStore):
+    """
+    Log-structured battery pass store.
+
+    Every create, update and delete appends a single binary frame to the log file
+    instead of rewriting the store. Writers that arrive while an fsync is in flight
+    are flushed together by the next fsync (group commit).
+
+    The in-memory index only holds the position of each live frame. Reads go through
+    a memory map of the segment, so a lookup returns zero-copy views of the record's
+    raw fields and resident memory doesn't grow with the stored data.
+
+    The index and the log are owned by a single process, which holds an exclusive lock on
+    ``<path>.lock`` while the store is open. Sharing the memory-mapped log between several API
+    worker processes through the page cache is deliberately not supported: none of them would see
+    the appends of the others and a compaction would drop them. The API therefore has to run with
+    a single worker on this backend, a second process fails to open the store.
+
+    A background thread compacts the log once it grows beyond ``compaction_ratio``
+    times the size of the live records. Compaction copies the live frames into a new
+    segment while readers keep using the current one, then appends the log tail written
+    in the meantime and atomically replaces the old segment.
+    """
+
+    def __init__(
+            self,
+            path: str | os.PathLike,
+            compaction_ratio: float = 2.0,
+            compaction_min_bytes: int = 1 << 20,
+            compaction_interval: float = 30.0,
+    ):
+        self.path = Path(path)
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_bytes = compaction_min_bytes
+        self._index: dict[str, _Entry] = {}
+        self._live_bytes = 0
+        self._log_bytes = 0
+
+        # Guards the index and appends to the log file
+        self._lock = threading.Lock()
+        # Guards the group commit state
+        self._sync_cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        # Only one compaction at a time
+        self._compact_lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # The log itself is replaced by compactions, so the lock is held on a separate file
+        try:
+            self._process_lock = lock_exclusively(self.path.with_suffix(self.path.suffix + ".lock"))
+        except RuntimeError as e:
+            raise RuntimeError(f"{e} The log backend only supports a single API worker, run the API with "
+                               f"one worker or use the sqlite backend for several.") from None
+        self._tmp_path.unlink(missing_ok=True)
+        self.path.touch()
+        self._convert_json_lines()
+        self._segment = _Segment(self.path)
+        self._replay()
+        self._sorted = SortedKeys(self._index)
+        self._file = open(self.path, "ab")
+
+        self._closed = threading.Event()
+        self._compactor = threading.Thread(
+            target=self._compaction_loop, args=(compaction_interval,), name="logstore-compactor", daemon=True
+        )
+        self._compactor.start()
+
+    @property
+    def _tmp_path(self) -> Path:
+        return self.path.with_suffix(self.path.suffix + ".compact")
+
+    def _convert_json_lines(self) -> None:
+        """Rewrite a log written in the former JSON lines format as binary frames."""
+        with open(self.path, "rb") as f:
+            if f.read(1) != b"{":
+                return
+            f.seek(0)
+            records = {}
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                if entry["op"] == "put":
+                    records[entry["did"]] = entry["encrypted_data"]
+                else:
+                    records.pop(entry["did"], None)
+        with open(self._tmp_path, "wb") as segment:
+            for did, encrypted_data in records.items():
+                segment.write(encode_frame(OP_PUT, did, encrypted_data))
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.replace(self._tmp_path, self.path)
+        logging.info(f"Converted {len(records)} records in {self.path} to the binary log format")
+
+    def _replay(self) -> None:
+        """Rebuild the index from the log and cut off a torn last frame."""
+        size = self.path.stat().st_size
+        offset = 0
+        while offset + FRAME_HEADER.size <= size:
+            header = self._segment.view(offset, FRAME_HEADER.size)
+            magic, op, flags, did_len, enc_len, ciphertext_len, extra_len, version, crc = FRAME_HEADER.unpack(header)
+            frame_size = FRAME_HEADER.size + did_len + enc_len + ciphertext_len + extra_len
+            if magic != FRAME_MAGIC or offset + frame_size > size:
+                break
+            body = self._segment.view(offset + FRAME_HEADER.size, frame_size - FRAME_HEADER.size)
+            if zlib.crc32(body) != crc:
+                break
+            did = bytes(body[:did_len]).decode()
+            self._apply(did, op, _Entry(
+                self._segment, offset, frame_size, did_len, enc_len, ciphertext_len, extra_len, flags, version
+            ))
+            offset += frame_size
+        if offset != size:
+            logging.warning(f"Discarding incomplete log entry at offset {offset} in {self.path}")
+            os.truncate(self.path, offset)
+        self._log_bytes = offset
+
+    def _apply(self, did: str, op: int, entry: _Entry) -> bool:
+        """Apply an entry to the index and return whether the set of DIDs has changed."""
+        previous = self._index.pop(did, None)
+        if previous is not None:
+            self._live_bytes -= previous.size
+        if op == OP_PUT:
+            self._index[did] = entry
+            self._live_bytes += entry.size
+        return (previous is None) == (op == OP_PUT)
+
+    def _append(self, entries: list[tuple[int, str, dict | None, int]]) -> int:
+        """
+        Append entries to the log and apply them to the index. Must be called with the lock held.
+        Returns the ticket to wait for with ``_sync``.
+        """
+        frames = [encode_frame(op, did, encrypted_data, version) for op, did, encrypted_data, version in entries]
+        self._file.write(b"".join(frames))
+        self._file.flush()
+        for (op, did, _, _), frame in zip(entries, frames):
+            magic, _, flags, did_len, enc_len, ciphertext_len, extra_len, version, _ = FRAME_HEADER.unpack_from(frame)
+            changed = self._apply(did, op, _Entry(
+                self._segment, self._log_bytes, len(frame), did_len, enc_len, ciphertext_len, extra_len, flags, version
+            ))
+            if changed and op == OP_PUT:
+                self._sorted.add(did)
+            elif changed:
+                self._sorted.discard(did)
+            self._log_bytes += len(frame)
+        self._written += 1
+        return self._written
+
+    def _sync(self, ticket: int) -> None:
+        """Wait until the write with the given ticket is on disk, fsyncing on behalf of all waiting writers."""
+        with self._sync_cond:
+            while self._synced < ticket:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                target = self._written
+                file = self._file
+                self._sync_cond.release()
+                try:
+                    os.fsync(file.fileno())
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                    self._synced = max(self._synced, target)
+                    self._sync_cond.notify_all()
+
+    def get(self, did: str) -> dict | None:
+        entry = self._index.get(did)
+        if entry is None:
+            return None
+        view = entry.segment.view(entry.offset + FRAME_HEADER.size, entry.size - FRAME_HEADER.size)
+        position = entry.did_len
+        if entry.flags & FLAG_RECORD:
+            encrypted_data = unpack(view[position + entry.enc_len:position + entry.enc_len + entry.ciphertext_len])
+            return {"did": did, "version": entry.version, "encrypted_data": encrypted_data}
+        encrypted_data = {}
+        if entry.flags & FLAG_ENC:
+            encrypted_data["enc"] = view[position:position + entry.enc_len]
+        position += entry.enc_len
+        if entry.flags & FLAG_CIPHERTEXT:
+            encrypted_data["ciphertext"] = view[position:position + entry.ciphertext_len]
+        position += entry.ciphertext_len
+        if entry.extra_len:
+            encrypted_data.update(loads(view[position:position + entry.extra_len]))
+        return {"did": did, "version": entry.version, "encrypted_data": encrypted_data}
+
+    def __contains__(self, did: str) -> bool:
+        return did in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def insert(self, did: str, encrypted_data: dict) -> None:
+        self.insert_many([(did, encrypted_data)])
+
+    def insert_many(self, records: list[tuple[str, dict]]) -> None:
+        with self._lock:
+            seen = set()
+            conflicts = [did for did, _ in records if did in self._index or did in seen or seen.add(did)]
+            if conflicts:
+                raise KeyError(", ".join(conflicts))
+            ticket = self._append([(OP_PUT, did, encrypted_data, 1) for did, encrypted_data in records])
+        self._sync(ticket)
+
+    def _check_version(self, did: str, expected_version: int | None) -> int:
+        version = self._index[did].version
+        if expected_version is not None and version != expected_version:
+            raise VersionConflict(did, expected_version, version)
+        return version
+
+    def update(self, did: str, encrypted_data: dict, expected_version: int | None = None) -> int:
+        with self._lock:
+            version = self._check_version(did, expected_version) + 1
+            ticket = self._append([(OP_PUT, did, encrypted_data, version)])
+        self._sync(ticket)
+        return version
+
+    def update_many(self, updates: list[tuple[str, dict, int | None]]) -> list[int | Exception]:
+        """Append all applicable updates and wait for a single fsync covering all of them."""
+        results = []
+        ticket = 0
+        with self._lock:
+            for did, encrypted_data, expected_version in updates:
+                try:
+                    version = self._check_version(did, expected_version) + 1
+                except (KeyError, VersionConflict) as e:
+                    results.append(e)
+                    continue
+                ticket = self._append([(OP_PUT, did, encrypted_data, version)])
+                results.append(version)
+        if ticket:
+            self._sync(ticket)
+        return results
+
+    def remove(self, did: str, expected_version: int | None = None) -> None:
+        with self._lock:
+            version = self._check_version(did, expected_version) + 1
+            ticket = self._append([(OP_DEL, did, None, version)])
+        self._sync(ticket)
+
+    def list_dids(self, limit: int, after: str | None = None, prefix: str | None = None) -> list[str]:
+        return self._sorted.page(limit, after, prefix)
+
+    def pack_records(self) -> int:
+        """Rewrite records stored in the former frame layout as binary records, keeping their versions."""
+        packed = ticket = 0
+        for did in self.dids():
+            with self._lock:
+                entry = self._index.get(did)
+                if entry is None or entry.flags & FLAG_RECORD:
+                    continue
+                encrypted_data = self.get(did)["encrypted_data"]
+                if not can_pack(encrypted_data):
+                    continue
+                ticket = self._append([(OP_PUT, did, encrypted_data, entry.version)])
+                packed += 1
+        if ticket:
+            self._sync(ticket)
+        return packed
+
+    def needs_compaction(self) -> bool:
+        return (
+                self._log_bytes >= self.compaction_min_bytes
+                and self._log_bytes > self.compaction_ratio * self._live_bytes
+        )
+
+    def compact(self) -> None:
+        """Copy the live frames into a new segment and replace the log with it."""
+        with self._compact_lock:
+            with self._lock:
+                snapshot = list(self._index.items())
+                tail_offset = self._log_bytes
+            offsets = {}
+            with open(self._tmp_path, "wb") as segment:
+                for did, entry in snapshot:
+                    offsets[did] = segment.tell()
+                    segment.write(entry.segment.view(entry.offset, entry.size))
+                snapshot_bytes = segment.tell()
+                with self._lock:
+                    with open(self.path, "rb") as log:
+                        log.seek(tail_offset)
+                        segment.write(log.read())
+                    segment.flush()
+                    os.fsync(segment.fileno())
+                    segment_bytes = segment.tell()
+                    os.replace(self._tmp_path, self.path)
+                    retired_segment = self._segment
+                    self._segment = _Segment(self.path)
+                    index = {}
+                    for did, entry in self._index.items():
+                        if entry.offset >= tail_offset:
+                            offset = snapshot_bytes + entry.offset - tail_offset
+                        else:
+                            offset = offsets[did]
+                        index[did] = entry._replace(segment=self._segment, offset=offset)
+                    self._index = index
+                    with self._sync_cond:
+                        while self._syncing:
+                            self._sync_cond.wait()
+                        retired_file = self._file
+                        self._file = open(self.path, "ab")
+                        # Everything written so far is part of the fsynced segment
+                        self._synced = self._written
+                        self._sync_cond.notify_all()
+                    logging.info(f"Compacted {self.path} from {self._log_bytes} to {segment_bytes} bytes")
+                    self._log_bytes = segment_bytes
+            retired_file.close()
+            retired_segment.close()
+
+    def _compaction_loop(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            if not self.needs_compaction():
+                continue
+            try:
+                self.compact()
+            except OSError as e:
+                logging.error(f"Compaction of {self.path} failed: {e}")
+
+    def close(self) -> None:
+        self._closed.set()
+        self._compactor.join()
+        with self._lock:
+            self._file.close()
+            self._segment.close()
+        self._process_lock.close()
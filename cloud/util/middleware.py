@@ -1,86 +1,92 @@
 import json
-import json5
-
-from functools import lru_cache
-from pathlib import Path
-from typing import Literal, Any
-from tinydb.table import Document
-from crypto.crypto import decrypt_and_verify, decrypt_hpke
+from typing import Literal
+from crypto.crypto import decrypt_and_verify_request, decrypt_record, decrypt_chunks, encrypt_document, \
+    is_chunked, compression_matches, SignedRequest
 from Crypto.PublicKey import ECC
-from util.models import EncryptedPayload
-
+from util.lazyjson import view
+from util.projection import ProjectionStep, apply_plan, attribute_plans, fields_plan, plan_submodels
+from util.validators import validate_battery_pass_payload
+from util.serialization import dumps, loads
+from util.timeseries import is_telemetry_list, latest_entries, latest_telemetry
 
-@lru_cache
-def load_attributes() -> dict:
-    with open(Path(__file__).parent / "attributes.jsonc") as f:
-        return json5.load(f)
 
+async def verify_request(item: SignedRequest, private_key: ECC.EccKey) -> bytes:
+    return await decrypt_and_verify_request(private_key, item)
 
-def verify_request(item: EncryptedPayload, private_key: ECC.EccKey) -> bytes:
-    return decrypt_and_verify(private_key, json.dumps(item.model_dump()).encode())
 
-
-def retrieve_data(scope: Literal["public", "bms", "legitimate_interest"], did: str, doc: Document,
-                  private_key: ECC.EccKey):
+def retrieve_data(scope: Literal["public", "bms", "legitimate_interest"], did: str, doc: dict,
+                  private_key: ECC.EccKey, fields: tuple[tuple[str, ...], ...] = (),
+                  plan: tuple[ProjectionStep, ...] | None = None) -> bytes:
+    """
+    Decrypt a document and return the JSON body of its projection for the scope, restricted
+    to the attribute paths in ``fields`` if given. Of a chunked document only the submodels
+    the projection reads from are decrypted, and only the attributes it reads are parsed.
+    The full document of the bms scope is returned as stored, without parsing it. A ``plan``
+    already taken from ``attribute_plans`` for the scope and fields is used instead of looking it up.
+    """
     if scope not in ["public", "bms", "legitimate_interest"]:
         raise ValueError(f"Scope '{scope}' is not in ['public', 'bms', 'legitimate_interest'].")
-    decrypted_data = decrypt_hpke(
-        private_key=private_key,
-        bundle=doc["encrypted_data"]
-    )
-    decrypted_dict = json.loads(decrypted_data)
-    if scope == "bms":
-        return decrypted_dict
-    attributes = load_attributes()
-    output_dict = filter_attributes(scope, attributes, decrypted_dict)
-    return output_dict
+    bundle = doc["encrypted_data"]
+    if scope == "bms" and not fields:
+        return decrypt_record(private_key=private_key, did=did, bundle=bundle)
+    if plan is None:
+        plan = fields_plan(fields) if scope == "bms" else attribute_plans.get(scope, fields)[1]
+    if is_chunked(bundle):
+        chunks = decrypt_chunks(private_key, did, bundle, plan_submodels(plan))
+        document = {name: view(chunk) for name, chunk in chunks.items()}
+    else:
+        document = loads(decrypt_record(private_key, did, bundle))
+    return dumps(apply_plan(plan, document))
 
 
-def filter_attributes(
-        scope: Literal["public", "legitimate_interest"],
-        attributes: dict[str, Any],
-        input_dict: dict[str, Any]
-) -> dict[str, Any]:
-    def merge_scopes(base_scope: dict, extra_scope: dict) -> dict:
-        merged = dict(base_scope)
-        for key, value in extra_scope.items():
-            if key in merged:
-                if isinstance(value, dict) and isinstance(merged[key], dict):
-                    merged[key] = merge_scopes(merged[key], value)
-                elif isinstance(value, list) and isinstance(merged[key], list):
-                    merged[key] = list(set(merged[key]) | set(value))
-            else:
-                merged[key] = value
-        return merged
+def set_nested_value(doc, path_keys, new_value):
+    """
+    Set the value at a path, a value for a list is appended to it. Lists in the telemetry only keep
+    their latest entry instead, per component for entries with a ``batteryComponent``, their
+    history is kept in the time-series and event stores.
+    """
+    current_level = doc
+    for key in path_keys[:-1]:
+        current_level = current_level.setdefault(key, {})
+    target = current_level[path_keys[-1]]
+    if not isinstance(target, list):
+        current_level[path_keys[-1]] = latest_telemetry(path_keys, new_value)
+    elif is_telemetry_list(path_keys):
+        entries = new_value if isinstance(new_value, list) else [new_value]
+        current_level[path_keys[-1]] = latest_entries(target + entries)
+    else:
+        target.append(new_value)
+
 
-    def recursive_filter(attr_structure: Any, data: Any, path: str = "") -> Any:
-        result = {}
-        if isinstance(attr_structure, dict):
-            for key, sub_attrs in attr_structure.items():
-                if key not in data:
-                    continue
-                filtered = recursive_filter(sub_attrs, data[key], path=f"{path}.{key}" if path else key)
-                if filtered:
-                    result[key] = filtered
-        elif isinstance(attr_structure, list):
-            for attr in attr_structure:
-                if attr not in data:
-                    continue
-                if path == "materialComposition" and attr == "batteryMaterials" and scope == "public":
-                    filtered_battery_materials = []
-                    for item in data[attr]:
-                        comp_name = item.get("batteryMaterialLocation", {}).get("componentName")
-                        if comp_name in {"Anode", "Cathode", "Electrolyte"}:  # Exclude anode/cathode/electrolyte
-                            continue
-                        filtered_battery_materials.append(item)
-                    if filtered_battery_materials:
-                        result[attr] = filtered_battery_materials
-                else:
-                    result[attr] = data[attr]
-        return result
-    if scope == "legitimate_interest":
-        merged_attrs = merge_scopes(attributes["public"], attributes["legitimate_interest"])
+def update_data(doc: dict, updates: list, private_key: ECC.EccKey) -> dict:
+    """
+    Apply a list of ``{"path.to.key": value}`` updates to a document and encrypt it again with
+    the document's data key. Of a chunked document only the submodels the updates touch are
+    decrypted and encrypted again, and only the attributes on the updated paths are parsed and
+    serialized again. A document stored as a whole is split into submodels.
+    """
+    if not isinstance(updates, list) or not all(isinstance(element, dict) and len(element) == 1
+                                                for element in updates):
+        raise ValueError("Invalid update format.")
+    bundle = doc["encrypted_data"]
+    if is_chunked(bundle) and compression_matches(bundle):
+        touched = {key.split(".")[0] for element in updates for key in element}
+        chunks = decrypt_chunks(private_key, doc["did"], bundle, touched)
+        decrypted_dict = {name: view(chunk) for name, chunk in chunks.items()}
     else:
-        merged_attrs = attributes["public"]
+        decrypted_dict = loads(decrypt_record(private_key, doc["did"], bundle))
+    for element in updates:  # Iterate over the list of JSON items
+        key, value = next(iter(element.items()))
+        try:
+            set_nested_value(decrypted_dict, key.split("."), value)
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError(f"Invalid update path '{key}'.")
+    return encrypt_document(private_key, doc["did"], decrypted_dict, bundle=bundle)
+
 
-    return recursive_filter(merged_attrs, input_dict)
+def prepare_battery_pass(did: str, battery_pass: dict, private_key: ECC.EccKey) -> dict:
+    """Validate a new battery pass and encrypt it, raises a ValueError if it doesn't match the schema."""
+    results = validate_battery_pass_payload(battery_pass)
+    if not all(value == "Valid" for value in results.values()):
+        raise ValueError(f"Invalid payload: {json.dumps(results)}")
+    return encrypt_document(private_key, did, battery_pass)
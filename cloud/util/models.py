@@ -103,10 +103,29 @@ class EncryptedPayload(BaseModel):
     signature: Base64String()
 
 
+class DIDPage(BaseModel):
+    dids: list[DID]
+    next_cursor: str | None = Field(
+        description="Pass as `cursor` to fetch the next page, null on the last page."
+    )
+
+
 class SuccessfulResponse(BaseModel):
     ok: str
 
 
+class BatchEntryResult(BaseModel):
+    did: str | None
+    status: int
+    message: str
+
+
+class BatchResponse(BaseModel):
+    succeeded: int
+    failed: int
+    results: list[BatchEntryResult] = Field(description="One result per entry, in the order of the entries.")
+
+
 class ErrorResponse(BaseModel):
     status: int
     message: str
@@ -126,3 +145,18 @@ class ForbiddenResponse(ErrorResponse):
 class NotFoundResponse(ErrorResponse):
     status: int = 404
     message: str = "Entry doesn't exist."
+
+
+class ConflictResponse(ErrorResponse):
+    status: int = 409
+    message: str = "Entry has been modified concurrently."
+
+
+class PreconditionFailedResponse(ErrorResponse):
+    status: int = 412
+    message: str = "Entry version doesn't match If-Match."
+
+
+class RequestTooLargeResponse(ErrorResponse):
+    status: int = 413
+    message: str = "Batch is too large."
@@ -0,0 +1,236 @@
+import logging
+import os
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+import json5
+
+from util.lazyjson import LazyObject
+
+ATTRIBUTES_PATH = Path(__file__).parent / "attributes.jsonc"
+# Limits of the attribute paths a read may select with fields
+MAX_FIELDS = 32
+MAX_FIELD_DEPTH = 8
+
+
+def exclude_active_materials(battery_materials: list) -> list:
+    """Hide the materials of the anode, cathode and electrolyte from the public."""
+    return [
+        item for item in battery_materials
+        if item.get("batteryMaterialLocation", {}).get("componentName") not in {"Anode", "Cathode", "Electrolyte"}
+    ]
+
+
+# Hooks applied to an attribute before it's copied into a projection, keyed by scope and attribute path.
+# An attribute is left out if its hook returns an empty value.
+PREDICATES: dict[tuple[str, str], Callable[[Any], Any]] = {
+    ("public", "materialComposition.batteryMaterials"): exclude_active_materials,
+}
+
+
+class ProjectionStep(NamedTuple):
+    parent: tuple[str, ...]
+    keys: tuple[str, ...]
+    hooks: dict[str, Callable[[Any], Any]]
+
+
+def compile_plan(scope: str, *structures: dict) -> tuple[ProjectionStep, ...]:
+    """
+    Compile attribute structures as found in ``attributes.jsonc`` into a flat projection plan,
+    one step per object holding readable attributes. Several structures are merged.
+    """
+    groups: dict[tuple[str, ...], list[str]] = {}
+
+    def walk(structure: Any, parent: tuple[str, ...]) -> None:
+        if isinstance(structure, dict):
+            for key, sub_structure in structure.items():
+                walk(sub_structure, parent + (key,))
+        elif isinstance(structure, list):
+            keys = groups.setdefault(parent, [])
+            keys.extend(key for key in structure if key not in keys)
+
+    for structure in structures:
+        walk(structure, ())
+    return tuple(
+        ProjectionStep(parent, tuple(keys), {
+            key: PREDICATES[scope, ".".join(parent + (key,))]
+            for key in keys if (scope, ".".join(parent + (key,))) in PREDICATES
+        })
+        for parent, keys in groups.items()
+    )
+
+
+def apply_plan(plan: tuple[ProjectionStep, ...], document: dict | LazyObject) -> dict:
+    """
+    Copy the attributes selected by a plan from a document, leaving out objects without any of them.
+    Attributes of a ``LazyObject`` are copied as their serialized JSON unless they have a hook.
+    """
+    output = {}
+    for step in plan:
+        source = document
+        for key in step.parent:
+            source = source.get(key) if isinstance(source, (dict, LazyObject)) else None
+        if not isinstance(source, (dict, LazyObject)):
+            continue
+        target = None
+        for key in step.keys:
+            if key not in source:
+                continue
+            hook = step.hooks.get(key)
+            if hook is not None:
+                value = hook(source[key])
+                if not value:
+                    continue
+            else:
+                value = source.raw(key) if isinstance(source, LazyObject) else source[key]
+            if target is None:
+                target = output
+                for parent_key in step.parent:
+                    target = target.setdefault(parent_key, {})
+            target[key] = value
+    return output
+
+
+def parse_fields(fields: str) -> tuple[tuple[str, ...], ...]:
+    """
+    Parse a comma separated list of dotted attribute paths into a normalized selection: sorted and
+    without paths below another selected path, so that equivalent lists select the same projection.
+    Raises a ValueError if a path is empty or there are more than ``MAX_FIELDS`` paths or keys in one.
+    """
+    paths = set()
+    for field in fields.split(","):
+        path = tuple(field.strip().split("."))
+        if not all(path):
+            raise ValueError(f"Invalid field '{field.strip()}'.")
+        if len(path) > MAX_FIELD_DEPTH:
+            raise ValueError(f"Field '{field.strip()}' is nested deeper than {MAX_FIELD_DEPTH} attributes.")
+        paths.add(path)
+    if len(paths) > MAX_FIELDS:
+        raise ValueError(f"At most {MAX_FIELDS} fields can be selected.")
+    return tuple(sorted(
+        path for path in paths if not any(path[:depth] in paths for depth in range(1, len(path)))
+    ))
+
+
+def _group(selected: list[tuple[tuple[str, ...], str, Callable[[Any], Any] | None]]) -> tuple[ProjectionStep, ...]:
+    groups: dict[tuple[str, ...], ProjectionStep] = {}
+    for parent, key, hook in selected:
+        step = groups.setdefault(parent, ProjectionStep(parent, (), {}))
+        if key not in step.keys:
+            groups[parent] = step = step._replace(keys=step.keys + (key,))
+        if hook is not None:
+            step.hooks[key] = hook
+    return tuple(groups.values())
+
+
+def fields_plan(fields: tuple[tuple[str, ...], ...]) -> tuple[ProjectionStep, ...]:
+    """Compile attribute paths into a plan selecting exactly these attributes."""
+    return _group([(path[:-1], path[-1], None) for path in fields])
+
+
+def restrict_plan(plan: tuple[ProjectionStep, ...], fields: tuple[tuple[str, ...], ...]) -> tuple[ProjectionStep, ...]:
+    """
+    Intersect a plan with attribute paths. An attribute of the plan is kept as a whole if a path
+    selects it or one of its parents, and narrowed down to the paths below it otherwise. Attributes
+    with a hook are never narrowed down, so the hook always sees the whole attribute.
+    """
+    selected = []
+    for step in plan:
+        for key in step.keys:
+            path = step.parent + (key,)
+            if any(path[:len(field)] == field for field in fields):
+                selected.append((step.parent, key, step.hooks.get(key)))
+                continue
+            narrower = [field for field in fields if field[:len(path)] == path]
+            if narrower and key in step.hooks:
+                selected.append((step.parent, key, step.hooks[key]))
+            else:
+                selected.extend((field[:-1], field[-1], None) for field in narrower)
+    return _group(selected)
+
+
+def plan_submodels(plan: tuple[ProjectionStep, ...]) -> set[str]:
+    """The top-level attributes, i.e. submodels, a plan reads from."""
+    submodels = set()
+    for step in plan:
+        if step.parent:
+            submodels.add(step.parent[0])
+        else:
+            submodels.update(step.keys)
+    return submodels
+
+
+class ProjectionPlans:
+    """
+    The projection plans of all scopes, compiled from ``attributes.jsonc``.
+
+    The file is checked for changes at most every ``check_interval`` seconds. A changed file is
+    compiled into a new set of plans that replaces the old one at once, so a projection never
+    mixes the two. If the changed file can't be parsed, the old plans stay in use. Each set of
+    plans has a generation, which is returned together with a plan so that a projection rendered
+    with it can be cached under the generation it was rendered with.
+    """
+
+    def __init__(self, path: str | os.PathLike = ATTRIBUTES_PATH, check_interval: float = 1.0):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._state: tuple[int, dict[str, tuple[ProjectionStep, ...]]] | None = None
+        # Plans restricted to requested fields, keyed by generation, scope and fields
+        self._restricted: dict[tuple, tuple[ProjectionStep, ...]] = {}
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _compile(self) -> dict[str, tuple[ProjectionStep, ...]]:
+        with open(self.path) as f:
+            attributes = json5.load(f)
+        return {
+            "public": compile_plan("public", attributes["public"]),
+            "legitimate_interest": compile_plan(
+                "legitimate_interest", attributes["public"], attributes["legitimate_interest"]
+            ),
+        }
+
+    def _refresh(self) -> tuple[int, dict[str, tuple[ProjectionStep, ...]]]:
+        """Reload the plans if the file changed. Must be called with the lock held."""
+        now = time.monotonic()
+        if self._state is not None and now < self._next_check:
+            return self._state
+        self._next_check = now + self.check_interval
+        if self._state is None:
+            self._state = self.path.stat().st_mtime_ns, self._compile()
+            return self._state
+        mtime = self._state[0]
+        try:
+            mtime = self.path.stat().st_mtime_ns
+            if mtime != self._state[0]:
+                self._state = mtime, self._compile()
+                self._restricted.clear()
+                logging.info(f"Reloaded attribute projections from {self.path}")
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Failed to reload {self.path}, keeping the previous projections: {e}")
+            # Don't retry until the file changes again
+            self._state = mtime, self._state[1]
+        return self._state
+
+    def get(self, scope: str, fields: tuple[tuple[str, ...], ...] = ()) -> tuple[int, tuple[ProjectionStep, ...]]:
+        """
+        Return the generation of the current plans, which changes whenever they are reloaded,
+        together with the plan of a scope, restricted to the given attribute paths if any.
+        """
+        with self._lock:
+            generation, plans = self._refresh()
+            if not fields:
+                return generation, plans[scope]
+            key = generation, scope, fields
+            plan = self._restricted.get(key)
+            if plan is None:
+                if len(self._restricted) >= 1024:
+                    self._restricted.clear()
+                plan = self._restricted[key] = restrict_plan(plans[scope], fields)
+            return generation, plan
+
+
+attribute_plans = ProjectionPlans()
@@ -0,0 +1,138 @@
+import base64
+import struct
+
+RECORD_MAGIC = b"BPRC"
+RECORD_FORMAT = 1
+FLAG_ENVELOPE = 0x01
+FLAG_ZSTD = 0x02
+# The ciphertext section is a table of per-submodel chunks instead of a single ciphertext
+FLAG_CHUNKED = 0x04
+
+# magic, format, flags, enc length, wrapped key length, nonce length, zstd dictionary id, ciphertext length
+RECORD_HEADER = struct.Struct("<4sBBHHBII")
+# Chunk table: number of chunks, then per chunk its name length, nonce length and ciphertext length
+# followed by the name, nonce and ciphertext
+CHUNK_COUNT = struct.Struct("<H")
+CHUNK_HEADER = struct.Struct("<BBI")
+
+PACKED_FIELDS = {"enc", "ciphertext", "chunks", "wrapped_key", "nonce", "compression", "dict_id"}
+
+
+def _as_bytes(value) -> bytes | memoryview:
+    return base64.b64decode(value) if isinstance(value, str) else value
+
+
+def _can_pack_chunks(chunks) -> bool:
+    return isinstance(chunks, dict) and len(chunks) <= 0xFFFF and all(
+        len(name.encode()) <= 0xFF and isinstance(chunk, dict) and chunk.keys() == {"nonce", "ciphertext"}
+        for name, chunk in chunks.items()
+    )
+
+
+def can_pack(encrypted_data: dict) -> bool:
+    """Whether the encrypted data has a binary layout, i.e. is an HPKE bundle, an envelope or a chunked envelope."""
+    fields = encrypted_data.keys()
+    if "chunks" in fields:
+        return (
+                {"enc", "wrapped_key", "chunks"} <= fields <= PACKED_FIELDS - {"ciphertext", "nonce"}
+                and encrypted_data.get("compression", "zstd") == "zstd"
+                and _can_pack_chunks(encrypted_data["chunks"])
+        )
+    return (
+            {"enc", "ciphertext"} <= fields <= PACKED_FIELDS
+            and ("wrapped_key" in fields) == ("nonce" in fields)
+            and encrypted_data.get("compression", "zstd") == "zstd"
+    )
+
+
+def _pack_chunks(chunks: dict) -> bytes:
+    parts = [CHUNK_COUNT.pack(len(chunks))]
+    for name, chunk in chunks.items():
+        name = name.encode()
+        nonce = _as_bytes(chunk["nonce"])
+        ciphertext = _as_bytes(chunk["ciphertext"])
+        parts += [CHUNK_HEADER.pack(len(name), len(nonce), len(ciphertext)), name, nonce, ciphertext]
+    return b"".join(parts)
+
+
+def _unpack_chunks(view: memoryview) -> dict:
+    if len(view) < CHUNK_COUNT.size:
+        raise ValueError("Truncated chunk table.")
+    count, = CHUNK_COUNT.unpack_from(view)
+    position = CHUNK_COUNT.size
+    chunks = {}
+    for _ in range(count):
+        if len(view) < position + CHUNK_HEADER.size:
+            raise ValueError("Truncated chunk table.")
+        name_len, nonce_len, ciphertext_len = CHUNK_HEADER.unpack_from(view, position)
+        position += CHUNK_HEADER.size
+        end = position + name_len + nonce_len + ciphertext_len
+        if len(view) < end:
+            raise ValueError("Truncated chunk table.")
+        name = bytes(view[position:position + name_len]).decode()
+        position += name_len
+        chunks[name] = {
+            "nonce": view[position:position + nonce_len],
+            "ciphertext": view[position + nonce_len:end],
+        }
+        position = end
+    if position != len(view):
+        raise ValueError("Chunk table length doesn't match the record header.")
+    return chunks
+
+
+def pack(encrypted_data: dict) -> bytes:
+    """
+    Pack encrypted data into the binary record layout: a fixed-size header followed by the raw
+    ``enc``, wrapped data key, nonce and ciphertext, or the chunk table of a chunked record.
+    Fields may be given as raw or base64 encoded bytes.
+    """
+    if not can_pack(encrypted_data):
+        raise ValueError(f"Can't pack encrypted data with the fields {sorted(encrypted_data)}.")
+    flags = 0
+    enc = _as_bytes(encrypted_data["enc"])
+    if "chunks" in encrypted_data:
+        flags |= FLAG_CHUNKED
+        ciphertext = _pack_chunks(encrypted_data["chunks"])
+    else:
+        ciphertext = _as_bytes(encrypted_data["ciphertext"])
+    wrapped_key = nonce = b""
+    if "wrapped_key" in encrypted_data:
+        flags |= FLAG_ENVELOPE
+        wrapped_key = _as_bytes(encrypted_data["wrapped_key"])
+        nonce = _as_bytes(encrypted_data.get("nonce", b""))
+    if "compression" in encrypted_data:
+        flags |= FLAG_ZSTD
+    header = RECORD_HEADER.pack(
+        RECORD_MAGIC, RECORD_FORMAT, flags, len(enc), len(wrapped_key), len(nonce),
+        encrypted_data.get("dict_id", 0), len(ciphertext)
+    )
+    return b"".join((header, enc, wrapped_key, nonce, ciphertext))
+
+
+def unpack(record: bytes | memoryview) -> dict:
+    """Unpack a binary record into encrypted data holding zero-copy views of the raw fields."""
+    view = memoryview(record)
+    if len(view) < RECORD_HEADER.size:
+        raise ValueError("Truncated record header.")
+    magic, record_format, flags, enc_len, wrapped_key_len, nonce_len, dict_id, ciphertext_len = \
+        RECORD_HEADER.unpack_from(view)
+    if magic != RECORD_MAGIC or record_format != RECORD_FORMAT:
+        raise ValueError(f"Unknown record format {magic!r} {record_format}.")
+    if len(view) != RECORD_HEADER.size + enc_len + wrapped_key_len + nonce_len + ciphertext_len:
+        raise ValueError("Record length doesn't match its header.")
+    position = RECORD_HEADER.size
+    encrypted_data = {}
+    for field, length in (("enc", enc_len), ("wrapped_key", wrapped_key_len), ("nonce", nonce_len),
+                          ("ciphertext", ciphertext_len)):
+        # Fields without a section in this kind of record have length 0
+        if field in ("wrapped_key", "nonce") and not flags & FLAG_ENVELOPE or field == "nonce" and flags & FLAG_CHUNKED:
+            continue
+        if field == "ciphertext" and flags & FLAG_CHUNKED:
+            encrypted_data["chunks"] = _unpack_chunks(view[position:position + length])
+        else:
+            encrypted_data[field] = view[position:position + length]
+        position += length
+    if flags & FLAG_ZSTD:
+        encrypted_data.update(compression="zstd", dict_id=dict_id)
+    return encrypted_data
@@ -0,0 +1,77 @@
+import json
+
+from typing import Any, Iterator
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Embeds serialized JSON without parsing it, available since orjson 3.9
+Fragment = getattr(orjson, "Fragment", None)
+
+
+class RawJSON:
+    """Already serialized JSON, which ``dumps`` embeds as it is."""
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def raw_json(self) -> bytes:
+        return self.data
+
+
+def _embed_fragment(obj: Any) -> Any:
+    """Embed objects with a ``raw_json`` method, e.g. ``RawJSON`` or the views of ``util.lazyjson``."""
+    if not hasattr(obj, "raw_json"):
+        raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+    return Fragment(obj.raw_json()) if Fragment is not None else loads(obj.raw_json())
+
+
+def _embed_parsed(obj: Any) -> Any:
+    if not hasattr(obj, "raw_json"):
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return loads(obj.raw_json())
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize to compact UTF-8 JSON, using orjson if it's installed.
+    Falls back to the standard library for values orjson doesn't support, e.g. integers above 64 bits.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_embed_fragment)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_embed_parsed).encode()
+
+
+def loads(data: bytes | bytearray | memoryview | str) -> Any:
+    """Parse JSON, raises a ``json.JSONDecodeError`` (or a subclass of it) on invalid input."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def ndjson_lines(data: bytes) -> Iterator[memoryview]:
+    """Iterate over the non-empty lines of newline-delimited JSON without copying them."""
+    view = memoryview(data)
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start)
+        if end == -1:
+            end = len(data)
+        if end > start:
+            yield view[start:end]
+        start = end + 1
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with ``dumps``."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,288 @@
+import base64
+import bisect
+import os
+import threading
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from util.locks import lock_exclusively
+from util.serialization import dumps, loads
+
+DEFAULT_TABLE = "_default"
+
+
+def to_json_safe(encrypted_data: dict) -> dict:
+    """
+    Base64 encode raw byte fields, e.g. views returned by the log store, so the data can be stored as JSON.
+    Nested objects such as the chunks of a chunked record are converted as well.
+    """
+    return {
+        key: base64.b64encode(value).decode() if isinstance(value, (bytes, bytearray, memoryview))
+        else to_json_safe(value) if isinstance(value, dict) else value
+        for key, value in encrypted_data.items()
+    }
+
+
+class VersionConflict(Exception):
+    """Raised when a record has been changed since the version a write was based on."""
+
+    def __init__(self, did: str, expected_version: int, actual_version: int):
+        super().__init__(f"Expected version {expected_version} of {did}, found version {actual_version}.")
+        self.did = did
+        self.expected_version = expected_version
+        self.actual_version = actual_version
+
+
+class SortedKeys:
+    """Sorted list of DIDs backing the ordered, cursor based listing of the in-memory stores."""
+
+    def __init__(self, keys: Iterable[str] = ()):
+        self._keys = sorted(keys)
+        self._lock = threading.Lock()
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            bisect.insort(self._keys, key)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def page(self, limit: int, after: str | None = None, prefix: str | None = None) -> list[str]:
+        with self._lock:
+            start = 0 if after is None else bisect.bisect_right(self._keys, after)
+            if prefix:
+                start = max(start, bisect.bisect_left(self._keys, prefix))
+            keys = self._keys[start:start + limit]
+        if prefix and keys and not keys[-1].startswith(prefix):
+            # Keys sharing the prefix are contiguous, cut off at the first one that doesn't
+            keys = keys[:bisect.bisect_left(keys, True, key=lambda key: not key.startswith(prefix))]
+        return keys
+
+
+class BatteryPassStore(ABC):
+    """
+    Storage engine for the encrypted battery pass records.
+
+    A record is a dict of the form ``{"did": ..., "version": ..., "encrypted_data": ...}``.
+    The version starts at 1 and is incremented by every update, records written before
+    versioning was introduced have version 0. The
+    ``enc`` and ``ciphertext`` fields of the encrypted data are either base64 strings
+    or raw bytes, depending on the backend.
+    Implementations live for the whole process and keep an index keyed by DID,
+    so that single-record operations don't depend on the number of stored records.
+    """
+
+    @abstractmethod
+    def get(self, did: str) -> dict | None:
+        """Return the record for the DID or None if it doesn't exist."""
+
+    @abstractmethod
+    def insert(self, did: str, encrypted_data: dict) -> None:
+        """Insert a new record. Raises a KeyError if the DID already exists."""
+
+    def insert_many(self, records: list[tuple[str, dict]]) -> None:
+        """Insert several records at once. Raises a KeyError if any DID already exists."""
+        for did, encrypted_data in records:
+            self.insert(did, encrypted_data)
+
+    @abstractmethod
+    def update(self, did: str, encrypted_data: dict, expected_version: int | None = None) -> int:
+        """
+        Replace the encrypted data of a record and return its new version.
+        Raises a KeyError if the DID doesn't exist and a VersionConflict if
+        ``expected_version`` is given and doesn't match the stored version.
+        """
+
+    def update_many(self, updates: list[tuple[str, dict, int | None]]) -> list[int | Exception]:
+        """
+        Apply several ``(did, encrypted_data, expected_version)`` updates as one group. An update
+        failing with a KeyError or VersionConflict doesn't keep the others from being applied.
+        Returns the new version or the exception of every update, in the order of the updates.
+        """
+        results = []
+        for did, encrypted_data, expected_version in updates:
+            try:
+                results.append(self.update(did, encrypted_data, expected_version))
+            except (KeyError, VersionConflict) as e:
+                results.append(e)
+        return results
+
+    @abstractmethod
+    def remove(self, did: str, expected_version: int | None = None) -> None:
+        """
+        Remove a record. Raises a KeyError if the DID doesn't exist and a VersionConflict
+        if ``expected_version`` is given and doesn't match the stored version.
+        """
+
+    @abstractmethod
+    def list_dids(self, limit: int, after: str | None = None, prefix: str | None = None) -> list[str]:
+        """
+        Return up to ``limit`` DIDs in lexicographic order, starting after the DID ``after``
+        and restricted to DIDs starting with ``prefix``.
+        """
+
+    def dids(self, after: str | None = None, prefix: str | None = None, chunk_size: int = 1000) -> Iterator[str]:
+        """Iterate over the stored DIDs in lexicographic order, fetching them in chunks."""
+        while True:
+            chunk = self.list_dids(chunk_size, after=after, prefix=prefix)
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1]
+
+    def __contains__(self, did: str) -> bool:
+        return self.get(did) is not None
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.dids())
+
+    def pack_records(self) -> int:
+        """
+        Convert records stored before the backend used binary records (see util.records),
+        keeping their versions. Returns the number of converted records.
+        """
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class JsonStore(BatteryPassStore):
+    """
+    Battery pass store backed by a TinyDB compatible JSON file.
+
+    The file is parsed once on startup and kept in memory together with a
+    DID -> document id index. Mutations are written back atomically in the
+    TinyDB storage layout, so existing ``data/db.json`` files keep working.
+    Since every write replaces the whole file, only one process can open it,
+    it holds an exclusive lock on ``<path>.lock`` while the store is open.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = Path(path)
+        self._process_lock = lock_exclusively(self.path.with_suffix(self.path.suffix + ".lock"))
+        self._lock = threading.Lock()
+        self._tables: dict[str, dict] = {}
+        self._index: dict[str, str] = {}
+        self._next_id = 1
+        self._load()
+        self._sorted = SortedKeys(self._index)
+
+    def _load(self) -> None:
+        if self.path.is_file() and self.path.stat().st_size > 0:
+            with open(self.path, "rb") as f:
+                self._tables = loads(f.read())
+        self._tables.setdefault(DEFAULT_TABLE, {})
+        for doc_id, record in self._tables[DEFAULT_TABLE].items():
+            if "did" in record:
+                self._index[record["did"]] = doc_id
+            self._next_id = max(self._next_id, int(doc_id) + 1)
+
+    def _flush(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(dumps(self._tables))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @property
+    def _table(self) -> dict:
+        return self._tables[DEFAULT_TABLE]
+
+    def get(self, did: str) -> dict | None:
+        doc_id = self._index.get(did)
+        return None if doc_id is None else {"version": 0, **self._table[doc_id]}
+
+    def _check_version(self, did: str, expected_version: int | None) -> dict:
+        record = self._table[self._index[did]]
+        if expected_version is not None and record.get("version", 0) != expected_version:
+            raise VersionConflict(did, expected_version, record.get("version", 0))
+        return record
+
+    def __contains__(self, did: str) -> bool:
+        return did in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def insert(self, did: str, encrypted_data: dict) -> None:
+        self.insert_many([(did, encrypted_data)])
+
+    def insert_many(self, records: list[tuple[str, dict]]) -> None:
+        with self._lock:
+            seen = set()
+            conflicts = [did for did, _ in records if did in self._index or did in seen or seen.add(did)]
+            if conflicts:
+                raise KeyError(", ".join(conflicts))
+            for did, encrypted_data in records:
+                doc_id = str(self._next_id)
+                self._next_id += 1
+                self._table[doc_id] = {"did": did, "version": 1, "encrypted_data": to_json_safe(encrypted_data)}
+                self._index[did] = doc_id
+                self._sorted.add(did)
+            self._flush()
+
+    def update(self, did: str, encrypted_data: dict, expected_version: int | None = None) -> int:
+        with self._lock:
+            record = self._check_version(did, expected_version)
+            version = record.get("version", 0) + 1
+            self._table[self._index[did]] = {
+                **record, "version": version, "encrypted_data": to_json_safe(encrypted_data)
+            }
+            self._flush()
+            return version
+
+    def update_many(self, updates: list[tuple[str, dict, int | None]]) -> list[int | Exception]:
+        results = []
+        with self._lock:
+            for did, encrypted_data, expected_version in updates:
+                try:
+                    record = self._check_version(did, expected_version)
+                except (KeyError, VersionConflict) as e:
+                    results.append(e)
+                    continue
+                version = record.get("version", 0) + 1
+                self._table[self._index[did]] = {
+                    **record, "version": version, "encrypted_data": to_json_safe(encrypted_data)
+                }
+                results.append(version)
+            if any(isinstance(result, int) for result in results):
+                self._flush()
+        return results
+
+    def remove(self, did: str, expected_version: int | None = None) -> None:
+        with self._lock:
+            self._check_version(did, expected_version)
+            del self._table[self._index.pop(did)]
+            self._sorted.discard(did)
+            self._flush()
+
+    def list_dids(self, limit: int, after: str | None = None, prefix: str | None = None) -> list[str]:
+        return self._sorted.page(limit, after, prefix)
+
+    def close(self) -> None:
+        self._process_lock.close()
+
+
+def open_store(backend: str | None = None) -> BatteryPassStore:
+    """
+    Open the battery pass store selected by ``backend`` or the ``STORAGE_BACKEND``
+    environment variable ("json", "sqlite" or "log").
+    """
+    backend = backend or os.getenv("STORAGE_BACKEND", "json")
+    if backend == "json":
+        return JsonStore(os.getenv("JSON_DB_PATH", "data/db.json"))
+    if backend == "sqlite":
+        from util.database import SqlStore
+        return SqlStore()
+    if backend == "log":
+        from util.logstore import LogStore
+        return LogStore(os.getenv("LOG_DB_PATH", "data/batterypass.log"))
+    raise ValueError(f"Unknown storage backend '{backend}'.")
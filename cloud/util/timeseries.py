@@ -0,0 +1,544 @@
+import array
+import logging
+import math
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from util.locks import lock_exclusively
+
+# Telemetry reported by the BMS, its history is kept in the time-series store instead of the battery pass
+TELEMETRY_PATH = ("performance", "batteryCondition")
+# Values of the BatteryComponent enum of the performance schema
+BATTERY_COMPONENTS = ("pack", "module", "cell")
+# The numeric attributes below TELEMETRY_PATH in the performance schema, only these are recorded,
+# so clients can't create any number of series with made-up attribute names
+TELEMETRY_METRICS = frozenset([
+    "numberOfFullCycles.numberOfFullCyclesValue",
+    "roundTripEfficiencyat50PerCentCycleLife",
+    "stateOfCharge.stateOfChargeValue",
+    "currentSelfDischargingRate.currentSelfDischargingRateEntity",
+    "remainingEnergy.remainingEnergyalue",
+    "evolutionOfSelfDischarge.evolutionOfSelfDischargeEntityValue",
+    "temperatureInformation.timeExtremeHighTemp",
+    "temperatureInformation.timeExtremeLowTempCharging",
+    "temperatureInformation.timeExtremeHighTempCharging",
+    "temperatureInformation.timeExtremeLowTemp",
+    "stateOfCertifiedEnergy.stateOfCertifiedEnergyValue",
+    "energyThroughput",
+    *(f"internalResistanceIncrease.{component}.internalResistanceIncreaseValue" for component in BATTERY_COMPONENTS),
+    "remainingPowerCapability.remainingPowerCapabilityValue.atSoC",
+    "remainingPowerCapability.remainingPowerCapabilityValue.powerCapabilityAt",
+    "roundTripEfficiencyFade",
+    "powerFade",
+    "remainingRoundTripEnergyEfficiency.remainingRoundTripEnergyEfficiencyValue",
+    "capacityThroughput.capacityThroughputValue",
+    "remainingCapacity.remainingCapacityValue",
+    "capacityFade.capacityFadeValue",
+])
+_MAX_METRIC_DEPTH = max(metric.count(".") + 1 for metric in TELEMETRY_METRICS)
+DEFAULT_RETENTION = "raw=7d,1h=90d,1d=1825d"
+
+KIND_POINT = 1
+KIND_BUCKET = 2
+KIND_DROP = 3
+
+# magic, kind, tier, did length, metric length, time, crc32 of did, metric and payload
+FRAME_HEADER = struct.Struct("<4sBBHHdI")
+FRAME_MAGIC = b"BPTS"
+POINT = struct.Struct("<d")
+# minimum, maximum, sum, count
+BUCKET = struct.Struct("<dddI")
+PAYLOAD_SIZES = {KIND_POINT: POINT.size, KIND_BUCKET: BUCKET.size, KIND_DROP: 0}
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+Point = tuple[str, float, float]
+
+
+def parse_duration(value: str) -> float:
+    """Parse a duration like ``90s``, ``15m``, ``1h`` or ``7d`` into seconds."""
+    unit = DURATION_UNITS.get(value[-1:])
+    duration = float(value[:-1]) * unit if unit else float(value)
+    if not duration > 0:
+        raise ValueError(f"Invalid duration '{value}'.")
+    return duration
+
+
+class Tier(NamedTuple):
+    name: str
+    resolution: float
+    retention: float
+
+
+class RetentionPolicy(NamedTuple):
+    """
+    Raw points are kept for ``raw_retention`` seconds and then downsampled into the buckets of
+    the first tier, whose buckets are downsampled into the next tier once they are older than
+    its retention and so on. Buckets older than the retention of the last tier are dropped.
+    """
+    raw_retention: float
+    tiers: tuple[Tier, ...]
+
+    @classmethod
+    def parse(cls, spec: str) -> "RetentionPolicy":
+        """Parse a policy like ``raw=7d,1h=90d,1d=1825d``, the retention of raw points and of each bucket size."""
+        raw_retention = None
+        tiers = []
+        for part in spec.split(","):
+            name, _, retention = part.strip().partition("=")
+            if not retention:
+                raise ValueError(f"Invalid retention '{part}'.")
+            if name == "raw":
+                raw_retention = parse_duration(retention)
+            else:
+                tiers.append(Tier(name, parse_duration(name), parse_duration(retention)))
+        if raw_retention is None:
+            raise ValueError("Retention policy without a retention for raw points.")
+        tiers.sort(key=lambda tier: tier.resolution)
+        return cls(raw_retention, tuple(tiers))
+
+
+class _Buckets:
+    """The downsampled points of one metric in one tier, one array per column."""
+    __slots__ = ("starts", "minimum", "maximum", "total", "count")
+
+    def __init__(self):
+        self.starts = array.array("d")
+        self.minimum = array.array("d")
+        self.maximum = array.array("d")
+        self.total = array.array("d")
+        self.count = array.array("I")
+
+    def columns(self) -> tuple[array.array, ...]:
+        return self.starts, self.minimum, self.maximum, self.total, self.count
+
+    def add(self, start: float, minimum: float, maximum: float, total: float, count: int) -> bool:
+        """Merge into the bucket beginning at ``start`` and return whether a new bucket was created."""
+        index = bisect_left(self.starts, start)
+        if index < len(self.starts) and self.starts[index] == start:
+            self.minimum[index] = min(self.minimum[index], minimum)
+            self.maximum[index] = max(self.maximum[index], maximum)
+            self.total[index] += total
+            self.count[index] += count
+            return False
+        for column, value in zip(self.columns(), (start, minimum, maximum, total, count)):
+            column.insert(index, value)
+        return True
+
+    def pop_front(self, end: int) -> list[tuple]:
+        rows = list(zip(*(column[:end] for column in self.columns())))
+        for column in self.columns():
+            del column[:end]
+        return rows
+
+
+class _Series:
+    """The points of one metric of one DID: the raw points and the buckets of each tier."""
+    __slots__ = ("times", "values", "tiers")
+
+    def __init__(self, tiers: int):
+        self.times = array.array("d")
+        self.values = array.array("d")
+        self.tiers = [_Buckets() for _ in range(tiers)]
+
+    def add(self, timestamp: float, value: float) -> None:
+        index = bisect_right(self.times, timestamp)
+        # Points almost always arrive in order
+        if index == len(self.times):
+            self.times.append(timestamp)
+            self.values.append(value)
+        else:
+            self.times.insert(index, timestamp)
+            self.values.insert(index, value)
+
+    def __len__(self) -> int:
+        return len(self.times) + sum(len(buckets.starts) for buckets in self.tiers)
+
+
+def encode_frame(kind: int, did: str, metric: str = "", timestamp: float = 0.0, payload: bytes = b"",
+                 tier: int = 0) -> bytes:
+    did = did.encode()
+    metric = metric.encode()
+    body = did + metric + payload
+    return FRAME_HEADER.pack(FRAME_MAGIC, kind, tier, len(did), len(metric), timestamp, zlib.crc32(body)) + body
+
+
+class TimeSeriesStore:
+    """
+    Bounded store for the telemetry history of battery passes.
+
+    Every metric of a DID is kept as columnar arrays of timestamps and values, so a point takes
+    16 bytes in memory instead of a JSON object inside the encrypted battery pass. The
+    ``RetentionPolicy`` downsamples older points into buckets holding their minimum, maximum,
+    sum and count, and at most ``max_points`` raw points are kept per metric, so the size of
+    each series is bounded no matter how often a BMS reports.
+
+    Points are appended to a binary log, which is replayed on startup. A background thread
+    applies the retention policy to series that don't receive new points and compacts the log
+    into a snapshot of the live points and buckets once it has grown beyond ``compaction_ratio``
+    times their number. The log is flushed on every write but only fsynced on compaction and close,
+    losing the last points in a crash of the machine is acceptable for telemetry. Like the log
+    store, only one process can open the store at a time.
+    """
+
+    def __init__(
+            self,
+            path: str | os.PathLike,
+            policy: RetentionPolicy,
+            max_points: int = 10000,
+            compaction_ratio: float = 2.0,
+            compaction_min_bytes: int = 1 << 20,
+            compaction_interval: float = 60.0,
+    ):
+        self.path = Path(path)
+        self.policy = policy
+        self.max_points = max_points
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_bytes = compaction_min_bytes
+        self._series: dict[str, dict[str, _Series]] = {}
+        # Number of live points and buckets and of frames in the log
+        self._live = 0
+        self._log_frames = 0
+        self._log_bytes = 0
+
+        # Guards the series and appends to the log file
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._process_lock = lock_exclusively(self.path.with_suffix(self.path.suffix + ".lock"))
+        self._tmp_path.unlink(missing_ok=True)
+        self.path.touch()
+        self._replay()
+        self._file = open(self.path, "ab")
+
+        self._closed = threading.Event()
+        self._compactor = threading.Thread(
+            target=self._compaction_loop, args=(compaction_interval,), name="timeseries-compactor", daemon=True
+        )
+        self._compactor.start()
+
+    @property
+    def _tmp_path(self) -> Path:
+        return self.path.with_suffix(self.path.suffix + ".compact")
+
+    def _replay(self) -> None:
+        """Rebuild the series from the log and cut off a torn last frame."""
+        data = self.path.read_bytes()
+        now = time.time()
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(data):
+            magic, kind, tier, did_len, metric_len, timestamp, crc = FRAME_HEADER.unpack_from(data, offset)
+            body_size = did_len + metric_len + PAYLOAD_SIZES.get(kind, 0)
+            end = offset + FRAME_HEADER.size + body_size
+            if magic != FRAME_MAGIC or kind not in PAYLOAD_SIZES or end > len(data):
+                break
+            body = data[offset + FRAME_HEADER.size:end]
+            if zlib.crc32(body) != crc:
+                break
+            did = body[:did_len].decode()
+            metric = body[did_len:did_len + metric_len].decode()
+            self._apply(kind, did, metric, timestamp, body[did_len + metric_len:], tier, now)
+            self._log_frames += 1
+            offset = end
+        if offset != len(data):
+            logging.warning(f"Discarding incomplete time-series entry at offset {offset} in {self.path}")
+            os.truncate(self.path, offset)
+        self._log_bytes = offset
+
+    def _apply(self, kind: int, did: str, metric: str, timestamp: float, payload: bytes, tier: int,
+               now: float) -> None:
+        """Apply a frame to the series. Must be called with the lock held."""
+        if kind == KIND_DROP:
+            self._live -= sum(len(series) for series in self._series.pop(did, {}).values())
+            return
+        metrics = self._series.setdefault(did, {})
+        series = metrics.get(metric)
+        if series is None:
+            series = metrics[sys.intern(metric)] = _Series(len(self.policy.tiers))
+        if kind == KIND_POINT:
+            series.add(timestamp, *POINT.unpack(payload))
+            self._live += 1
+        elif series.tiers:
+            # Buckets of a tier that has been removed from the policy end up in the last tier
+            tier = min(tier, len(series.tiers) - 1)
+            resolution = self.policy.tiers[tier].resolution
+            self._live += series.tiers[tier].add(timestamp - timestamp % resolution, *BUCKET.unpack(payload))
+        self._enforce(did, metric, series, now)
+
+    def _enforce(self, did: str, metric: str, series: _Series, now: float) -> None:
+        """Downsample and drop the points of a series according to the policy. Must be called with the lock held."""
+        tiers = self.policy.tiers
+        end = max(bisect_left(series.times, now - self.policy.raw_retention), len(series.times) - self.max_points)
+        if end > 0:
+            if tiers:
+                buckets, resolution = series.tiers[0], tiers[0].resolution
+                for timestamp, value in zip(series.times[:end], series.values[:end]):
+                    self._live += buckets.add(timestamp - timestamp % resolution, value, value, value, 1)
+            del series.times[:end]
+            del series.values[:end]
+            self._live -= end
+        for index, (tier, buckets) in enumerate(zip(tiers, series.tiers)):
+            end = bisect_left(buckets.starts, now - tier.retention)
+            if end == 0:
+                continue
+            rows = buckets.pop_front(end)
+            self._live -= end
+            if index + 1 < len(tiers):
+                coarser, resolution = series.tiers[index + 1], tiers[index + 1].resolution
+                for start, *aggregates in rows:
+                    self._live += coarser.add(start - start % resolution, *aggregates)
+        if not len(series):
+            metrics = self._series[did]
+            del metrics[metric]
+            if not metrics:
+                del self._series[did]
+
+    def record(self, did: str, points: Iterable[Point]) -> int:
+        """Append ``(metric, timestamp, value)`` points of a DID and return their number."""
+        points = list(points)
+        if not points:
+            return 0
+        frames = [encode_frame(KIND_POINT, did, metric, timestamp, POINT.pack(value))
+                  for metric, timestamp, value in points]
+        now = time.time()
+        with self._lock:
+            data = b"".join(frames)
+            self._file.write(data)
+            self._file.flush()
+            self._log_bytes += len(data)
+            self._log_frames += len(frames)
+            for (metric, timestamp, _), frame in zip(points, frames):
+                self._apply(KIND_POINT, did, metric, timestamp, frame[-POINT.size:], 0, now)
+        return len(points)
+
+    def remove(self, did: str) -> None:
+        """Drop the whole history of a DID, e.g. when its battery pass is deleted."""
+        with self._lock:
+            if did not in self._series:
+                return
+            frame = encode_frame(KIND_DROP, did)
+            self._file.write(frame)
+            self._file.flush()
+            self._log_bytes += len(frame)
+            self._log_frames += 1
+            self._apply(KIND_DROP, did, "", 0.0, b"", 0, time.time())
+
+    def query(self, did: str, metric: str | None = None, since: float | None = None,
+              until: float | None = None) -> dict:
+        """
+        The history of the metrics of a DID whose name is or starts with ``metric``, between
+        ``since`` and ``until`` as Unix timestamps. Every metric maps ``raw`` and the name of each
+        tier to its columns, the buckets of a tier are identified by the timestamp they start at.
+        """
+        result = {}
+        with self._lock:
+            metrics = self._series.get(did, {})
+            for name in sorted(metrics):
+                if metric and name != metric and not name.startswith(metric + "."):
+                    continue
+                series = metrics[name]
+                start, end = self._range(series.times, since, until)
+                history = {"raw": {"time": series.times[start:end].tolist(),
+                                   "value": series.values[start:end].tolist()}}
+                for tier, buckets in zip(self.policy.tiers, series.tiers):
+                    start, end = self._range(buckets.starts, since, until)
+                    count = buckets.count[start:end].tolist()
+                    history[tier.name] = {
+                        "time": buckets.starts[start:end].tolist(),
+                        "min": buckets.minimum[start:end].tolist(),
+                        "max": buckets.maximum[start:end].tolist(),
+                        "mean": [total / n for total, n in zip(buckets.total[start:end], count)],
+                        "count": count,
+                    }
+                result[name] = history
+        return result
+
+    @staticmethod
+    def _range(times: array.array, since: float | None, until: float | None) -> tuple[int, int]:
+        return (
+            bisect_left(times, since) if since is not None else 0,
+            bisect_right(times, until) if until is not None else len(times),
+        )
+
+    def __contains__(self, did: str) -> bool:
+        return did in self._series
+
+    def enforce(self) -> None:
+        """Apply the retention policy to all series, including those that don't receive new points."""
+        now = time.time()
+        with self._lock:
+            for did, metrics in list(self._series.items()):
+                for metric, series in list(metrics.items()):
+                    self._enforce(did, metric, series, now)
+
+    def needs_compaction(self) -> bool:
+        return (
+                self._log_bytes >= self.compaction_min_bytes
+                and self._log_frames > self.compaction_ratio * self._live
+        )
+
+    def _snapshot_frames(self) -> tuple[list[bytes], int]:
+        """Encode the live points and buckets as frames. Must be called with the lock held."""
+        frames = []
+        for did, metrics in self._series.items():
+            for metric, series in metrics.items():
+                for timestamp, value in zip(series.times, series.values):
+                    frames.append(encode_frame(KIND_POINT, did, metric, timestamp, POINT.pack(value)))
+                for tier, buckets in enumerate(series.tiers):
+                    for start, *aggregates in zip(*buckets.columns()):
+                        frames.append(encode_frame(KIND_BUCKET, did, metric, start, BUCKET.pack(*aggregates), tier))
+        return frames, self._log_bytes
+
+    def compact(self) -> None:
+        """Write the live points and buckets into a new log and replace the current one with it."""
+        with self._compact_lock:
+            with self._lock:
+                frames, tail_offset = self._snapshot_frames()
+                tail_frames = self._log_frames
+            with open(self._tmp_path, "wb") as segment:
+                segment.write(b"".join(frames))
+                with self._lock:
+                    with open(self.path, "rb") as log:
+                        log.seek(tail_offset)
+                        segment.write(log.read())
+                    segment.flush()
+                    os.fsync(segment.fileno())
+                    os.replace(self._tmp_path, self.path)
+                    retired_file = self._file
+                    self._file = open(self.path, "ab")
+                    logging.info(f"Compacted {self.path} from {self._log_bytes} to {segment.tell()} bytes")
+                    self._log_frames = len(frames) + self._log_frames - tail_frames
+                    self._log_bytes = segment.tell()
+            retired_file.close()
+
+    def _compaction_loop(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            self.enforce()
+            if not self.needs_compaction():
+                continue
+            try:
+                self.compact()
+            except OSError as e:
+                logging.error(f"Compaction of {self.path} failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "dids": len(self._series),
+            "series": sum(len(metrics) for metrics in self._series.values()),
+            "entries": self._live,
+            "log_bytes": self._log_bytes,
+        }
+
+    def close(self) -> None:
+        self._closed.set()
+        self._compactor.join()
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._process_lock.close()
+
+
+def open_timeseries() -> TimeSeriesStore:
+    """Open the time-series store configured by the ``TIMESERIES_*`` environment variables."""
+    return TimeSeriesStore(
+        os.getenv("TIMESERIES_PATH", "data/timeseries.log"),
+        RetentionPolicy.parse(os.getenv("TIMESERIES_RETENTION", DEFAULT_RETENTION)),
+        max_points=int(os.getenv("TIMESERIES_MAX_POINTS", "10000")),
+    )
+
+
+def is_telemetry_list(path_keys: list[str]) -> bool:
+    """Whether an update path points to an attribute of the telemetry, whose list only keeps its latest entries."""
+    return len(path_keys) == len(TELEMETRY_PATH) + 1 and tuple(path_keys[:len(TELEMETRY_PATH)]) == TELEMETRY_PATH
+
+
+def latest_entries(entries: list) -> list:
+    """
+    The latest entries of a list of the telemetry: the last entry of each ``batteryComponent``,
+    e.g. of ``internalResistanceIncrease``, and the last of all entries without one.
+    """
+    latest = {}
+    for entry in entries:
+        component = entry.get("batteryComponent") if isinstance(entry, dict) else None
+        if not isinstance(component, str):
+            component = None
+        latest.pop(component, None)
+        latest[component] = entry
+    return list(latest.values())
+
+
+def latest_telemetry(path_keys: list[str], value):
+    """
+    The value set at an update path, with the lists of the telemetry within it reduced to their
+    latest entries if the path is above ``performance.batteryCondition``. The value isn't modified.
+    """
+    if tuple(path_keys) != TELEMETRY_PATH[:len(path_keys)] or not isinstance(value, dict):
+        return value
+    if len(path_keys) < len(TELEMETRY_PATH):
+        key = TELEMETRY_PATH[len(path_keys)]
+        return {**value, key: latest_telemetry(path_keys + [key], value[key])} if key in value else value
+    return {key: latest_entries(item) if isinstance(item, list) else item for key, item in value.items()}
+
+
+def parse_timestamp(value, default: float) -> float:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            pass
+    return default
+
+
+def _collect(path: list[str], value, timestamp: float, points: list[Point]) -> None:
+    if isinstance(value, bool) or len(path) > _MAX_METRIC_DEPTH:
+        return
+    if isinstance(value, (int, float)):
+        metric = ".".join(path)
+        if metric in TELEMETRY_METRICS and math.isfinite(value):
+            points.append((metric, timestamp, float(value)))
+    elif isinstance(value, dict):
+        timestamp = parse_timestamp(value.get("lastUpdate"), timestamp)
+        # Entries of lists like internalResistanceIncrease describe different components,
+        # each of which gets its own series
+        component = value.get("batteryComponent")
+        if component in BATTERY_COMPONENTS:
+            path = path + [component]
+        for key, item in value.items():
+            _collect(path + [key], item, timestamp, points)
+    elif isinstance(value, list):
+        for item in value:
+            _collect(path, item, timestamp, points)
+
+
+def telemetry_points(updates: list, now: float | None = None) -> list[Point]:
+    """
+    The numeric telemetry in a list of ``{"path.to.key": value}`` updates as ``(metric, timestamp, value)``
+    points. A metric is the dotted path of a number below ``performance.batteryCondition``, e.g.
+    ``stateOfCharge.stateOfChargeValue``, its timestamp the ``lastUpdate`` next to it or ``now``.
+    The path of a list entry with a ``batteryComponent`` contains the component, e.g.
+    ``internalResistanceIncrease.pack.internalResistanceIncreaseValue``. Numbers at paths that
+    aren't in ``TELEMETRY_METRICS`` are left out.
+    """
+    now = time.time() if now is None else now
+    points = []
+    for element in updates:
+        for key, value in element.items():
+            path = key.split(".")
+            if tuple(path[:len(TELEMETRY_PATH)]) != TELEMETRY_PATH[:len(path)]:
+                continue
+            # An update of e.g. the whole performance submodel contains the telemetry further down
+            for parent in TELEMETRY_PATH[len(path):]:
+                value = value.get(parent) if isinstance(value, dict) else None
+            _collect(path[len(TELEMETRY_PATH):], value, now, points)
+    return points
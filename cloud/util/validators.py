@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 import json
 import re
+from functools import lru_cache
 from jsonschema import validate, Draft4Validator, ValidationError
 
 # Define relevant paths
@@ -23,15 +24,19 @@ def load_schema(submodel: str) -> dict:
     with path.open("r", encoding="utf-8") as f:
         return json.load(f)
 
+@lru_cache()
+def get_validator(submodel: str) -> Draft4Validator:
+    """Load the schema of a submodel once per process and keep its validator"""
+    return Draft4Validator(load_schema(submodel))
+
 # ------------------------------- Full Payload Validation ------------------------------- #
 def validate_battery_pass_payload(data: dict):
     """Validate a complete given battery pass payload"""
     results = {}
     for submodel_name, payload in data.items():
         try:
-            schema = load_schema(submodel_name)
             #validate(instance=payload, schema=schema)
-            Draft4Validator(schema).validate(payload)
+            get_validator(submodel_name).validate(payload)
             results[submodel_name] = "Valid"
         except FileNotFoundError as e:
             results[submodel_name] = f"Missing schema: {e}"